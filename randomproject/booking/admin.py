@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import Receipt, Address, ReceiptProduct, InvoiceProduct, Invoice, Company, InvoicePrepayment
+from .models import (
+    Receipt, Address, ReceiptProduct, InvoiceProduct, Invoice, Company, InvoicePrepayment, DocumentSequence,
+    ReceiptTaxSummary, InvoiceTaxSummary, SalesRollup, SearchEntry
+)
 
 
 admin.site.register(Receipt)
@@ -9,3 +12,8 @@ admin.site.register(Invoice)
 admin.site.register(InvoiceProduct)
 admin.site.register(Company)
 admin.site.register(InvoicePrepayment)
+admin.site.register(DocumentSequence)
+admin.site.register(ReceiptTaxSummary)
+admin.site.register(InvoiceTaxSummary)
+admin.site.register(SalesRollup)
+admin.site.register(SearchEntry)
@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class BookingConfig(AppConfig):
     name = 'booking'
+
+    def ready(self):
+        from .search import create_search_index
+        post_migrate.connect(create_search_index, sender=self)
@@ -0,0 +1,32 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers import asgi
+
+
+class ASGIHandler(asgi.ASGIHandler):
+
+    """
+    Django ASGI handler which sends async streaming content of responses from the event loop,
+    so slow clients of long downloads don't hold a thread between chunks.
+    Views still run synchronously, Django 3.1 has no async ORM and Django REST framework no async views.
+    """
+
+    async def send_response(self, response, send):
+        async_streaming_content = getattr(response, "async_streaming_content", None)
+        if async_streaming_content is None:
+            return await super().send_response(response, send)
+        headers = [
+            (header.encode("ascii"), value.encode("latin1"))
+            for header, value in response.items()
+        ]
+        headers.extend(
+            (b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            for cookie in response.cookies.values()
+        )
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+        try:
+            async for part in async_streaming_content:
+                for chunk, _ in self.chunk_bytes(response.make_bytes(part)):
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body"})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
@@ -0,0 +1,497 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection
+from django.shortcuts import reverse
+from dj_rest_auth.jwt_auth import JWTAuthentication
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+from users.authentication import CachedJWTAuthentication, forget_user
+from .models import Address, Company, Receipt, Invoice
+from .asgi import ASGIHandler
+from .representations import FlatReceiptSerializer, FlatInvoiceSerializer
+from .serializers import ReceiptSerializer, InvoiceSerializer
+from .renderers import ORJSONRenderer, MessagePackRenderer, msgpack
+from time import perf_counter, sleep
+import asyncio
+import io
+import resource
+import statistics
+import threading
+import tracemalloc
+
+User = get_user_model()
+
+RECEIPT_DATA = {
+    "header": "Benchmark receipt",
+    "currency": "PLN",
+    "checkout_number": 1,
+    "products": [
+        {"name": "Egg", "unit_price": 1, "quantity": 5, "vat_type": "A"},
+        {"name": "Apple", "unit_price": 0.95, "quantity": 100, "vat_type": "B"},
+        {"name": "Bread", "unit_price": 3.49, "quantity": 1, "vat_type": "E"}
+    ]
+}
+
+INVOICE_DATA = {
+    "buyer_address": {
+        "street": "Buyerstreet",
+        "building_number": "2",
+        "post_code": "12-345",
+        "city": "Buyercity",
+        "country": "Poland"
+    },
+    "buyer_name": "Benchmark buyer",
+    "buyer_nip": "1234567890",
+    "date_finished": "2020-01-01",
+    "currency": "EUR",
+    "is_paid": True,
+    "is_prepayment": True,
+    "prepayments": [{"net_price": 10, "vat_tax": 23}, {"net_price": 5, "vat_tax": 8}],
+    "products": [
+        {"name": "Shelf", "unit_price": 4.99, "unit": "pcs", "quantity": 10, "vat_tax": 23},
+        {"name": "Kettle", "unit_price": 10.99, "unit": "pcs", "quantity": 2, "vat_tax": 8}
+    ]
+}
+
+
+class QueryCounter:
+
+    """
+    Database execute wrapper counting queries, unlike connection.queries it isn't reset by request signals.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def get_peak_rss():
+    """
+    Returns the peak resident set size of the process in megabytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def create_owner(username="benchmark"):
+    user = User.objects.create(username=username, first_name="Bench", last_name="Mark")
+    address = Address.objects.intern(
+        street="Benchstreet",
+        building_number="1",
+        post_code="12-345",
+        city="Benchcity",
+        country="Poland"
+    )
+    company = Company.objects.create(
+        owner=user,
+        name=f"{username} company",
+        website="benchmark.com",
+        company_address=address,
+        nip_number="1234567890"
+    )
+    return user, company
+
+
+def get_client(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+def seed_receipts(company, count, batch_size=5000):
+    created = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        Receipt.objects.bulk_create(
+            Receipt(
+                company=company,
+                header="Benchmark receipt",
+                currency="PLN",
+                print_number=created + number + 1,
+                receipt_number=created + number + 1,
+                total_tax="1.87",
+                gross_price="9.99"
+            )
+            for number in range(size)
+        )
+        created += size
+
+
+def seed_invoices(company, count, batch_size=5000):
+    buyer_address = Address.objects.intern(**INVOICE_DATA["buyer_address"])
+    created = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        Invoice.objects.bulk_create(
+            Invoice(
+                company=company,
+                buyer_name="Benchmark buyer",
+                buyer_address=buyer_address,
+                date_finished="2020-01-01",
+                invoice_number=f"FV/2020/01/{created + number + 1}",
+                currency="EUR",
+                is_paid=True,
+                net_price="8.12",
+                total_tax="1.87",
+                gross_price="9.99"
+            )
+            for number in range(size)
+        )
+        created += size
+
+
+def measure(request, iterations):
+    """
+    Calls request `iterations` times, returns latency percentiles in milliseconds, throughput and queries per call.
+    """
+    latencies = []
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        for _ in range(iterations):
+            start = perf_counter()
+            request()
+            latencies.append(perf_counter() - start)
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50_ms": percentiles[49] * 1000,
+        "p95_ms": percentiles[94] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "requests_per_second": iterations / sum(latencies),
+        "queries_per_request": queries.count / iterations
+    }
+
+
+def check_status(response, status_code):
+    if response.status_code != status_code:
+        raise AssertionError(f"Expected {status_code}, got {response.status_code}: {response.content[:200]}")
+    return response
+
+
+def seed_documents(client, company, count, batch_size=100):
+    """
+    Creates `count` receipts through the bulk endpoint, with products and tax summaries like real ones.
+    """
+    for offset in range(0, count, batch_size):
+        receipts = [{**RECEIPT_DATA, "company_name": company.name}] * min(batch_size, count - offset)
+        check_status(client.post(reverse("receipt-bulk"), receipts, format="json"), 201)
+
+
+def benchmark_receipt_create(options):
+    """
+    Creates `iterations` receipts one by one.
+    """
+    user, company = create_owner("receipt_create")
+    client = get_client(user)
+    data = {**RECEIPT_DATA, "company_name": company.name}
+    results = measure(lambda: check_status(client.post(reverse("receipt-list"), data, format="json"), 201),
+                      options["iterations"])
+    results["peak_rss_mb"] = get_peak_rss()
+    return results
+
+
+def benchmark_invoice_create(options):
+    """
+    Creates `iterations` prepayment invoices one by one.
+    """
+    user, company = create_owner("invoice_create")
+    client = get_client(user)
+    data = {**INVOICE_DATA, "company_name": company.name}
+    results = measure(lambda: check_status(client.post(reverse("invoice-list"), data, format="json"), 201),
+                      options["iterations"])
+    results["peak_rss_mb"] = get_peak_rss()
+    return results
+
+
+def benchmark_list(options):
+    """
+    Lists `documents` receipts, fetching pages of 20 at the first, 10th and 50th page of the cursor pagination.
+    """
+    user, company = create_owner("list")
+    client = get_client(user)
+    seed_documents(client, company, options["documents"])
+    results = {"documents": options["documents"]}
+    url = reverse("receipt-list") + "?page_size=20"
+    depth = 0
+    for page in (1, 10, 50):
+        while depth < page - 1 and url is not None:
+            url = client.get(url).data["next"]
+            depth += 1
+        if url is None:
+            break
+        for name, value in measure(lambda: check_status(client.get(url), 200), options["iterations"]).items():
+            results[f"page_{page}_{name}"] = value
+    results["peak_rss_mb"] = get_peak_rss()
+    return results
+
+
+def benchmark_list_serializers(options):
+    """
+    Serializes pages of 100 and 1000 receipts and invoices with the serializers and with the flat list serializers,
+    including the queries. Iterations are scaled down with the page size.
+    """
+    user, company = create_owner("list_serializers")
+    client = get_client(user)
+    seed_documents(client, company, 1000)
+    invoices = [{**INVOICE_DATA, "company_name": company.name}] * 1000
+    check_status(client.post(reverse("invoice-import-invoices"), invoices, format="json"), 200)
+    documents = (
+        ("receipt", ReceiptSerializer, FlatReceiptSerializer(), Receipt.objects.filter(company=company)
+         .select_related("company__company_address", "sales_point").prefetch_related("products", "tax_summaries")),
+        ("invoice", InvoiceSerializer, FlatInvoiceSerializer(), Invoice.objects.filter(company=company)
+         .select_related("company__company_address", "buyer_address")
+         .prefetch_related("products", "prepayments", "tax_summaries"))
+    )
+    results = {}
+    for doctype, serializer_class, flat_serializer, queryset in documents:
+        for page_size in (100, 1000):
+            iterations = max(options["iterations"] * 10 // page_size, 5)
+            page = queryset.order_by("-date_created", "-id")[:page_size]
+            flat_page = flat_serializer.get_queryset(page)
+            variants = {
+                "serializer": lambda: serializer_class(list(page.all()), many=True).data,
+                "flat": lambda: flat_serializer.to_representation(list(flat_page.all()))
+            }
+            for variant, request in variants.items():
+                for name, value in measure(request, iterations).items():
+                    results[f"{doctype}_{page_size}_{variant}_{name}"] = value
+            results[f"{doctype}_{page_size}_speedup"] = \
+                results[f"{doctype}_{page_size}_serializer_p50_ms"] / results[f"{doctype}_{page_size}_flat_p50_ms"]
+    results["peak_rss_mb"] = get_peak_rss()
+    return results
+
+
+def benchmark_renderers(options):
+    """
+    Renders pages of 20 and 100 invoices, as listed by the API, with DRF's JSONRenderer, ORJSONRenderer
+    and MessagePackRenderer when msgpack is installed.
+    """
+    user, company = create_owner("renderers")
+    client = get_client(user)
+    invoices = [{**INVOICE_DATA, "company_name": company.name}] * 100
+    check_status(client.post(reverse("invoice-import-invoices"), invoices, format="json"), 200)
+    renderers = {"drf_json": JSONRenderer(), "orjson": ORJSONRenderer()}
+    if msgpack is not None:
+        renderers["msgpack"] = MessagePackRenderer()
+    results = {}
+    for page_size in (20, 100):
+        data = check_status(client.get(reverse("invoice-list"), {"page_size": page_size}), 200).data
+        for name, renderer in renderers.items():
+            for metric, value in measure(lambda: renderer.render(data), options["iterations"]).items():
+                if metric != "queries_per_request":
+                    results[f"{page_size}_{name}_{metric}"] = value
+            results[f"{page_size}_{name}_bytes"] = len(renderer.render(data))
+    return results
+
+
+def benchmark_retrieve(options):
+    """
+    Retrieves a receipt with an empty representation cache, from the cache and with a matching ETag.
+    """
+    user, company = create_owner("retrieve")
+    client = get_client(user)
+    seed_documents(client, company, 1)
+    url = reverse("receipt-detail", kwargs={"pk": Receipt.objects.get(company=company).pk})
+    etag = client.get(url)["ETag"]
+
+    def cold():
+        cache.clear()
+        check_status(client.get(url), 200)
+
+    results = {}
+    requests = {
+        "cold": cold,
+        "cached": lambda: check_status(client.get(url), 200),
+        "not_modified": lambda: check_status(client.get(url, HTTP_IF_NONE_MATCH=etag), 304)
+    }
+    for variant, request in requests.items():
+        for name, value in measure(request, options["iterations"]).items():
+            results[f"{variant}_{name}"] = value
+    results["peak_rss_mb"] = get_peak_rss()
+    return results
+
+
+def consume_stream(response):
+    """
+    Reads a streaming response, returns seconds to the first chunk, total seconds and number of bytes.
+    """
+    start = perf_counter()
+    first_byte = None
+    size = 0
+    for chunk in response.streaming_content:
+        if first_byte is None:
+            first_byte = perf_counter() - start
+        size += len(chunk)
+    return first_byte, perf_counter() - start, size
+
+
+def benchmark_report(options, doctype="receipt"):
+    """
+    Exports a report of `rows` documents, measuring time to first byte, queries and memory of the export.
+    """
+    user, company = create_owner(f"{doctype}_report")
+    if doctype == "receipt":
+        seed_receipts(company, options["rows"])
+    else:
+        seed_invoices(company, options["rows"])
+    client = get_client(user)
+    url = reverse("report", kwargs={"doctype": doctype})
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        start = perf_counter()
+        response = client.get(url)
+        request_time = perf_counter() - start
+        first_byte, stream_time, size = consume_stream(response)
+    tracemalloc.start()
+    consume_stream(client.get(url))
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    total_time = request_time + stream_time
+    return {
+        "rows": options["rows"],
+        "bytes": size,
+        "time_to_first_byte": request_time + first_byte,
+        "total_time": total_time,
+        "rows_per_second": options["rows"] / total_time,
+        "queries": queries.count,
+        "peak_python_memory_mb": peak_memory / 1024 / 1024,
+        "peak_rss_mb": get_peak_rss()
+    }
+
+
+def benchmark_auth(options):
+    """
+    Authenticates `iterations` requests with the uncached and the cached JWT authentication,
+    measuring time and database queries per request.
+    """
+    user, _ = create_owner("auth")
+    forget_user(user.pk)
+    request = APIRequestFactory().get("/", HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+    results = {"iterations": options["iterations"]}
+    for name, authentication in (("jwt", JWTAuthentication()), ("cached_jwt", CachedJWTAuthentication())):
+        queries = QueryCounter()
+        with connection.execute_wrapper(queries):
+            start = perf_counter()
+            for _ in range(options["iterations"]):
+                authentication.authenticate(request)
+            elapsed = perf_counter() - start
+        results[f"{name}_ms_per_request"] = elapsed / options["iterations"] * 1000
+        results[f"{name}_queries_per_request"] = queries.count / options["iterations"]
+    return results
+
+
+def wsgi_get(handler, path, token, read_delay=0):
+    """
+    Makes a GET request through a WSGI handler, reading the response a chunk every read_delay seconds.
+    """
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "HTTP_HOST": "testserver",
+        "HTTP_AUTHORIZATION": f"Bearer {token}",
+        "SERVER_NAME": "testserver",
+        "SERVER_PORT": "80",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO()
+    }
+    start = perf_counter()
+    response = handler(environ, lambda status, headers: None)
+    try:
+        for _ in response:
+            sleep(read_delay)
+    finally:
+        response.close()
+    return perf_counter() - start
+
+
+async def asgi_get(application, path, token, read_delay=0):
+    """
+    Makes a GET request through an ASGI application, reading the response a chunk every read_delay seconds.
+    """
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": b"",
+        "server": ("testserver", 80),
+        "headers": [(b"authorization", f"Bearer {token}".encode())]
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            await asyncio.sleep(read_delay)
+
+    start = perf_counter()
+    await application(scope, receive, send)
+    return perf_counter() - start
+
+
+def benchmark_slow_readers(options):
+    """
+    Serves `readers` concurrent report downloads to clients reading a chunk every `read_delay` seconds,
+    through WSGI with a pool of `threads` threads and through booking.asgi.ASGIHandler.
+    Measures the total time, the threads used and the latency of a short request made during the downloads.
+    """
+    user, company = create_owner("slow_readers")
+    seed_receipts(company, settings.REPORT_CHUNK_SIZE * 2)
+    token = str(AccessToken.for_user(user))
+    report_url = reverse("report", kwargs={"doctype": "receipt"})
+    probe_url = reverse("company-list")
+    readers, read_delay = options["readers"], options["read_delay"]
+    results = {"readers": readers, "read_delay": read_delay, "wsgi_threads": options["threads"]}
+
+    handler = WSGIHandler()
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=options["threads"]) as executor:
+        downloads = [executor.submit(wsgi_get, handler, report_url, token, read_delay) for _ in range(readers)]
+        probe = executor.submit(wsgi_get, handler, probe_url, token)
+        probe_start = perf_counter()
+        probe.result()
+        results["wsgi_probe_latency"] = perf_counter() - probe_start
+        for download in downloads:
+            download.result()
+    results["wsgi_total_time"] = perf_counter() - start
+
+    application = ASGIHandler()
+
+    async def run():
+        peak_threads = threading.active_count()
+        downloads = [
+            asyncio.ensure_future(asgi_get(application, report_url, token, read_delay)) for _ in range(readers)
+        ]
+        await asyncio.sleep(0)
+        results["asgi_probe_latency"] = await asgi_get(application, probe_url, token)
+        while not all(download.done() for download in downloads):
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*downloads)
+        results["asgi_peak_threads"] = peak_threads
+
+    start = perf_counter()
+    asyncio.run(run())
+    results["asgi_total_time"] = perf_counter() - start
+    return results
+
+
+SCENARIOS = {
+    "receipt_create": benchmark_receipt_create,
+    "invoice_create": benchmark_invoice_create,
+    "list": benchmark_list,
+    "list_serializers": benchmark_list_serializers,
+    "renderers": benchmark_renderers,
+    "retrieve": benchmark_retrieve,
+    "report": benchmark_report,
+    "invoice_report": partial(benchmark_report, doctype="invoice"),
+    "auth": benchmark_auth,
+    "slow_readers": benchmark_slow_readers
+}
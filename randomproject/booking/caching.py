@@ -0,0 +1,175 @@
+"""
+Caches of rendered receipts and invoices and of companies resolved by name.
+Documents never change after creation, so an entry is only invalidated when the document is deleted
+or its company is updated, which replaces the company version stored with every entry.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework import status
+from randomproject.lru import LRUCache
+from .models import Company
+from uuid import uuid4
+import hashlib
+import json
+
+# Per-process cache of (owner id, company name) -> (company, company version)
+companies = LRUCache(settings.COMPANY_CACHE_SIZE, settings.COMPANY_CACHE_TTL)
+
+
+def get_company_version_key(company_id):
+    return f"booking:company-version:{company_id}"
+
+
+def get_company_version(company_id):
+    return cache.get_or_set(get_company_version_key(company_id), uuid4().hex, None)
+
+
+def get_company_versions(company_ids):
+    """
+    Returns versions of companies by id with one cache round trip, or two when some aren't set yet.
+    """
+    keys = {get_company_version_key(company_id): company_id for company_id in company_ids}
+    if not keys:
+        return {}
+    versions = cache.get_many(list(keys))
+    missing = {key: uuid4().hex for key in keys.keys() - versions.keys()}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def bump_company_version(company_id):
+    cache.set(get_company_version_key(company_id), uuid4().hex, None)
+
+
+def get_companies(owner, names):
+    """
+    Returns owner's companies by name, unknown names are left out.
+    Cached companies are used while their version is current, so updates made by other processes are seen.
+    """
+    entries = {}
+    for name in names:
+        entry = companies.get((owner.pk, name))
+        if entry is not None:
+            entries[name] = entry
+    versions = get_company_versions({company.pk for company, _ in entries.values()})
+    found = {name: company for name, (company, version) in entries.items() if versions[company.pk] == version}
+    missing = set(names) - found.keys()
+    if missing:
+        loaded = list(Company.objects.filter(owner=owner, name__in=missing).select_related("company_address"))
+        versions = get_company_versions({company.pk for company in loaded})
+        for company in loaded:
+            companies.set((owner.pk, company.name), (company, versions[company.pk]))
+            found[company.name] = company
+    return found
+
+
+def get_company(owner, name):
+    company = get_companies(owner, [name]).get(name)
+    if company is None:
+        raise Http404
+    return company
+
+
+def forget_company(owner_id, name):
+    companies.delete((owner_id, name))
+
+
+def get_representation_key(doctype, pk, variant=""):
+    return f"booking:{doctype}:{pk}:{variant}" if variant else f"booking:{doctype}:{pk}"
+
+
+def get_deleted_key(doctype, pk):
+    return f"booking:{doctype}:{pk}:deleted"
+
+
+def get_representation_variant(fields, expand):
+    """
+    Returns the part of the cache key of representations with sparse fields, see SparseFieldsMixin.
+    """
+    if fields is None and expand is None:
+        return ""
+    params = [f"{name}={','.join(sorted(names))}" for name, names in (("fields", fields), ("expand", expand))
+              if names is not None]
+    return hashlib.sha256("&".join(params).encode()).hexdigest()[:16]
+
+
+def get_representation(doctype, pk, owner_id, variant=""):
+    key = get_representation_key(doctype, pk, variant)
+    deleted_key = get_deleted_key(doctype, pk)
+    entries = cache.get_many([key, deleted_key])
+    entry = entries.get(key)
+    if entry is None or deleted_key in entries or entry["owner_id"] != owner_id:
+        return None
+    if entry["company_version"] != get_company_version(entry["company_id"]):
+        return None
+    return entry
+
+
+def set_representation(doctype, document, data, owner_id, variant=""):
+    content = json.dumps(data, cls=JSONEncoder).encode()
+    entry = {
+        "owner_id": owner_id,
+        "company_id": document.company_id,
+        "company_version": get_company_version(document.company_id),
+        "digest": hashlib.sha256(content).hexdigest()[:32],
+        "data": data
+    }
+    cache.set(get_representation_key(doctype, document.pk, variant), entry, settings.REPRESENTATION_CACHE_TIMEOUT)
+    return entry
+
+
+def delete_representation(doctype, pk):
+    """
+    Deletes the representation of a deleted document and marks the document as deleted,
+    as representations with sparse fields can't be listed.
+    """
+    cache.set(get_deleted_key(doctype, pk), True, settings.REPRESENTATION_CACHE_TIMEOUT)
+    cache.delete(get_representation_key(doctype, pk))
+
+
+def get_representation_etag(entry, media_type):
+    """
+    Returns the ETag of the representation rendered as media_type, so every format has its own validator.
+    """
+    digest = hashlib.sha256(f"{entry['digest']}:{media_type}".encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(request, etag):
+    etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+    return "*" in etags or etag.strip('"') in (tag.strip('"') for tag in etags)
+
+
+class CachedRetrieveModelMixin:
+
+    """
+    Retrieves documents from the representation cache and answers If-None-Match requests with 304.
+    Every combination of fields and expand query parameters is cached separately, the ETag depends on
+    the negotiated media type as well.
+    """
+
+    cache_doctype = None
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        variant = get_representation_variant(*self.get_serializer_class().get_sparse_params(request.query_params))
+        entry = get_representation(self.cache_doctype, pk, request.user.pk, variant)
+        if entry is None:
+            instance = self.get_object()
+            entry = set_representation(self.cache_doctype, instance, self.get_serializer(instance).data,
+                                       request.user.pk, variant)
+        etag = get_representation_etag(entry, request.accepted_media_type)
+        if etag_matches(request, etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        else:
+            response = Response(entry["data"], headers={"ETag": etag})
+        patch_vary_headers(response, ["Accept"])
+        return response
@@ -0,0 +1,69 @@
+"""
+Incremental compression of streamed responses.
+Every chunk is compressed and flushed as it's produced, so memory use doesn't depend on the response size
+and the client gets data as soon as the first chunk is ready.
+"""
+
+from django.conf import settings
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class GzipCompressor:
+
+    content_type = "application/gzip"
+    extension = "gz"
+
+    def __init__(self):
+        # 16 + MAX_WBITS writes the gzip header and trailer
+        self.compressor = zlib.compressobj(settings.REPORT_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class ZstdCompressor:
+
+    content_type = "application/zstd"
+    extension = "zst"
+
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=settings.REPORT_ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+# Available encodings, the most preferred first
+COMPRESSORS = {"zstd": ZstdCompressor, "gzip": GzipCompressor} if zstandard is not None else {"gzip": GzipCompressor}
+
+
+def compress_chunks(chunks, encoding, charset="utf-8"):
+    compressor = COMPRESSORS[encoding]()
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode(charset) if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+async def async_compress_chunks(chunks, encoding, charset="utf-8"):
+    """
+    Async version of compress_chunks, compressing in the event loop as a chunk takes a few milliseconds.
+    """
+    compressor = COMPRESSORS[encoding]()
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode(charset) if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.finish()
@@ -1,5 +1,7 @@
 from django_filters import rest_framework as filters
-from .models import Receipt, Invoice
+from rest_framework.filters import SearchFilter
+from .models import Receipt, Invoice, SalesRollup, SearchEntry
+from .search import matching_entries
 
 
 class ReceiptFilter(filters.FilterSet):
@@ -26,3 +28,33 @@ class InvoiceFilter(filters.FilterSet):
     class Meta:
         model = Invoice
         exclude = ("id", "company")
+
+
+class SalesRollupFilter(filters.FilterSet):
+
+    period_start = filters.DateFromToRangeFilter()
+    company = filters.CharFilter(field_name="company__name")
+
+    class Meta:
+        model = SalesRollup
+        fields = {
+            "doctype": ["exact"],
+            "period": ["exact"],
+            "currency": ["exact"],
+            "vat_rate": ["exact"]
+        }
+
+
+class FullTextSearchFilter(SearchFilter):
+
+    """
+    Search parameter matching documents by the full-text index of their header or buyer name and product names.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, "").strip()
+        if not query:
+            return queryset
+        document_field = queryset.model._meta.model_name
+        entries = matching_entries(SearchEntry.objects.filter(**{f"{document_field}__isnull": False}), query)
+        return queryset.filter(id__in=entries.values(document_field))
@@ -0,0 +1,235 @@
+"""
+Deterministic synthetic receipts and invoices for performance work, see the generate_data command.
+Every company is generated from its own random generator, so the data doesn't depend on the number of processes.
+Documents are numbered the way ReceiptSerializer and InvoiceSerializer number them and the sequences, tax summaries,
+search entries and rollups are written along with them.
+"""
+
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from uuid import UUID
+from django.db import connections, transaction
+from django.utils import timezone
+from .models import (
+    Address, Company, Receipt, ReceiptProduct, ReceiptTaxSummary, Invoice, InvoiceProduct, InvoicePrepayment,
+    InvoiceTaxSummary, DocumentSequence, SalesRollup, SearchEntry
+)
+from .rollups import receipt_contributions, invoice_contributions, aggregate_contributions, rollup_key_to_fields
+from .search import receipt_search_entries, invoice_search_entries
+from .sequences import RECEIPT, INVOICE, receipt_period, invoice_period
+from .serializers import VAT_TYPES, calculate_tax_values, build_receipt_tax_summaries, build_invoice_tax_summaries
+import random
+
+PRODUCT_NAMES = [
+    "Egg", "Apple", "Bread", "Milk", "Butter", "Cheese", "Coffee", "Tea", "Sugar", "Rice", "Pasta", "Tomato",
+    "Potato", "Onion", "Chicken", "Ham", "Juice", "Water", "Chocolate", "Shelf", "Kettle", "Lamp", "Chair", "Desk"
+]
+RECEIPT_HEADERS = ["Thank you for supporting our shop", "Welcome again", "Have a nice day", None]
+BUYER_NAMES = ["Kowalski", "Nowak", "Wisniewski", "Wojcik", "Kaminski", "Lewandowski", "Zielinski", "Szymanski"]
+CURRENCIES = ["PLN"] * 8 + ["EUR", "USD"]
+INVOICE_VAT_RATES = [Decimal(23), Decimal(8), Decimal(5), Decimal(0)]
+UNITS = ["pcs", "kg", "h"]
+
+
+@contextmanager
+def keep_document_dates():
+    """
+    Lets bulk_create store generated date_created values instead of the current time.
+    """
+    fields = [Receipt._meta.get_field("date_created"), Invoice._meta.get_field("date_created")]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def random_uuid(rng):
+    return UUID(int=rng.getrandbits(128), version=4)
+
+
+def random_dates(rng, count, since, until):
+    span = (until - since).total_seconds()
+    return sorted(since + timedelta(seconds=rng.random() * span) for _ in range(count))
+
+
+def random_address(rng):
+    return {
+        "street": f"{rng.choice(BUYER_NAMES)}street",
+        "building_number": str(rng.randint(1, 200)),
+        "post_code": f"{rng.randint(10, 99)}-{rng.randint(100, 999)}",
+        "city": f"City {rng.randint(1, 50)}",
+        "country": "Poland"
+    }
+
+
+def merge_totals(totals, contributions):
+    for key, values in aggregate_contributions(contributions).items():
+        total = totals.setdefault(key, [0, 0, 0, 0])
+        for index, value in enumerate(values):
+            total[index] += value
+
+
+def generate_receipts(rng, company, count, since, until, sales_points, batch_size, totals, sequences):
+    dates = random_dates(rng, count, since, until)
+    for offset in range(0, count, batch_size):
+        receipts, products, tax_summaries, search_entries, contributions = [], [], [], [], []
+        for date_created in dates[offset:offset + batch_size]:
+            period = receipt_period(timezone.localtime(date_created).date())
+            print_number = sequences[RECEIPT, period] = sequences.get((RECEIPT, period), 0) + 1
+            receipt = Receipt(
+                id=random_uuid(rng),
+                header=rng.choice(RECEIPT_HEADERS),
+                company=company,
+                sales_point=rng.choice(sales_points) if rng.random() < 0.3 else None,
+                print_number=print_number,
+                receipt_number=print_number,
+                date_created=date_created,
+                currency=rng.choice(CURRENCIES),
+                checkout_number=str(rng.randint(1, 10))
+            )
+            receipt_products = [
+                ReceiptProduct(
+                    id=random_uuid(rng),
+                    name=rng.choice(PRODUCT_NAMES),
+                    quantity=Decimal(rng.randint(1, 5)),
+                    unit_price=Decimal(rng.randint(50, 20000)) / 100,
+                    vat_type=rng.choice(list(VAT_TYPES)),
+                    receipt=receipt
+                )
+                for _ in range(rng.randint(1, 8))
+            ]
+            receipt.gross_price = sum(product.get_full_price() for product in receipt_products)
+            receipt.total_tax = round(sum(calculate_tax_values(receipt_products).values()), 2)
+            summaries = build_receipt_tax_summaries(receipt, receipt_products)
+            for summary in summaries:
+                summary.id = random_uuid(rng)
+            receipts.append(receipt)
+            products.extend(receipt_products)
+            tax_summaries.extend(summaries)
+            search_entries.extend(receipt_search_entries(receipt, receipt_products))
+            contributions.extend(receipt_contributions(receipt, summaries))
+        with transaction.atomic():
+            Receipt.objects.bulk_create(receipts, batch_size=batch_size)
+            ReceiptProduct.objects.bulk_create(products, batch_size=batch_size)
+            ReceiptTaxSummary.objects.bulk_create(tax_summaries, batch_size=batch_size)
+            SearchEntry.objects.bulk_create(search_entries, batch_size=batch_size)
+        merge_totals(totals, contributions)
+
+
+def generate_invoices(rng, company, count, since, until, buyer_addresses, batch_size, totals, sequences):
+    """
+    Generates invoices, some of them chains of prepayment invoices of one buyer linked by previous_prepayment.
+    """
+    dates = random_dates(rng, count, since, until)
+    chain_length = 0
+    previous_invoice = None
+    for offset in range(0, count, batch_size):
+        invoices, products, prepayments, tax_summaries, search_entries, contributions = [], [], [], [], [], []
+        for date_created in dates[offset:offset + batch_size]:
+            period = invoice_period(date_created)
+            number = sequences[INVOICE, period] = sequences.get((INVOICE, period), 0) + 1
+            if chain_length == 0 and rng.random() < 0.1:
+                chain_length = rng.randint(2, 4)
+                previous_invoice = None
+            invoice = Invoice(
+                id=random_uuid(rng),
+                company=company,
+                buyer_name=previous_invoice.buyer_name if previous_invoice else rng.choice(BUYER_NAMES),
+                buyer_address=previous_invoice.buyer_address if previous_invoice else rng.choice(buyer_addresses),
+                buyer_nip=str(rng.randint(10 ** 9, 10 ** 10 - 1)),
+                date_created=date_created,
+                date_finished=date_created.date() + timedelta(days=rng.randint(0, 30)),
+                invoice_number=f"FV/{date_created.year}/{date_created.month}/{number}",
+                currency=rng.choice(CURRENCIES),
+                is_paid=rng.random() < 0.8,
+                is_prepayment=chain_length > 0,
+                previous_prepayment=previous_invoice.invoice_number if previous_invoice else None
+            )
+            invoice_prepayments = []
+            if chain_length > 0:
+                chain_length -= 1
+                previous_invoice = invoice if chain_length > 0 else None
+                invoice_prepayments = [
+                    InvoicePrepayment(
+                        id=random_uuid(rng),
+                        invoice=invoice,
+                        net_price=Decimal(rng.randint(100, 100000)) / 100,
+                        vat_tax=rng.choice(INVOICE_VAT_RATES)
+                    )
+                    for _ in range(rng.randint(1, 2))
+                ]
+            invoice_products = [
+                InvoiceProduct(
+                    id=random_uuid(rng),
+                    invoice=invoice,
+                    name=rng.choice(PRODUCT_NAMES),
+                    unit=rng.choice(UNITS),
+                    quantity=Decimal(rng.randint(1, 20)),
+                    unit_price=Decimal(rng.randint(100, 50000)) / 100,
+                    vat_tax=rng.choice(INVOICE_VAT_RATES)
+                )
+                for _ in range(rng.randint(1, 6))
+            ]
+            invoice.net_price = sum(product.get_net_price() for product in invoice_products)
+            invoice.total_tax = sum(product.get_vat_tax() for product in invoice_products)
+            invoice.gross_price = sum(product.get_gross_price() for product in invoice_products)
+            summaries = build_invoice_tax_summaries(invoice, invoice_products, invoice_prepayments)
+            for summary in summaries:
+                summary.id = random_uuid(rng)
+            invoices.append(invoice)
+            products.extend(invoice_products)
+            prepayments.extend(invoice_prepayments)
+            tax_summaries.extend(summaries)
+            search_entries.extend(invoice_search_entries(invoice, invoice_products))
+            contributions.extend(invoice_contributions(invoice, summaries))
+        with transaction.atomic():
+            Invoice.objects.bulk_create(invoices, batch_size=batch_size)
+            InvoiceProduct.objects.bulk_create(products, batch_size=batch_size)
+            InvoicePrepayment.objects.bulk_create(prepayments, batch_size=batch_size)
+            InvoiceTaxSummary.objects.bulk_create(tax_summaries, batch_size=batch_size)
+            SearchEntry.objects.bulk_create(search_entries, batch_size=batch_size)
+        merge_totals(totals, contributions)
+
+
+def generate_company_documents(task):
+    """
+    Generates receipts and invoices of one company with their sequences and rollups.
+    Runs in worker processes, so it gets and returns only plain values.
+    """
+    try:
+        company = Company.objects.get(pk=task["company_id"])
+        addresses = list(Address.objects.filter(pk__in=task["address_ids"]).order_by("content_hash"))
+        rng = random.Random(f"{task['seed']}:{task['index']}")
+        totals = {}
+        sequences = {}
+        with keep_document_dates():
+            generate_receipts(rng, company, task["receipts"], task["since"], task["until"], addresses,
+                              task["batch_size"], totals, sequences)
+            generate_invoices(rng, company, task["invoices"], task["since"], task["until"], addresses,
+                              task["batch_size"], totals, sequences)
+        with transaction.atomic():
+            DocumentSequence.objects.bulk_create(
+                DocumentSequence(company=company, doctype=doctype, period=period, last_value=last_value)
+                for (doctype, period), last_value in sequences.items()
+            )
+            SalesRollup.objects.bulk_create(
+                (
+                    SalesRollup(
+                        **rollup_key_to_fields(key),
+                        document_count=document_count,
+                        net_price=net_price,
+                        total_tax=total_tax,
+                        gross_price=gross_price
+                    )
+                    for key, (document_count, net_price, total_tax, gross_price) in totals.items()
+                ),
+                batch_size=task["batch_size"]
+            )
+        return task["receipts"], task["invoices"]
+    finally:
+        if task.get("close_connections"):
+            connections.close_all()
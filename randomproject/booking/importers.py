@@ -0,0 +1,171 @@
+from django.conf import settings
+from django.db import transaction, DatabaseError
+from django.utils import timezone
+from .models import Address, Invoice, InvoiceProduct, InvoicePrepayment, InvoiceTaxSummary, SearchEntry
+from .serializers import InvoiceSerializer, build_invoice_tax_summaries
+from .rollups import apply_contributions, invoice_contributions
+from .search import invoice_search_entries
+from .caching import get_companies
+from .sequences import number_invoices, UNNUMBERED_INVOICE
+
+
+class InvoiceImporter:
+
+    """
+    Imports invoices in batches, each batch is written in its own transaction.
+    Records are validated one by one, so a broken record only fails itself. Invoice numbers are given on creation,
+    so a batch is split before a prepayment which refers to another one that may be an earlier record of the batch.
+    """
+
+    def __init__(self, user, batch_size=None):
+        self.user = user
+        self.batch_size = batch_size or settings.BULK_BATCH_SIZE
+        self.companies = {}
+        self.prepayment_numbers = set()
+
+    def run(self, records):
+        """
+        Yields one result per record, in input order.
+        """
+        batch = []
+        for index, record in enumerate(records):
+            batch.append((index, record))
+            if len(batch) >= self.batch_size:
+                yield from self.import_batch(batch)
+                batch = []
+        if batch:
+            yield from self.import_batch(batch)
+
+    def import_batch(self, batch):
+        results = {}
+        valid_records = []
+        for index, record in batch:
+            serializer = InvoiceSerializer(data=record)
+            if serializer.is_valid():
+                valid_records.append((index, serializer.validated_data))
+            else:
+                results[index] = self.failed(index, serializer.errors)
+        self.resolve_companies({data["company_name"] for _, data in valid_records})
+        previous_prepayments = self.get_previous_prepayments(valid_records)
+        to_create = []
+        for index, data in valid_records:
+            company = self.companies.get(data["company_name"])
+            previous_prepayment = data.get("previous_prepayment")
+            if company is None:
+                results[index] = self.failed(index, {"company_name": [f"No company named {data['company_name']}"]})
+                continue
+            reference = (company.pk, previous_prepayment) \
+                if data.get("is_prepayment") and previous_prepayment is not None else None
+            if reference is not None and reference not in previous_prepayments and any(
+                other.pk == company.pk and other_data.get("is_prepayment") for _, other, other_data in to_create
+            ):
+                # The prepayment may be one of the earlier records of the batch, which get numbers when created
+                self.write(to_create, results)
+                to_create = []
+                previous_prepayments |= self.prepayment_numbers
+            if reference is not None and reference not in previous_prepayments:
+                results[index] = self.failed(
+                    index,
+                    {"previous_prepayment": [f"No prepayments with invoice number {previous_prepayment}"]}
+                )
+            else:
+                to_create.append((index, company, data))
+        self.write(to_create, results)
+        return [results[index] for index, _ in batch]
+
+    def write(self, to_create, results):
+        """
+        Creates invoices of valid records and sets their results.
+        """
+        if not to_create:
+            return
+        try:
+            invoices = self.create_invoices(to_create)
+        except DatabaseError as exc:
+            for index, _, _ in to_create:
+                results[index] = self.failed(index, {"non_field_errors": [str(exc)]})
+        else:
+            for (index, _, _), invoice in zip(to_create, invoices):
+                results[index] = {"index": index, "status": "created", "invoice_number": invoice.invoice_number}
+
+    def resolve_companies(self, company_names):
+        missing = company_names - self.companies.keys()
+        if missing:
+            self.companies.update(get_companies(self.user, missing))
+
+    def get_previous_prepayments(self, valid_records):
+        numbers = {
+            data["previous_prepayment"] for _, data in valid_records
+            if data.get("is_prepayment") and data.get("previous_prepayment") is not None
+        }
+        if not numbers:
+            return set()
+        existing = set(Invoice.objects.filter(
+            company__in=self.companies.values(),
+            invoice_number__in=numbers,
+            is_prepayment=True
+        ).values_list("company_id", "invoice_number"))
+        return existing | self.prepayment_numbers
+
+    def create_invoices(self, to_create):
+        invoices = []
+        products = []
+        prepayments = []
+        tax_summaries = []
+        search_entries = []
+        now = timezone.now()
+        with transaction.atomic():
+            buyer_addresses = iter(Address.objects.intern_many([data["buyer_address"] for _, _, data in to_create]))
+            for _, company, data in to_create:
+                data = data.copy()
+                invoice_products = data.pop("products")
+                invoice_prepayments = data.pop("prepayments", None)
+                previous_prepayment = data.pop("previous_prepayment", None)
+                data.pop("company_name")
+                data.pop("buyer_address")
+                buyer_address = next(buyer_addresses)
+                invoice = Invoice(
+                    **data,
+                    invoice_number=UNNUMBERED_INVOICE,
+                    company=company,
+                    buyer_address=buyer_address
+                )
+                if invoice.is_prepayment:
+                    invoice_prepayments = [
+                        InvoicePrepayment(**prepayment, invoice=invoice) for prepayment in invoice_prepayments
+                    ]
+                    invoice.previous_prepayment = previous_prepayment
+                else:
+                    invoice_prepayments = []
+                invoice_products = [InvoiceProduct(**product, invoice=invoice) for product in invoice_products]
+                tax_summaries.append(build_invoice_tax_summaries(invoice, invoice_products, invoice_prepayments))
+                search_entries.extend(invoice_search_entries(invoice, invoice_products))
+                invoice.net_price = sum(product.get_net_price() for product in invoice_products)
+                invoice.total_tax = sum(product.get_vat_tax() for product in invoice_products)
+                invoice.gross_price = sum(product.get_gross_price() for product in invoice_products)
+                invoices.append(invoice)
+                products.extend(invoice_products)
+                prepayments.extend(invoice_prepayments)
+            Invoice.objects.bulk_create(invoices, batch_size=self.batch_size)
+            InvoiceProduct.objects.bulk_create(products, batch_size=self.batch_size)
+            InvoicePrepayment.objects.bulk_create(prepayments, batch_size=self.batch_size)
+            InvoiceTaxSummary.objects.bulk_create(
+                [summary for summaries in tax_summaries for summary in summaries],
+                batch_size=self.batch_size
+            )
+            SearchEntry.objects.bulk_create(search_entries, batch_size=self.batch_size)
+            apply_contributions(
+                contribution
+                for invoice, summaries in zip(invoices, tax_summaries)
+                for contribution in invoice_contributions(invoice, summaries)
+            )
+            number_invoices(invoices, now)
+            Invoice.objects.bulk_update(invoices, ["invoice_number"], batch_size=self.batch_size)
+        self.prepayment_numbers.update(
+            (invoice.company_id, invoice.invoice_number) for invoice in invoices if invoice.is_prepayment
+        )
+        return invoices
+
+    @staticmethod
+    def failed(index, errors):
+        return {"index": index, "status": "failed", "errors": errors}
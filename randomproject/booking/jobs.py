@@ -0,0 +1,152 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import ReportJob
+from .reports import get_report_params, get_report_queryset, limit_report, report_rows, csv_chunks, dump_cursor
+import django
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.REPORT_JOB_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup
+        )
+    return _executor
+
+
+def get_report_path(job):
+    return Path(settings.REPORTS_ROOT) / f"{job.pk}.csv.gz"
+
+
+def normalize_report_params(doctype, params):
+    """
+    Validates report parameters and returns them in a form which is the same for equal requests.
+    """
+    validated_params = get_report_params(doctype, params)
+    normalized_params = {}
+    for name, value in validated_params.items():
+        if name == "cursor":
+            value = params["cursor"]
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        normalized_params[name] = value
+    return normalized_params
+
+
+def get_temporary_report_path(job):
+    return get_report_path(job).with_suffix(".tmp")
+
+
+def expire_report_jobs():
+    """
+    Fails jobs running longer than REPORT_JOB_TIMEOUT or pending for that long, whose worker died,
+    and deletes jobs and files of reports finished more than REPORT_JOB_REUSE_SECONDS ago.
+    Returns the number of deleted jobs.
+    """
+    now = timezone.now()
+    timeout = now - timedelta(seconds=settings.REPORT_JOB_TIMEOUT)
+    ReportJob.objects.filter(
+        Q(status=ReportJob.RUNNING, date_started__lt=timeout) | Q(status=ReportJob.PENDING, date_queued__lt=timeout)
+    ).update(status=ReportJob.FAILED, error="Report job timed out", date_finished=now)
+    expired_jobs = ReportJob.objects.filter(
+        status__in=[ReportJob.FINISHED, ReportJob.FAILED],
+        date_finished__lt=now - timedelta(seconds=settings.REPORT_JOB_REUSE_SECONDS)
+    )
+    expired_ids = list(expired_jobs.values_list("pk", flat=True))
+    for job_id in expired_ids:
+        job = ReportJob(pk=job_id)
+        get_report_path(job).unlink(missing_ok=True)
+        get_temporary_report_path(job).unlink(missing_ok=True)
+    return ReportJob.objects.filter(pk__in=expired_ids).delete()[0]
+
+
+def queue_report_job(job):
+    if settings.REPORT_JOB_WORKERS:
+        transaction.on_commit(lambda: get_executor().submit(run_report_job_in_worker, job.pk))
+    else:
+        run_report_job(job.pk)
+        job.refresh_from_db()
+
+
+def submit_report_job(user, doctype, params):
+    """
+    Returns a job generating the report and whether it was created.
+    A pending, running or recently finished job of the same report is returned instead of creating a new one,
+    a job pending longer than REPORT_JOB_REQUEUE_SECONDS is submitted to the workers again.
+    """
+    expire_report_jobs()
+    params = normalize_report_params(doctype, params)
+    params_hash = hashlib.sha256(json.dumps([doctype, params], sort_keys=True).encode()).hexdigest()
+    now = timezone.now()
+    reusable_jobs = ReportJob.objects.filter(owner=user, params_hash=params_hash).filter(
+        Q(status__in=[ReportJob.PENDING, ReportJob.RUNNING]) |
+        Q(status=ReportJob.FINISHED, date_finished__gte=now - timedelta(seconds=settings.REPORT_JOB_REUSE_SECONDS))
+    )
+    for job in reusable_jobs:
+        if job.status == ReportJob.FINISHED and not get_report_path(job).exists():
+            continue
+        stale = job.status == ReportJob.PENDING and \
+            job.date_queued < now - timedelta(seconds=settings.REPORT_JOB_REQUEUE_SECONDS)
+        # Only the request which moves date_queued requeues the job
+        if stale and ReportJob.objects.filter(pk=job.pk, date_queued=job.date_queued).update(date_queued=now):
+            logger.warning("Requeueing report job %s", job.pk)
+            queue_report_job(job)
+        return job, False
+    job = ReportJob.objects.create(owner=user, doctype=doctype, params=params, params_hash=params_hash)
+    queue_report_job(job)
+    return job, True
+
+
+def run_report_job(job_id):
+    """
+    Writes the gzip compressed csv report of a job to REPORTS_ROOT.
+    Jobs which aren't pending anymore, like requeued jobs started by another worker, are skipped.
+    """
+    if not ReportJob.objects.filter(pk=job_id, status=ReportJob.PENDING).update(
+            status=ReportJob.RUNNING, date_started=timezone.now()):
+        return
+    job = ReportJob.objects.select_related("owner").get(pk=job_id)
+    path = get_report_path(job)
+    temporary_path = get_temporary_report_path(job)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        params = get_report_params(job.doctype, job.params)
+        queryset, watermark = limit_report(get_report_queryset(job.owner, job.doctype, params), params)
+        with gzip.open(temporary_path, "wt", encoding="utf-8", newline="") as file:
+            for chunk in csv_chunks(report_rows(queryset, job.doctype)):
+                file.write(chunk)
+        os.replace(temporary_path, path)
+    except Exception as exc:
+        logger.exception("Report job %s failed", job_id)
+        ReportJob.objects.filter(pk=job_id).update(status=ReportJob.FAILED, error=str(exc),
+                                                   date_finished=timezone.now())
+    else:
+        ReportJob.objects.filter(pk=job_id).update(
+            status=ReportJob.FINISHED,
+            cursor=dump_cursor(job.doctype, *watermark) if watermark is not None else job.params.get("cursor"),
+            date_finished=timezone.now()
+        )
+
+
+def run_report_job_in_worker(job_id):
+    try:
+        run_report_job(job_id)
+    finally:
+        connections.close_all()
@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from booking.benchmarks import SCENARIOS
+import json
+import platform
+import subprocess
+
+
+class Command(BaseCommand):
+
+    help = "Runs performance benchmarks of the booking API against a temporary test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run: {', '.join(SCENARIOS)}, all by default")
+        parser.add_argument("--rows", type=int, default=1000000, help="Number of rows exported by report scenarios")
+        parser.add_argument("--documents", type=int, default=1000, help="Number of receipts listed by list scenario")
+        parser.add_argument("--iterations", type=int, default=1000, help="Number of requests made by request scenarios")
+        parser.add_argument("--readers", type=int, default=500, help="Number of concurrent slow report readers")
+        parser.add_argument("--read-delay", type=float, default=0.5, help="Seconds a slow reader takes per chunk")
+        parser.add_argument("--threads", type=int, default=32, help="Number of WSGI worker threads")
+        parser.add_argument("--output", help="Writes results as JSON to this file")
+        parser.add_argument("--compare", help="Compares results with a JSON file written by an earlier run")
+
+    def handle(self, *args, **options):
+        scenarios = options["scenarios"] or list(SCENARIOS)
+        unknown = set(scenarios) - SCENARIOS.keys()
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as file:
+                baseline = json.load(file)["scenarios"]
+        old_name = connection.settings_dict["NAME"]
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        results = {}
+        try:
+            for scenario in scenarios:
+                self.stdout.write(f"Running {scenario}...")
+                results[scenario] = SCENARIOS[scenario](options)
+                for name, value in results[scenario].items():
+                    change = self.format_change(baseline, scenario, name, value)
+                    self.stdout.write(f"  {name}: {self.format_value(value)}{change}")
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump({"meta": self.get_meta(options), "scenarios": results}, file, indent=2)
+
+    @staticmethod
+    def format_value(value):
+        return f"{value:.4f}" if isinstance(value, float) else str(value)
+
+    @staticmethod
+    def format_change(baseline, scenario, name, value):
+        old_value = (baseline or {}).get(scenario, {}).get(name)
+        if not isinstance(old_value, (int, float)) or not isinstance(value, (int, float)) or not old_value:
+            return ""
+        return f" (was {Command.format_value(old_value)}, {(value - old_value) / old_value:+.1%})"
+
+    @staticmethod
+    def get_meta(options):
+        try:
+            commit = subprocess.run(
+                ["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            "commit": commit,
+            "python": platform.python_version(),
+            "database": connection.vendor,
+            "options": {
+                name: options[name] for name in ("rows", "documents", "iterations", "readers", "read_delay", "threads")
+            }
+        }
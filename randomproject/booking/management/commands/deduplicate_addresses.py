@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from booking.models import Address
+
+
+class Command(BaseCommand):
+
+    help = "Hashes addresses created before interning, merges duplicates and repoints documents and companies"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=settings.BULK_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        relations = [
+            (relation.related_model, relation.field.name)
+            for relation in Address._meta.related_objects
+            if relation.one_to_many
+        ]
+        hashed = merged = 0
+        while True:
+            batch = list(Address.objects.filter(content_hash__isnull=True).order_by("pk")[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic():
+                for address in batch:
+                    fields = Address.normalize({name: getattr(address, name) for name in Address.FIELDS})
+                    content_hash = Address.get_content_hash(fields)
+                    canonical = Address.objects.select_for_update().filter(content_hash=content_hash).first()
+                    if canonical is None:
+                        address.save()
+                        hashed += 1
+                        continue
+                    for model, field_name in relations:
+                        model.objects.filter(**{field_name: address}).update(**{field_name: canonical})
+                    address.delete()
+                    merged += 1
+        self.stdout.write(f"Hashed {hashed} addresses, merged {merged} duplicates")
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from booking.jobs import expire_report_jobs
+from booking.models import ReportJob
+from pathlib import Path
+from uuid import UUID
+
+
+def get_job_id(path):
+    try:
+        return UUID(path.name.split(".")[0])
+    except ValueError:
+        return None
+
+
+class Command(BaseCommand):
+
+    help = "Deletes expired report jobs and their files, including files of jobs which don't exist anymore"
+
+    def handle(self, *args, **options):
+        deleted = expire_report_jobs()
+        root = Path(settings.REPORTS_ROOT)
+        paths = [(get_job_id(path), path) for path in root.glob("*.csv.*")] if root.exists() else []
+        existing = set(ReportJob.objects.filter(pk__in=[job_id for job_id, _ in paths]).values_list("pk", flat=True))
+        orphans = [path for job_id, path in paths if job_id not in existing]
+        for path in orphans:
+            path.unlink(missing_ok=True)
+        self.stdout.write(f"Deleted {deleted} expired jobs and {len(orphans)} orphaned files")
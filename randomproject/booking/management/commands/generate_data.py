@@ -0,0 +1,108 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from booking.generators import generate_company_documents, random_address, random_uuid
+from booking.models import Address, Company
+import django
+import multiprocessing
+import os
+import random
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+
+    help = "Generates a deterministic synthetic dataset of owners, companies, receipts and invoices"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--owners", type=int, default=10)
+        parser.add_argument("--companies", type=int, default=2, help="Number of companies of every owner")
+        parser.add_argument("--receipts", type=int, default=100000, help="Total number of receipts")
+        parser.add_argument("--invoices", type=int, default=10000, help="Total number of invoices")
+        parser.add_argument("--days", type=int, default=365, help="Number of days the documents are spread over")
+        parser.add_argument("--until", help="Last day of the documents, YYYY-MM-DD, today by default")
+        parser.add_argument("--seed", type=int, default=0, help="Same seed and until give the same dataset")
+        parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Ignored on SQLite")
+        parser.add_argument("--batch-size", type=int, default=settings.BULK_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options["owners"] < 1 or options["companies"] < 1:
+            raise CommandError("At least one owner and company are needed")
+        seed = options["seed"]
+        until = parse_date(options["until"]) if options["until"] else timezone.localdate()
+        if until is None:
+            raise CommandError("until must be a date in YYYY-MM-DD format")
+        until = timezone.make_aware(datetime.combine(until + timedelta(days=1), time()))
+        since = until - timedelta(days=options["days"])
+        rng = random.Random(seed)
+        if User.objects.filter(username=f"generated{seed}_0").exists():
+            raise CommandError(f"Dataset with seed {seed} is already generated")
+        with transaction.atomic():
+            address_ids = [
+                address.pk for address in Address.objects.intern_many([random_address(rng) for _ in range(100)])
+            ]
+            companies = []
+            for owner_number in range(options["owners"]):
+                owner = User(
+                    id=random_uuid(rng),
+                    username=f"generated{seed}_{owner_number}",
+                    first_name="Generated",
+                    last_name=str(owner_number)
+                )
+                owner.set_unusable_password()
+                owner.save()
+                for company_number in range(options["companies"]):
+                    companies.append(Company.objects.create(
+                        id=random_uuid(rng),
+                        owner=owner,
+                        name=f"Generated {seed} company {owner_number}-{company_number}",
+                        website="generated.com",
+                        company_address_id=rng.choice(address_ids),
+                        nip_number=str(rng.randint(10 ** 9, 10 ** 10 - 1))
+                    ))
+        processes = 1 if connection.vendor == "sqlite" else max(options["processes"], 1)
+        tasks = [
+            {
+                "seed": seed,
+                "index": index,
+                "company_id": company.pk,
+                "address_ids": address_ids,
+                "receipts": self.share(options["receipts"], len(companies), index),
+                "invoices": self.share(options["invoices"], len(companies), index),
+                "since": since,
+                "until": until,
+                "batch_size": options["batch_size"],
+                "close_connections": processes > 1
+            }
+            for index, company in enumerate(companies)
+        ]
+        if processes == 1:
+            results = map(generate_company_documents, tasks)
+        else:
+            connection.close()
+            executor = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup
+            )
+            with executor:
+                results = list(executor.map(generate_company_documents, tasks))
+        receipts = invoices = 0
+        for company_receipts, company_invoices in results:
+            receipts += company_receipts
+            invoices += company_invoices
+            self.stdout.write(f"Generated {receipts} receipts and {invoices} invoices")
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {options['owners']} owners, {len(companies)} companies, {receipts} receipts "
+            f"and {invoices} invoices"
+        ))
+
+    @staticmethod
+    def share(total, parts, index):
+        return total // parts + (1 if index < total % parts else 0)
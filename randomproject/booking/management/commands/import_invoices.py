@@ -0,0 +1,45 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from booking.importers import InvoiceImporter
+from booking.parsers import parse_ndjson
+from rest_framework.exceptions import ParseError
+import json
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+
+    help = "Imports invoices from a JSON array or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="JSON array or NDJSON file with invoices")
+        parser.add_argument("--owner", required=True, help="Username of the owner of imported companies")
+        parser.add_argument("--batch-size", type=int, default=None)
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.get(username=options["owner"])
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {options['owner']}")
+        importer = InvoiceImporter(owner, batch_size=options["batch_size"])
+        created = 0
+        failed = 0
+        with open(options["path"], encoding="utf-8") as file:
+            first_char = file.read(1)
+            while first_char.isspace():
+                first_char = file.read(1)
+            file.seek(0)
+            records = json.load(file) if first_char == "[" else parse_ndjson(file)
+            try:
+                for result in importer.run(records):
+                    if result["status"] == "created":
+                        created += 1
+                    else:
+                        failed += 1
+                        self.stderr.write(f"Record {result['index']} failed: {json.dumps(result['errors'])}")
+                    if (created + failed) % importer.batch_size == 0:
+                        self.stdout.write(f"Processed {created + failed} records")
+            except ParseError as exc:
+                raise CommandError(exc.detail)
+        self.stdout.write(self.style.SUCCESS(f"Imported {created} invoices, {failed} failed"))
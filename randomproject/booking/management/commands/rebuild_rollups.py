@@ -0,0 +1,71 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from booking.models import Receipt, Invoice, SalesRollup
+from booking.rollups import (
+    receipt_contributions, invoice_contributions, aggregate_contributions, rollup_key_to_fields
+)
+
+ROLLUP_VALUES = ("document_count", "net_price", "total_tax", "gross_price")
+
+
+class Command(BaseCommand):
+
+    help = "Recomputes sales rollups from receipts and invoices, reporting rows which drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", help="Only report drift, don't change stored rollups")
+        parser.add_argument("--batch-size", type=int, default=settings.BULK_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        with transaction.atomic():
+            expected = self.compute_rollups(batch_size)
+            stored = {
+                (rollup.company_id, rollup.doctype, rollup.period, rollup.period_start, rollup.currency,
+                 rollup.vat_rate): [getattr(rollup, name) for name in ROLLUP_VALUES]
+                for rollup in SalesRollup.objects.all()
+            }
+            drift = 0
+            for key in expected.keys() | stored.keys():
+                expected_values = expected.get(key, [0, 0, 0, 0])
+                stored_values = stored.get(key, [0, 0, 0, 0])
+                if expected_values != stored_values:
+                    drift += 1
+                    self.stdout.write(f"Drift in {key}: stored {stored_values}, expected {expected_values}")
+            self.stdout.write(f"{drift} of {len(expected)} rollups drifted")
+            if not options["check"]:
+                SalesRollup.objects.all().delete()
+                SalesRollup.objects.bulk_create(
+                    (
+                        SalesRollup(**rollup_key_to_fields(key), **dict(zip(ROLLUP_VALUES, values)))
+                        for key, values in expected.items()
+                    ),
+                    batch_size=batch_size
+                )
+                self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(expected)} rollups"))
+
+    def compute_rollups(self, batch_size):
+        totals = {}
+        documents = (
+            (Receipt.objects.order_by("pk").prefetch_related("tax_summaries"), receipt_contributions),
+            (Invoice.objects.order_by("pk").prefetch_related("tax_summaries"), invoice_contributions)
+        )
+        for queryset, get_contributions in documents:
+            last_pk = None
+            while True:
+                batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                batch = list(batch[:batch_size])
+                if not batch:
+                    break
+                contributions = (
+                    contribution
+                    for document in batch
+                    for contribution in get_contributions(document, document.tax_summaries.all())
+                )
+                for key, values in aggregate_contributions(contributions).items():
+                    total = totals.setdefault(key, [0, 0, 0, 0])
+                    for index, value in enumerate(values):
+                        total[index] += value
+                last_pk = batch[-1].pk
+        return totals
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from booking.models import Receipt, Invoice, SearchEntry
+from booking.search import create_search_index, rebuild_search_index, receipt_search_entries, invoice_search_entries
+
+
+class Command(BaseCommand):
+
+    help = "Writes search entries of receipts and invoices and rebuilds the full-text index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Rebuild entries of every document, not only missing")
+        parser.add_argument("--batch-size", type=int, default=settings.BULK_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        receipts = Receipt.objects.order_by("pk").prefetch_related("products")
+        invoices = Invoice.objects.order_by("pk").prefetch_related("products")
+        if not options["all"]:
+            receipts = receipts.exclude(id__in=SearchEntry.objects.filter(receipt__isnull=False).values("receipt"))
+            invoices = invoices.exclude(id__in=SearchEntry.objects.filter(invoice__isnull=False).values("invoice"))
+        create_search_index()
+        count = self.rebuild(receipts, "receipt", batch_size, self.build_receipt_entries)
+        self.stdout.write(f"Rebuilt search entries of {count} receipts")
+        count = self.rebuild(invoices, "invoice", batch_size, self.build_invoice_entries)
+        self.stdout.write(f"Rebuilt search entries of {count} invoices")
+        rebuild_search_index()
+        self.stdout.write("Rebuilt full-text index")
+
+    @staticmethod
+    def build_receipt_entries(receipt):
+        return receipt_search_entries(receipt, receipt.products.all())
+
+    @staticmethod
+    def build_invoice_entries(invoice):
+        return invoice_search_entries(invoice, invoice.products.all())
+
+    @staticmethod
+    def rebuild(documents, document_field, batch_size, build_entries):
+        count = 0
+        last_pk = None
+        while True:
+            batch = documents if last_pk is None else documents.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if not batch:
+                return count
+            with transaction.atomic():
+                SearchEntry.objects.filter(**{f"{document_field}__in": batch}).delete()
+                SearchEntry.objects.bulk_create(
+                    [entry for document in batch for entry in build_entries(document)],
+                    batch_size=batch_size
+                )
+            count += len(batch)
+            last_pk = batch[-1].pk
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from booking.models import Receipt, Invoice, ReceiptTaxSummary, InvoiceTaxSummary
+from booking.serializers import build_receipt_tax_summaries, build_invoice_tax_summaries
+
+
+class Command(BaseCommand):
+
+    help = "Writes tax summaries of receipts and invoices from their product lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Rebuild summaries of every document, not only missing")
+        parser.add_argument("--batch-size", type=int, default=settings.BULK_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        receipts = Receipt.objects.order_by("pk").prefetch_related("products")
+        invoices = Invoice.objects.order_by("pk").prefetch_related("products", "prepayments")
+        if not options["all"]:
+            receipts = receipts.filter(tax_summaries__isnull=True)
+            invoices = invoices.filter(tax_summaries__isnull=True)
+        count = self.rebuild(receipts, ReceiptTaxSummary, "receipt", batch_size, self.build_receipt_summaries)
+        self.stdout.write(f"Rebuilt tax summaries of {count} receipts")
+        count = self.rebuild(invoices, InvoiceTaxSummary, "invoice", batch_size, self.build_invoice_summaries)
+        self.stdout.write(f"Rebuilt tax summaries of {count} invoices")
+
+    @staticmethod
+    def build_receipt_summaries(receipt):
+        return build_receipt_tax_summaries(receipt, receipt.products.all())
+
+    @staticmethod
+    def build_invoice_summaries(invoice):
+        prepayments = invoice.prepayments.all() if invoice.is_prepayment else []
+        return build_invoice_tax_summaries(invoice, invoice.products.all(), prepayments)
+
+    @staticmethod
+    def rebuild(documents, summary_model, document_field, batch_size, build_summaries):
+        count = 0
+        last_pk = None
+        while True:
+            batch = documents if last_pk is None else documents.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if not batch:
+                return count
+            with transaction.atomic():
+                summary_model.objects.filter(**{f"{document_field}__in": batch}).delete()
+                summary_model.objects.bulk_create(
+                    [summary for document in batch for summary in build_summaries(document)],
+                    batch_size=batch_size
+                )
+            count += len(batch)
+            last_pk = batch[-1].pk
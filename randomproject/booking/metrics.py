@@ -0,0 +1,237 @@
+"""
+Request metrics per route, method and status, exposed in the Prometheus text format.
+Every process keeps its metrics in memory and writes them to its own file in METRICS_DIR at most every
+METRICS_FLUSH_INTERVAL seconds. The scrape endpoint sums the files of live processes and removes the others.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from itertools import zip_longest
+from pathlib import Path
+from threading import Lock
+from time import monotonic, perf_counter
+from uuid import uuid4
+import json
+import os
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+COUNTERS = (
+    ("booking_http_db_queries_total", "Database queries made by requests"),
+    ("booking_http_db_query_seconds_total", "Seconds requests spent in database queries"),
+    ("booking_http_render_seconds_total", "Seconds spent rendering responses"),
+    ("booking_http_response_bytes_total", "Bytes of response bodies, not counted for streaming responses"),
+    ("booking_http_serialize_seconds_total", "Seconds serializers spent building representations")
+)
+
+# Serialization timer of the current request, set by booking.middleware.MetricsMiddleware
+serialization_timer = ContextVar("serialization_timer", default=None)
+
+
+class SerializationTimer:
+
+    def __init__(self):
+        self.seconds = 0
+        self.running = False
+
+
+@contextmanager
+def measure_serialization():
+    """
+    Adds the time spent in the block to the serialization time of the current request.
+    Nested blocks, like the data of a serializer used by another one, are counted once.
+    """
+    timer = serialization_timer.get()
+    if timer is None or timer.running:
+        yield
+        return
+    timer.running = True
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timer.seconds += perf_counter() - start
+        timer.running = False
+
+
+def get_timed_serializer_class(serializer_class):
+    """
+    Returns a subclass of the serializer class which adds to_representation to the serialization time.
+    Lists are timed too, as the list serializer calls to_representation of its child for every item.
+    """
+    timed_class = timed_serializer_classes.get(serializer_class)
+    if timed_class is None:
+        def to_representation(serializer, instance):
+            with measure_serialization():
+                return serializer_class.to_representation(serializer, instance)
+
+        timed_class = type(serializer_class.__name__, (serializer_class,), {
+            "__module__": serializer_class.__module__,
+            "__qualname__": serializer_class.__qualname__,
+            "__doc__": serializer_class.__doc__,
+            "to_representation": to_representation
+        })
+        timed_serializer_classes[serializer_class] = timed_class
+    return timed_class
+
+
+# Timed subclasses of the serializer classes of views
+timed_serializer_classes = {}
+
+
+class TimedSerializerMixin:
+
+    """
+    Counts the time spent by serializers of the view in booking_http_serialize_seconds_total.
+    """
+
+    def get_serializer_class(self):
+        return get_timed_serializer_class(super().get_serializer_class())
+
+
+class Metrics:
+
+    def __init__(self):
+        self.series = {}
+        self.lock = Lock()
+        self.last_flush = monotonic()
+        self.start()
+
+    def start(self):
+        """
+        Starts the metrics of a new process. The file is named after the pid and a nonce of the process start,
+        so a process reusing the pid of a dead one never takes over its counters.
+        """
+        self.pid = os.getpid()
+        self.nonce = uuid4().hex[:8]
+        self.series = {}
+        self.flushed = False
+
+    def record(self, labels, duration, queries, query_seconds, render_seconds, size, serialize_seconds):
+        with self.lock:
+            if self.pid != os.getpid():
+                # A forked worker doesn't count the requests of its parent
+                self.start()
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = {
+                    "buckets": [0] * len(BUCKETS),
+                    "count": 0,
+                    "sum": 0,
+                    "counters": [0] * len(COUNTERS)
+                }
+            for index, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    series["buckets"][index] += 1
+            series["count"] += 1
+            series["sum"] += duration
+            for index, value in enumerate((queries, query_seconds, render_seconds, size, serialize_seconds)):
+                series["counters"][index] += value
+        if monotonic() - self.last_flush >= settings.METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes metrics of this process to its file, replacing it atomically so readers never see a partial file.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.start()
+            data = json.dumps([[list(labels), series] for labels, series in self.series.items()])
+            self.last_flush = monotonic()
+            flushed, self.flushed = self.flushed, True
+        directory = Path(settings.METRICS_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{self.pid}-{self.nonce}.json"
+        if not flushed:
+            # Files with the pid of this process were left by a dead process which had the same pid
+            for stale_path in directory.glob(f"{self.pid}-*.json"):
+                stale_path.unlink(missing_ok=True)
+        temporary_path = path.with_suffix(".tmp")
+        temporary_path.write_text(data)
+        os.replace(temporary_path, path)
+
+
+metrics = Metrics()
+
+
+def collect():
+    """
+    Returns the sum of the metrics of live processes.
+    Files of processes which are no longer running, like stopped workers or test runs, are removed.
+    """
+    metrics.flush()
+    totals = {}
+    for path in Path(settings.METRICS_DIR).glob("*.json"):
+        pid = get_file_pid(path)
+        if pid is None:
+            continue
+        if not is_running(pid):
+            path.unlink(missing_ok=True)
+            continue
+        try:
+            process_series = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+        for labels, series in process_series:
+            total = totals.setdefault(tuple(labels), {
+                "buckets": [0] * len(BUCKETS),
+                "count": 0,
+                "sum": 0,
+                "counters": [0] * len(COUNTERS)
+            })
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], series["buckets"])]
+            total["count"] += series["count"]
+            total["sum"] += series["sum"]
+            # Files written before a counter was added have fewer counters
+            total["counters"] = [a + b for a, b in zip_longest(total["counters"], series["counters"], fillvalue=0)]
+    return totals
+
+
+def get_file_pid(path):
+    pid, separator, nonce = path.stem.partition("-")
+    if not pid.isdigit() or not separator or not nonce:
+        return None
+    return int(pid)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
+
+
+def format_labels(labels, **extra):
+    route, method, status = labels
+    pairs = {"route": route, "method": method, "status": status, **extra}
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in pairs.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(pairs, escaped)) + "}"
+
+
+def render_metrics(totals):
+    """
+    Renders metrics in the Prometheus text exposition format.
+    """
+    lines = [
+        "# HELP booking_http_request_duration_seconds Request duration until the response is returned",
+        "# TYPE booking_http_request_duration_seconds histogram"
+    ]
+    for labels, series in sorted(totals.items()):
+        for bound, count in zip(BUCKETS, series["buckets"]):
+            lines.append(f"booking_http_request_duration_seconds_bucket{format_labels(labels, le=bound)} {count}")
+        lines.append(f"booking_http_request_duration_seconds_bucket{format_labels(labels, le='+Inf')} "
+                     f"{series['count']}")
+        lines.append(f"booking_http_request_duration_seconds_sum{format_labels(labels)} {series['sum']}")
+        lines.append(f"booking_http_request_duration_seconds_count{format_labels(labels)} {series['count']}")
+    for index, (name, description) in enumerate(COUNTERS):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, series in sorted(totals.items()):
+            lines.append(f"{name}{format_labels(labels)} {series['counters'][index]}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.db import connection
+from django.utils.crypto import constant_time_compare
+from time import perf_counter
+from .metrics import metrics, serialization_timer, SerializationTimer
+from .profiling import Profiler, save_profile
+import random
+
+
+class QueryTimer:
+
+    """
+    Database execute wrapper counting queries of a request and the time spent in them.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += perf_counter() - start
+
+
+class MetricsMiddleware:
+
+    """
+    Records latency, database queries, serialization and render time and response size of every request per route,
+    see booking.metrics.
+    Latency of streaming responses is measured until the headers are ready and their size isn't recorded.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryTimer()
+        serialization = SerializationTimer()
+        request.render_seconds = 0
+        start = perf_counter()
+        token = serialization_timer.set(serialization)
+        try:
+            with connection.execute_wrapper(queries):
+                response = self.get_response(request)
+        finally:
+            serialization_timer.reset(token)
+        duration = perf_counter() - start
+        resolver_match = getattr(request, "resolver_match", None)
+        route = resolver_match.view_name if resolver_match else "unmatched"
+        size = 0 if response.streaming else len(response.content)
+        metrics.record(
+            (route, request.method, str(response.status_code)),
+            duration, queries.count, queries.seconds, request.render_seconds, size, serialization.seconds
+        )
+        return response
+
+    def process_template_response(self, request, response):
+        start = perf_counter()
+
+        def rendered(response):
+            request.render_seconds = perf_counter() - start
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+class ProfilerMiddleware:
+
+    """
+    Profiles SQL statements of requests sent with the X-Profile header set to PROFILER_TOKEN
+    and of a PROFILER_SAMPLE_RATE fraction of the other requests, see booking.profiling.
+    Requested profiles are always stored and their id is returned in the X-Profile-Id header,
+    sampled ones only when the request took PROFILER_SLOW_REQUEST_SECONDS or longer.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request.META.get("HTTP_X_PROFILE")
+        requested = bool(settings.PROFILER_TOKEN and token and constant_time_compare(token, settings.PROFILER_TOKEN))
+        if not requested and random.random() >= settings.PROFILER_SAMPLE_RATE:
+            return self.get_response(request)
+        profiler = Profiler()
+        start = perf_counter()
+        with connection.execute_wrapper(profiler):
+            response = self.get_response(request)
+        duration = perf_counter() - start
+        if requested or duration >= settings.PROFILER_SLOW_REQUEST_SECONDS:
+            profile = profiler.get_profile(request, response, duration)
+            save_profile(profile)
+            if requested:
+                response['X-Profile-Id'] = profile["id"]
+        return response
@@ -1,18 +1,70 @@
 from django.db import models
 from uuid import uuid4
+from hashlib import sha256
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator
+from django.utils import timezone
 
 User = get_user_model()
 
 
+class AddressManager(models.Manager):
+
+    def intern(self, **fields):
+        """
+        Returns the address with the same normalized content, creating it if there is none.
+        """
+        fields = Address.normalize(fields)
+        address, _ = self.get_or_create(content_hash=Address.get_content_hash(fields), defaults=fields)
+        return address
+
+    def intern_many(self, addresses):
+        """
+        Interns a list of address field dicts with a few queries, returns addresses in the same order.
+        """
+        addresses = [Address.normalize(fields) for fields in addresses]
+        hashes = [Address.get_content_hash(fields) for fields in addresses]
+        existing = self.in_bulk(list(set(hashes)), field_name="content_hash")
+        missing = {
+            content_hash: Address(**fields, content_hash=content_hash)
+            for content_hash, fields in zip(hashes, addresses)
+            if content_hash not in existing
+        }
+        if missing:
+            self.bulk_create(missing.values(), ignore_conflicts=True)
+            # Rows inserted concurrently by others were skipped, their ids differ from the ones built here
+            existing.update(self.in_bulk(list(missing), field_name="content_hash"))
+        return [existing[content_hash] for content_hash in hashes]
+
+
 class Address(models.Model):
+    FIELDS = ("street", "building_number", "post_code", "city", "country")
+
     id = models.UUIDField(primary_key=True, editable=False, default=uuid4)
     street = models.CharField(max_length=32)
     building_number = models.CharField(max_length=10)
     post_code = models.CharField(max_length=6)
     city = models.CharField(max_length=36)
     country = models.CharField(max_length=42)
+    # Addresses are shared by documents with the same content, rows created before interning have no hash
+    content_hash = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+
+    objects = AddressManager()
+
+    @classmethod
+    def normalize(cls, fields):
+        return {name: " ".join(str(fields[name]).split()) for name in cls.FIELDS}
+
+    @classmethod
+    def get_content_hash(cls, fields):
+        return sha256("\x1f".join(fields[name] for name in cls.FIELDS).encode()).hexdigest()
+
+    def save(self, *args, **kwargs):
+        fields = self.normalize({name: getattr(self, name) for name in self.FIELDS})
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.content_hash = self.get_content_hash(fields)
+        super().save(*args, **kwargs)
 
 
 class Company(models.Model):
@@ -23,6 +75,11 @@ class Company(models.Model):
     company_address = models.ForeignKey(Address, on_delete=models.PROTECT, related_name="companies")
     nip_number = models.CharField(max_length=10)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["owner", "name"])
+        ]
+
 
 class Receipt(models.Model):
     id = models.UUIDField(primary_key=True, editable=False, default=uuid4)
@@ -46,6 +103,11 @@ class Receipt(models.Model):
 
     class Meta:
         ordering = ['-date_created']
+        indexes = [
+            models.Index(fields=["company", "date_created", "id"]),
+            models.Index(fields=["company", "print_number"]),
+            models.Index(fields=["company", "receipt_number"])
+        ]
 
 
 class ReceiptProduct(models.Model):
@@ -66,6 +128,18 @@ class ReceiptProduct(models.Model):
         return round(self.quantity * (self.unit_price - self.discount_value), 2)
 
 
+class ReceiptTaxSummary(models.Model):
+    id = models.UUIDField(primary_key=True, editable=False, default=uuid4)
+    receipt = models.ForeignKey(Receipt, on_delete=models.CASCADE, related_name="tax_summaries")
+    vat_type = models.CharField(max_length=1)
+    gross_price = models.DecimalField(max_digits=100, decimal_places=2)
+    tax_value = models.FloatField()
+
+    class Meta:
+        ordering = ['vat_type']
+        unique_together = ("receipt", "vat_type")
+
+
 class Invoice(models.Model):
     id = models.UUIDField(primary_key=True, editable=False, default=uuid4)
     company = models.ForeignKey(Company, on_delete=models.PROTECT)
@@ -86,6 +160,11 @@ class Invoice(models.Model):
 
     class Meta:
         ordering = ['-date_created']
+        indexes = [
+            models.Index(fields=["company", "date_created", "id"]),
+            models.Index(fields=["company", "invoice_number"]),
+            models.Index(fields=["company", "date_finished"])
+        ]
 
 
 class InvoiceProduct(models.Model):
@@ -124,3 +203,100 @@ class InvoicePrepayment(models.Model):
 
     def get_gross_price(self):
         return round(float(self.net_price) + self.get_tax_value(), 2)
+
+
+class InvoiceTaxSummary(models.Model):
+    PRODUCTS = "products"
+    PREPAYMENTS = "prepayments"
+
+    id = models.UUIDField(primary_key=True, editable=False, default=uuid4)
+    invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE, related_name="tax_summaries")
+    kind = models.CharField(max_length=11, choices=[(PRODUCTS, "Products"), (PREPAYMENTS, "Prepayments")])
+    vat_tax = models.DecimalField(max_digits=10, decimal_places=2)
+    net_price = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    tax_value = models.FloatField(default=0)
+    gross_price = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ['kind', 'vat_tax']
+        unique_together = ("invoice", "kind", "vat_tax")
+
+    def get_tax_data(self):
+        return {
+            "total_net_price": self.net_price,
+            "tax_value": self.tax_value,
+            "total_gross_price": self.gross_price
+        }
+
+
+class DocumentSequence(models.Model):
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="sequences")
+    doctype = models.CharField(max_length=10)
+    period = models.CharField(max_length=10)
+    last_value = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("company", "doctype", "period")
+
+
+class ReportJob(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+
+    id = models.UUIDField(primary_key=True, editable=False, default=uuid4)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="report_jobs")
+    doctype = models.CharField(max_length=10)
+    params = models.JSONField(default=dict)
+    params_hash = models.CharField(max_length=64)
+    status = models.CharField(
+        max_length=10,
+        choices=[(PENDING, "Pending"), (RUNNING, "Running"), (FINISHED, "Finished"), (FAILED, "Failed")],
+        default=PENDING
+    )
+    cursor = models.CharField(max_length=200, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    # Set again when a pending job is submitted to the workers again
+    date_queued = models.DateTimeField(default=timezone.now)
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-date_created']
+        indexes = [
+            models.Index(fields=["owner", "params_hash"]),
+            models.Index(fields=["status", "date_finished"])
+        ]
+
+
+class SalesRollup(models.Model):
+    DAY = "day"
+    MONTH = "month"
+    TOTAL = "total"
+
+    id = models.UUIDField(primary_key=True, editable=False, default=uuid4)
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="sales_rollups")
+    doctype = models.CharField(max_length=10)
+    period = models.CharField(max_length=5, choices=[(DAY, "Day"), (MONTH, "Month")])
+    period_start = models.DateField()
+    currency = models.CharField(max_length=10)
+    vat_rate = models.CharField(max_length=10)
+    document_count = models.IntegerField(default=0)
+    net_price = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    total_tax = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    gross_price = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['period_start']
+        unique_together = ("company", "doctype", "period", "period_start", "currency", "vat_rate")
+
+
+class SearchEntry(models.Model):
+    # Integer primary key, full-text indexes refer to entries by rowid
+    id = models.AutoField(primary_key=True)
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="search_entries")
+    receipt = models.ForeignKey(Receipt, on_delete=models.CASCADE, null=True, blank=True, related_name="+")
+    invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE, null=True, blank=True, related_name="+")
+    text = models.CharField(max_length=200)
@@ -0,0 +1,54 @@
+from rest_framework.exceptions import ValidationError
+from rest_framework.negotiation import DefaultContentNegotiation
+from .compression import COMPRESSORS
+
+
+def parse_accept_encoding(header):
+    """
+    Returns the quality of every coding of an Accept-Encoding header.
+    """
+    qualities = {}
+    for item in header.split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+class ReportContentNegotiation(DefaultContentNegotiation):
+
+    """
+    Negotiation of sales reports, which are always csv, so the renderer is used only for errors.
+    format query parameter selects a compressed file (gzip, zstd) or plain csv instead of a renderer,
+    without it the response is compressed with the best encoding of the Accept-Encoding header.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+    def select_encoding(self, request):
+        """
+        Returns the encoding or None and whether it's the file format rather than the content encoding.
+        """
+        file_format = request.query_params.get(self.settings.URL_FORMAT_OVERRIDE)
+        if file_format is not None:
+            if file_format == "csv":
+                return None, False
+            if file_format not in COMPRESSORS:
+                raise ValidationError({"format": [f"Format must be one of: csv, {', '.join(COMPRESSORS)}"]})
+            return file_format, True
+        qualities = parse_accept_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        # max() returns the first of equally accepted encodings, COMPRESSORS are ordered by preference
+        encoding = max(COMPRESSORS, key=lambda name: qualities.get(name, qualities.get("*", 0)))
+        if qualities.get(encoding, qualities.get("*", 0)) <= 0:
+            return None, False
+        return encoding, False
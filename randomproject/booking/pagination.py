@@ -0,0 +1,134 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import F, Q
+from functools import reduce
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, Cursor
+import json
+import operator
+
+
+class DocumentCursorPagination(CursorPagination):
+
+    """
+    Keyset pagination over documents, newest first.
+    The cursor holds the values of every ordering field of the last document of a page, the primary key is added
+    to the requested ordering, so pages start right after it and cost the same at any depth and with any number
+    of equal values, as there is no OFFSET nor COUNT query. Null values are ordered before the others.
+    """
+
+    ordering = ("-date_created", "-id")
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+    def get_ordering(self, request, queryset, view):
+        """
+        Appends the primary key to the ordering requested with the ordering parameter.
+        Documents with equal values are then always in the same order, so pages neither repeat nor skip them.
+        """
+        ordering = tuple(
+            field[:-2] + "id" if field.lstrip("-") == "pk" else field
+            for field in super().get_ordering(request, queryset, view)
+        )
+        if not any(field.lstrip("-") == "id" for field in ordering):
+            ordering += ("-id" if ordering[0].startswith("-") else "id",)
+        return ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        position = self.cursor.position if self.cursor is not None else None
+        nullable = {
+            name: queryset.model._meta.get_field(name).null for name in (field.lstrip("-") for field in self.ordering)
+        }
+        queryset = queryset.order_by(*self.get_order_by(nullable, reverse))
+        if position is not None:
+            if len(position) != len(self.ordering):
+                raise NotFound(self.invalid_cursor_message)
+            try:
+                queryset = queryset.filter(self.get_keyset_filter(nullable, position, reverse))
+            except (DjangoValidationError, ValueError, TypeError):
+                raise NotFound(self.invalid_cursor_message)
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_following = len(results) > self.page_size
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = position is not None, has_following
+        else:
+            self.has_next, self.has_previous = has_following, position is not None
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def get_order_by(self, nullable, reverse):
+        order_by = []
+        for field in self.ordering:
+            name = field.lstrip("-")
+            descending = field.startswith("-") != reverse
+            if not nullable[name]:
+                order_by.append(f"-{name}" if descending else name)
+            elif descending:
+                order_by.append(F(name).desc(nulls_last=True))
+            else:
+                order_by.append(F(name).asc(nulls_first=True))
+        return order_by
+
+    def get_keyset_filter(self, nullable, position, reverse):
+        """
+        Returns the condition of documents following the position in the ordering:
+        (a > x) or (a = x and b > y) or ... for ascending fields, with nulls before the other values.
+        """
+        branches = []
+        equal = Q()
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip("-")
+            descending = field.startswith("-") != reverse
+            if value is None:
+                following = None if descending else Q(**{f"{name}__isnull": False})
+            else:
+                following = Q(**{f"{name}__lt" if descending else f"{name}__gt": value})
+                if descending and nullable[name]:
+                    following |= Q(**{f"{name}__isnull": True})
+            if following is not None:
+                branches.append(equal & following)
+            equal &= Q(**{f"{name}__isnull": True}) if value is None else Q(**{name: value})
+        return reduce(operator.or_, branches) if branches else Q(pk__in=[])
+
+    def get_position(self, document):
+        values = (
+            document[field.lstrip("-")] if isinstance(document, dict) else getattr(document, field.lstrip("-"))
+            for field in self.ordering
+        )
+        return [None if value is None else str(value) for value in values]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        position = self.get_position(self.page[-1]) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self.get_position(self.page[0]) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def encode_cursor(self, cursor):
+        return super().encode_cursor(cursor._replace(position=json.dumps(cursor.position)))
+
+    def decode_cursor(self, request):
+        cursor = super().decode_cursor(request)
+        if cursor is None or cursor.position is None:
+            return cursor
+        try:
+            position = json.loads(cursor.position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor._replace(position=position)
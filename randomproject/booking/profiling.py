@@ -0,0 +1,136 @@
+"""
+Opt-in SQL profiling of single requests, see ProfilerMiddleware.
+A profile holds every statement of a request with its time and the line of the booking module which ran it.
+Statements repeated PROFILER_REPEATED_QUERIES times or more are listed as N+1 suspects.
+Profiles are kept as files in PROFILER_DIR, only the last PROFILER_RING_SIZE of them are kept.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from pathlib import Path
+from time import perf_counter, time_ns
+from uuid import uuid4
+import django
+import json
+import os
+import re
+import traceback
+
+PROFILED_MODULES = ("views.py", "serializers.py", "filters.py", "pagination.py", "caching.py")
+BOOKING_DIR = Path(__file__).resolve().parent
+DJANGO_DIR = Path(django.__file__).resolve().parent
+PROFILE_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def get_location():
+    """
+    Returns the innermost line of a profiled booking module in the current stack,
+    or the innermost line outside of Django when a library (DRF, django-filter) runs the statement.
+    """
+    library_location = None
+    for frame in reversed(traceback.extract_stack()):
+        path = Path(frame.filename)
+        if path.parent == BOOKING_DIR:
+            if path.name in PROFILED_MODULES:
+                return f"booking/{path.name}:{frame.lineno} in {frame.name}"
+        elif library_location is None and DJANGO_DIR not in path.parents:
+            library_location = f"{path.parent.name}/{path.name}:{frame.lineno} in {frame.name}"
+    return library_location
+
+
+class Profiler:
+
+    """
+    Database execute wrapper recording statements with their time and location.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                "sql": sql,
+                "seconds": perf_counter() - start,
+                "location": get_location()
+            })
+
+    def get_repeated(self):
+        statements = defaultdict(lambda: {"count": 0, "seconds": 0, "locations": set()})
+        for query in self.queries:
+            statement = statements[query["sql"]]
+            statement["count"] += 1
+            statement["seconds"] += query["seconds"]
+            if query["location"]:
+                statement["locations"].add(query["location"])
+        return sorted(
+            (
+                {"sql": sql, **statement, "locations": sorted(statement["locations"])}
+                for sql, statement in statements.items()
+                if statement["count"] >= settings.PROFILER_REPEATED_QUERIES
+            ),
+            key=lambda statement: statement["seconds"],
+            reverse=True
+        )
+
+    def get_profile(self, request, response, duration):
+        return {
+            "id": uuid4().hex,
+            "view": request.resolver_match.view_name if request.resolver_match else None,
+            "method": request.method,
+            "path": request.get_full_path(),
+            "status": response.status_code,
+            "started": (timezone.now() - timedelta(seconds=duration)).isoformat(),
+            "seconds": duration,
+            "query_count": len(self.queries),
+            "query_seconds": sum(query["seconds"] for query in self.queries),
+            "repeated": self.get_repeated(),
+            "queries": self.queries
+        }
+
+
+def get_profile_paths():
+    """
+    Returns paths of stored profiles, the newest first.
+    """
+    directory = Path(settings.PROFILER_DIR)
+    if not directory.is_dir():
+        return []
+    return sorted(directory.glob("*.json"), reverse=True)
+
+
+def save_profile(profile):
+    """
+    Stores a profile and removes the oldest ones above PROFILER_RING_SIZE.
+    """
+    directory = Path(settings.PROFILER_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{time_ns():020d}-{profile['id']}.json"
+    temporary_path = path.with_suffix(".tmp")
+    temporary_path.write_text(json.dumps(profile))
+    os.replace(temporary_path, path)
+    for old_path in get_profile_paths()[settings.PROFILER_RING_SIZE:]:
+        try:
+            old_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def load_profile(path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def get_profile(profile_id):
+    if not PROFILE_ID_RE.match(profile_id):
+        return None
+    for path in Path(settings.PROFILER_DIR).glob(f"*-{profile_id}.json"):
+        return load_profile(path)
+    return None
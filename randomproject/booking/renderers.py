@@ -0,0 +1,61 @@
+"""
+Renderers encoding responses faster than DRF's JSONRenderer.
+Decimals which aren't coerced to strings by serializer fields are encoded as floats like DRF's JSONEncoder does,
+other types orjson and msgpack don't encode natively go through JSONEncoder.
+"""
+
+from decimal import Decimal
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+import orjson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+encoder = JSONEncoder()
+
+
+def encode_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return encoder.default(obj)
+
+
+class ORJSONRenderer(BaseRenderer):
+
+    """
+    JSON renderer encoding dicts, lists, strings, numbers, UUIDs and datetimes in orjson.
+    Non-string keys, like the VAT rates of invoice tax data, are converted to strings like json does.
+    Accept header indent parameter indents by 2 spaces.
+    """
+
+    media_type = "application/json"
+    format = "json"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        options = orjson.OPT_NON_STR_KEYS
+        if accepted_media_type and "indent" in accepted_media_type:
+            options |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, default=encode_default, option=options)
+
+
+class MessagePackRenderer(BaseRenderer):
+
+    """
+    MessagePack renderer for internal services, registered when msgpack is installed.
+    """
+
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(data, default=encode_default, use_bin_type=True)
@@ -0,0 +1,180 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from .models import Invoice, Receipt
+from datetime import timedelta
+import csv
+
+REPORTS = {
+    "invoice": {
+        "model": Invoice,
+        "fields": ["Seller", "Buyer", "Marketplace", "Country", "InvoiceId",
+                   "TransactionTime", "MarketplaceCurrency", "NetPrice", "TotalTax", "GrossPrice"],
+        "columns": ["company__name", "buyer_name", "company__website", "company__company_address__country", "id",
+                    "date_finished", "currency", "net_price", "total_tax", "gross_price"]
+    },
+    "receipt": {
+        "model": Receipt,
+        "fields": ["Seller", "ReceiptId", "Country", "TransactionTime",
+                   "MarketplaceCurrency", "TotalTax", "GrossPrice"],
+        "columns": ["company__name", "id", "company__company_address__country", "date_created",
+                    "currency", "total_tax", "gross_price"]
+    }
+}
+
+
+class PseudoBuffer:
+
+    def write(self, value):
+        return value
+
+
+class ReportParamsSerializer(serializers.Serializer):
+
+    """
+    Optional filters of a sales report.
+    cursor is the X-Report-Cursor header of a previous report, only rows created after that report are returned.
+    """
+
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    company = serializers.CharField(max_length=150, required=False)
+    currency = serializers.CharField(max_length=10, required=False)
+    cursor = serializers.CharField(required=False)
+
+    def validate_cursor(self, cursor):
+        try:
+            position = signing.loads(cursor, salt="booking.reports")
+        except signing.BadSignature:
+            raise ValidationError("Invalid cursor")
+        if position["doctype"] != self.context["doctype"]:
+            raise ValidationError("Cursor belongs to another report type")
+        return parse_datetime(position["date_created"]), position["id"]
+
+
+def get_report_params(doctype, query_params):
+    serializer = ReportParamsSerializer(data=query_params, context={"doctype": doctype})
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data
+
+
+def dump_cursor(doctype, date_created, pk):
+    return signing.dumps({"doctype": doctype, "date_created": date_created.isoformat(), "id": str(pk)},
+                         salt="booking.reports")
+
+
+def get_report_queryset(user, doctype, params=None):
+    """
+    Returns documents of the report, oldest first.
+    """
+    params = params or {}
+    queryset = REPORTS[doctype]["model"].objects.filter(company__owner=user)
+    if "company" in params:
+        queryset = queryset.filter(company__name=params["company"])
+    if "currency" in params:
+        queryset = queryset.filter(currency=params["currency"])
+    if "since" in params:
+        queryset = queryset.filter(date_created__gte=params["since"])
+    if "until" in params:
+        queryset = queryset.filter(date_created__lt=params["until"])
+    if "cursor" in params:
+        queryset = created_after(queryset, params["cursor"])
+    return queryset.order_by("date_created", "id")
+
+
+def created_after(queryset, key):
+    date_created, pk = key
+    return queryset.filter(Q(date_created__gt=date_created) | Q(date_created=date_created, id__gt=pk))
+
+
+def get_report_watermark(queryset):
+    """
+    Returns the date and id of the newest document of the report created REPORT_CURSOR_LAG seconds ago or earlier,
+    or None when there is none.
+    date_created is set when a document is saved, not when its transaction commits, so newer documents are left
+    to the next report, otherwise a cursor could pass documents of a transaction which commits later.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.REPORT_CURSOR_LAG)
+    queryset = queryset.filter(date_created__lte=cutoff)
+    return queryset.order_by("-date_created", "-id").values_list("date_created", "id").first()
+
+
+def limit_to_watermark(queryset, watermark):
+    """
+    Returns documents of the report up to the watermark, none when it's None.
+    """
+    if watermark is None:
+        return queryset.none()
+    date_created, pk = watermark
+    return queryset.filter(Q(date_created__lt=date_created) | Q(date_created=date_created, id__lte=pk))
+
+
+def limit_report(queryset, params):
+    """
+    Returns the documents to export and the watermark of the cursor of the next report.
+    Incremental reports, requested with a cursor, end at the watermark, so every document is exported once.
+    Other reports export every document, the newest ones are exported again by the next incremental report.
+    """
+    watermark = get_report_watermark(queryset)
+    if "cursor" in params:
+        queryset = limit_to_watermark(queryset, watermark)
+    return queryset, watermark
+
+
+def report_rows(queryset, doctype, chunk_size=None):
+    """
+    Yields the header and then the report rows, fetched from the database in chunks.
+    Backends with server-side cursors stream the rows, so memory use doesn't depend on the report size.
+    """
+    chunk_size = chunk_size or settings.REPORT_CHUNK_SIZE
+    yield REPORTS[doctype]["fields"]
+    yield from queryset.values_list(*REPORTS[doctype]["columns"]).iterator(chunk_size=chunk_size)
+
+
+def csv_chunks(rows, chunk_size=None):
+    """
+    Encodes rows to csv, joining them into chunks so every chunk is sent with a single write.
+    """
+    chunk_size = chunk_size or settings.REPORT_CHUNK_SIZE
+    writer = csv.writer(PseudoBuffer())
+    chunk = []
+    for row in rows:
+        chunk.append(writer.writerow(row))
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def fetch_report_rows(queryset, doctype, after=None, chunk_size=None):
+    """
+    Returns a chunk of report rows following the (date_created, id) key and the key of its last row.
+    Every chunk is a separate query, so chunks can be fetched by different threads.
+    """
+    chunk_size = chunk_size or settings.REPORT_CHUNK_SIZE
+    if after is not None:
+        queryset = created_after(queryset, after)
+    rows = list(queryset.values_list(*REPORTS[doctype]["columns"], "date_created", "id")[:chunk_size])
+    return [row[:-2] for row in rows], rows[-1][-2:] if rows else None
+
+
+async def async_csv_chunks(queryset, doctype, chunk_size=None):
+    """
+    Async version of csv_chunks(report_rows(...)), holding a thread only while a chunk is fetched.
+    """
+    chunk_size = chunk_size or settings.REPORT_CHUNK_SIZE
+    writer = csv.writer(PseudoBuffer())
+    yield writer.writerow(REPORTS[doctype]["fields"])
+    after = None
+    while True:
+        rows, after = await sync_to_async(fetch_report_rows)(queryset, doctype, after, chunk_size)
+        if rows:
+            yield "".join(writer.writerow(row) for row in rows)
+        if len(rows) < chunk_size:
+            return
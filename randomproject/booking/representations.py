@@ -0,0 +1,221 @@
+"""
+Fast read path of the receipt and invoice lists, building representations from values() rows.
+Accessors are compiled once from the fields of ReceiptSerializer and InvoiceSerializer, so the output is the same
+as theirs without building model instances, nested serializers and resolving fields for every document.
+"""
+
+from collections import defaultdict
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import serializers
+from rest_framework.response import Response
+from randomproject.lru import LRUCache
+from .metrics import measure_serialization
+from .serializers import (
+    ReceiptSerializer, InvoiceSerializer, get_receipt_tax_values, get_invoice_tax_data, get_invoice_prepayments_data
+)
+
+# Number of compiled flat serializers kept in memory of every process
+FLAT_SERIALIZER_CACHE_SIZE = 128
+# Fields which represent a value that isn't None as str(value)
+STR_FIELDS = (serializers.CharField, serializers.EmailField, serializers.RegexField, serializers.SlugField)
+
+
+def make_instance(model, row):
+    """
+    Returns a model instance holding a values() row without running Model.__init__,
+    enough for the methods computing values from fields.
+    """
+    instance = model.__new__(model)
+    instance.__dict__.update(row)
+    return instance
+
+
+def get_column_getter(column, field):
+    if type(field) in STR_FIELDS or (isinstance(field, serializers.UUIDField) and field.uuid_format == "hex_verbose"):
+        to_representation = str
+    else:
+        to_representation = field.to_representation
+
+    def get(row, extra):
+        value = row[column]
+        return None if value is None else to_representation(value)
+
+    return get
+
+
+def represent(getters, row, extra):
+    return {key: getter(row, extra) for key, getter in getters}
+
+
+class FlatSerializer:
+
+    """
+    Builds the representations of serializer_class with the given fields and expand from values() rows.
+    Model fields and nested serializers of foreign keys are read from the row of the document, nested serializers
+    of reverse relations from instances made from rows of the relation. Method fields of serializer_class are
+    implemented here under the same name and get the row and the related instances, which hold the serialized
+    relations and the method_relations of serialized method fields.
+    """
+
+    serializer_class = None
+    # Method field name to the name of the reverse relation it reads
+    method_relations = {}
+
+    def __init__(self, fields=None, expand=None):
+        serializer = self.serializer_class()
+        serializer.select_fields(fields, expand)
+        self.model = serializer.Meta.model
+        # Own columns of documents are always read, the cursor pagination and method fields may need them
+        self.columns = ["pk", *(field.attname for field in self.model._meta.concrete_fields)]
+        self.relations = {}
+        self.getters = self.compile(serializer, "")
+
+    def add_column(self, column):
+        if column not in self.columns:
+            self.columns.append(column)
+
+    def add_relation(self, name):
+        relation = self.model._meta.get_field(name)
+        self.relations[name] = relation.related_model, relation.field.attname
+
+    def compile(self, serializer, prefix):
+        getters = []
+        for key, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.ListSerializer) and not prefix:
+                getters.append((key, self.compile_relation(field)))
+            elif isinstance(field, serializers.SerializerMethodField) and not prefix:
+                getters.append((key, self.compile_method(field)))
+            elif isinstance(field, serializers.BaseSerializer) and not isinstance(field, serializers.ListSerializer):
+                getters.append((key, self.compile_nested(field, prefix)))
+            elif isinstance(field, (serializers.ListSerializer, serializers.SerializerMethodField,
+                                    serializers.RelatedField, serializers.ManyRelatedField)):
+                raise ImproperlyConfigured(f"{type(field).__name__} {prefix}{key} can't be read from rows")
+            else:
+                column = prefix + field.source
+                self.add_column(column)
+                getters.append((key, get_column_getter(column, field)))
+        return getters
+
+    def compile_nested(self, serializer, prefix):
+        key_column = prefix + serializer.parent.Meta.model._meta.get_field(serializer.source).attname
+        self.add_column(key_column)
+        getters = self.compile(serializer, f"{prefix}{serializer.source}__")
+
+        def get(row, related):
+            return None if row[key_column] is None else represent(getters, row, related)
+
+        return get
+
+    def compile_relation(self, serializer):
+        name = serializer.source
+        self.add_relation(name)
+        getters = []
+        for key, field in serializer.child.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.SerializerMethodField):
+                method = getattr(serializer.child, field.method_name)
+                getters.append((key, lambda row, instance, method=method: method(instance)))
+            elif isinstance(field, (serializers.BaseSerializer, serializers.RelatedField)):
+                raise ImproperlyConfigured(f"{type(field).__name__} {name}.{key} can't be read from rows")
+            else:
+                getters.append((key, get_column_getter(field.source, field)))
+
+        def get(row, related):
+            return [represent(getters, instance.__dict__, instance) for instance in related[name]]
+
+        return get
+
+    def compile_method(self, field):
+        method = getattr(self, field.method_name)
+        if field.field_name in self.method_relations:
+            self.add_relation(self.method_relations[field.field_name])
+
+        def get(row, related):
+            return method(row, related)
+
+        return get
+
+    def get_queryset(self, queryset):
+        """
+        Returns the queryset of document rows, which are passed to to_representation.
+        """
+        return queryset.prefetch_related(None).values(*self.columns)
+
+    def get_related(self, rows):
+        """
+        Returns instances of the relations as relation name to document pk to a list of instances.
+        """
+        pks = [row["pk"] for row in rows]
+        related = {}
+        for name, (model, foreign_key) in self.relations.items():
+            columns = [field.attname for field in model._meta.concrete_fields]
+            instances = defaultdict(list)
+            if pks:
+                for row in model.objects.filter(**{f"{foreign_key}__in": pks}).values(*columns):
+                    instances[row[foreign_key]].append(make_instance(model, row))
+            related[name] = instances
+        return related
+
+    def to_representation(self, rows):
+        with measure_serialization():
+            related = self.get_related(rows)
+            return [
+                represent(
+                    self.getters, row, {name: instances.get(row["pk"], ()) for name, instances in related.items()}
+                )
+                for row in rows
+            ]
+
+
+class FlatReceiptSerializer(FlatSerializer):
+
+    serializer_class = ReceiptSerializer
+    method_relations = {"tax_values": "tax_summaries"}
+
+    def get_tax_values(self, row, related):
+        return get_receipt_tax_values(related["tax_summaries"])
+
+
+class FlatInvoiceSerializer(FlatSerializer):
+
+    serializer_class = InvoiceSerializer
+    method_relations = {"tax_data": "tax_summaries", "prepayments_data": "tax_summaries"}
+
+    def get_tax_data(self, row, related):
+        return get_invoice_tax_data(related["tax_summaries"])
+
+    def get_prepayments_data(self, row, related):
+        if not row["is_prepayment"]:
+            return None
+        return get_invoice_prepayments_data(related["tax_summaries"])
+
+
+class FlatListModelMixin:
+
+    """
+    Lists documents with flat_serializer_class instead of the serializer.
+    Flat serializers are compiled once for every combination of fields and expand query parameters.
+    """
+
+    flat_serializer_class = None
+    flat_serializers = LRUCache(FLAT_SERIALIZER_CACHE_SIZE)
+
+    def get_flat_serializer(self):
+        params = self.flat_serializer_class.serializer_class.get_sparse_params(self.request.query_params)
+        key = (self.flat_serializer_class, *params)
+        flat_serializer = self.flat_serializers.get(key)
+        if flat_serializer is None:
+            flat_serializer = self.flat_serializer_class(*params)
+            self.flat_serializers.set(key, flat_serializer)
+        return flat_serializer
+
+    def list(self, request, *args, **kwargs):
+        flat_serializer = self.get_flat_serializer()
+        queryset = flat_serializer.get_queryset(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(flat_serializer.to_representation(page))
+        return Response(flat_serializer.to_representation(queryset))
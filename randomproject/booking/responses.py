@@ -0,0 +1,67 @@
+from django.http import HttpResponse, StreamingHttpResponse
+import os
+import re
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+
+    """
+    Streaming response which also carries an async iterator of its content.
+    booking.asgi.ASGIHandler sends the async content, WSGI servers iterate the sync one.
+    """
+
+    def __init__(self, streaming_content, async_streaming_content, *args, **kwargs):
+        super().__init__(streaming_content, *args, **kwargs)
+        self.async_streaming_content = async_streaming_content
+
+
+def read_file(path, start, length, block_size=64 * 1024):
+    with open(path, "rb") as file:
+        file.seek(start)
+        while length > 0:
+            block = file.read(min(block_size, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def ranged_file_response(request, path, content_type, filename, etag):
+    """
+    Serves a file supporting single byte range requests, so interrupted downloads can be resumed.
+    Multiple ranges aren't supported, the whole file is served for them like for servers ignoring Range.
+    """
+    size = os.path.getsize(path)
+    start, end = 0, size - 1
+    status = 200
+    range_header = request.META.get("HTTP_RANGE")
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if range_header and "," not in range_header and (if_range is None or if_range == etag):
+        match = RANGE_RE.match(range_header.strip())
+        if match is None or match.groups() == ("", ""):
+            return range_not_satisfiable(size)
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start = max(size - int(last), 0)
+        if start > end or start >= size:
+            return range_not_satisfiable(size)
+        status = 206
+    response = StreamingHttpResponse(read_file(path, start, end - start + 1), content_type=content_type, status=status)
+    response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = "bytes"
+    response['ETag'] = etag
+    response['Content-Disposition'] = f"attachment; filename={filename}"
+    if status == 206:
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+    return response
+
+
+def range_not_satisfiable(size):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f"bytes */{size}"
+    return response
@@ -0,0 +1,107 @@
+"""
+Sales rollups hold totals per company, document type, day or month, currency and VAT rate.
+Rows with vat_rate "total" hold totals of whole documents, the other rows totals of document lines with that rate.
+"""
+
+from collections import defaultdict
+from decimal import Decimal
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from .models import SalesRollup, InvoiceTaxSummary
+
+
+def to_decimal(value):
+    return Decimal(str(round(value, 2)))
+
+
+def receipt_contributions(receipt, tax_summaries):
+    """
+    Returns (dimensions, values) pairs a receipt adds to the rollups.
+    """
+    dimensions = ("receipt", receipt.company_id, receipt.currency, timezone.localtime(receipt.date_created).date())
+    contributions = [(
+        (*dimensions, SalesRollup.TOTAL),
+        (1, to_decimal(receipt.gross_price) - to_decimal(receipt.total_tax), to_decimal(receipt.total_tax),
+         to_decimal(receipt.gross_price))
+    )]
+    for summary in tax_summaries:
+        tax_value = to_decimal(summary.tax_value)
+        contributions.append((
+            (*dimensions, summary.vat_type),
+            (1, to_decimal(summary.gross_price) - tax_value, tax_value, to_decimal(summary.gross_price))
+        ))
+    return contributions
+
+
+def invoice_contributions(invoice, tax_summaries):
+    """
+    Returns (dimensions, values) pairs an invoice adds to the rollups.
+    """
+    dimensions = ("invoice", invoice.company_id, invoice.currency, timezone.localtime(invoice.date_created).date())
+    contributions = [(
+        (*dimensions, SalesRollup.TOTAL),
+        (1, to_decimal(invoice.net_price), to_decimal(invoice.total_tax), to_decimal(invoice.gross_price))
+    )]
+    for summary in tax_summaries:
+        if summary.kind != InvoiceTaxSummary.PRODUCTS:
+            continue
+        contributions.append((
+            (*dimensions, format(Decimal(summary.vat_tax).normalize(), "f")),
+            (1, summary.net_price, to_decimal(summary.tax_value), to_decimal(summary.gross_price))
+        ))
+    return contributions
+
+
+def aggregate_contributions(contributions, sign=1):
+    """
+    Sums contributions into day and month rollup values keyed by rollup fields.
+    """
+    totals = defaultdict(lambda: [0, 0, 0, 0])
+    for (doctype, company_id, currency, day, vat_rate), values in contributions:
+        for period, period_start in ((SalesRollup.DAY, day), (SalesRollup.MONTH, day.replace(day=1))):
+            key = (company_id, doctype, period, period_start, currency, vat_rate)
+            total = totals[key]
+            for index, value in enumerate(values):
+                total[index] += value * sign
+    return totals
+
+
+def rollup_key_to_fields(key):
+    company_id, doctype, period, period_start, currency, vat_rate = key
+    return {
+        "company_id": company_id,
+        "doctype": doctype,
+        "period": period,
+        "period_start": period_start,
+        "currency": currency,
+        "vat_rate": vat_rate
+    }
+
+
+def apply_contributions(contributions, sign=1):
+    """
+    Adds (or subtracts with sign=-1) contributions to the stored rollups, one UPDATE per rollup row.
+    """
+    totals = aggregate_contributions(contributions, sign)
+    for key, (document_count, net_price, total_tax, gross_price) in totals.items():
+        rollup = SalesRollup.objects.filter(**rollup_key_to_fields(key))
+        changes = {
+            "document_count": F("document_count") + document_count,
+            "net_price": F("net_price") + net_price,
+            "total_tax": F("total_tax") + total_tax,
+            "gross_price": F("gross_price") + gross_price
+        }
+        if rollup.update(**changes):
+            continue
+        try:
+            with transaction.atomic():
+                SalesRollup.objects.create(
+                    **rollup_key_to_fields(key),
+                    document_count=document_count,
+                    net_price=net_price,
+                    total_tax=total_tax,
+                    gross_price=gross_price
+                )
+        except IntegrityError:
+            rollup.update(**changes)
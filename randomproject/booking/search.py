@@ -0,0 +1,107 @@
+"""
+Full-text search over receipt headers, invoice buyer names and product names.
+Every searchable text of a document is stored as a SearchEntry row, which the database indexes:
+an FTS5 table kept in sync by triggers on SQLite, a GIN index on PostgreSQL.
+Other backends fall back to case-insensitive substring search.
+"""
+
+from django.db import connections
+from django.db.models.expressions import RawSQL
+from .models import SearchEntry
+
+FTS_TABLE = "booking_searchentry_fts"
+
+SQLITE_SCHEMA = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"text, content='booking_searchentry', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON booking_searchentry BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, text) VALUES (new.id, new.text); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON booking_searchentry BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text) VALUES ('delete', old.id, old.text); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE ON booking_searchentry BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text) VALUES ('delete', old.id, old.text); "
+    f"INSERT INTO {FTS_TABLE}(rowid, text) VALUES (new.id, new.text); END"
+]
+
+POSTGRESQL_SCHEMA = [
+    "CREATE INDEX IF NOT EXISTS booking_searchentry_text_gin "
+    "ON booking_searchentry USING gin (to_tsvector('simple', text))"
+]
+
+
+def create_search_index(using="default", **kwargs):
+    """
+    Creates the full-text index, connected to post_migrate since the index is not a Django model.
+    """
+    connection = connections[using]
+    schema = {"sqlite": SQLITE_SCHEMA, "postgresql": POSTGRESQL_SCHEMA}.get(connection.vendor, [])
+    with connection.cursor() as cursor:
+        for statement in schema:
+            cursor.execute(statement)
+
+
+def rebuild_search_index(using="default"):
+    connection = connections[using]
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def receipt_search_entries(receipt, products):
+    texts = {receipt.header} | {product.name for product in products}
+    return [
+        SearchEntry(company_id=receipt.company_id, receipt=receipt, text=text)
+        for text in sorted(texts - {None, ""})
+    ]
+
+
+def invoice_search_entries(invoice, products):
+    texts = {invoice.buyer_name} | {product.name for product in products}
+    return [
+        SearchEntry(company_id=invoice.company_id, invoice=invoice, text=text)
+        for text in sorted(texts - {None, ""})
+    ]
+
+
+def to_match_query(query):
+    """
+    Turns user input into an FTS5 query matching entries which contain every word, the last one as a prefix.
+    """
+    words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+    if words:
+        words[-1] += "*"
+    return " ".join(words)
+
+
+def matching_entries(queryset, query, ranked=False):
+    """
+    Filters SearchEntry queryset to entries matching query, with ranked=True ordered from the best match.
+    """
+    vendor = connections[queryset.db].vendor
+    if vendor == "sqlite" and ranked:
+        queryset = queryset.extra(
+            tables=[FTS_TABLE],
+            where=[f"{FTS_TABLE}.rowid = booking_searchentry.id", f"{FTS_TABLE} MATCH %s"],
+            params=[to_match_query(query)]
+        )
+        rank = f"{FTS_TABLE}.rank"
+        rank_params = []
+    elif vendor == "sqlite":
+        # Unranked entries are used in subqueries, where the join above would lose its table name
+        queryset = queryset.filter(
+            id__in=RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [to_match_query(query)])
+        )
+    elif vendor == "postgresql":
+        queryset = queryset.extra(
+            where=["to_tsvector('simple', text) @@ plainto_tsquery('simple', %s)"],
+            params=[query]
+        )
+        rank = "-ts_rank(to_tsvector('simple', text), plainto_tsquery('simple', %s))"
+        rank_params = [query]
+    else:
+        queryset = queryset.filter(text__icontains=query)
+        rank = "0"
+        rank_params = []
+    if ranked:
+        queryset = queryset.extra(select={"rank": rank}, select_params=rank_params, order_by=["rank"])
+    return queryset
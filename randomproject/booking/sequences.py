@@ -0,0 +1,101 @@
+from django.db import transaction, IntegrityError
+from django.db.models import F, Max
+from collections import Counter
+from django.utils import timezone
+from .models import DocumentSequence, Receipt, Invoice
+
+RECEIPT = "receipt"
+INVOICE = "invoice"
+# Numbers documents are inserted with, they are replaced before the transaction commits
+UNNUMBERED_RECEIPT = 0
+UNNUMBERED_INVOICE = ""
+
+
+def reserve(company, doctype, period, count=1, initial=None):
+    """
+    Atomically reserves `count` consecutive numbers of a company sequence and returns the first one.
+    `initial` is called to seed a sequence which doesn't exist yet with the last number already in use.
+    The sequence row stays locked until the surrounding transaction ends, so numbers are never handed out twice
+    and a rolled back transaction leaves no gap. Documents are numbered by number_receipts and number_invoices
+    after they are inserted, so the lock is held only by the last statements of the transaction.
+    """
+    sequence = DocumentSequence.objects.filter(company=company, doctype=doctype, period=period)
+    with transaction.atomic():
+        if not sequence.update(last_value=F("last_value") + count):
+            try:
+                with transaction.atomic():
+                    DocumentSequence.objects.create(
+                        company=company,
+                        doctype=doctype,
+                        period=period,
+                        last_value=(initial() if initial is not None else 0) + count
+                    )
+            except IntegrityError:
+                sequence.update(last_value=F("last_value") + count)
+        last_value = sequence.values_list("last_value", flat=True).get()
+    return last_value - count + 1
+
+
+def receipt_period(day):
+    return day.isoformat()
+
+
+def invoice_period(now):
+    return f"{now.year}/{now.month}"
+
+
+def reserve_print_numbers(company, count=1):
+    day = timezone.localdate()
+
+    def last_print_number():
+        return Receipt.objects.filter(company=company, date_created__date=day)\
+            .aggregate(last=Max("print_number"))['last'] or 0
+
+    return reserve(company, RECEIPT, receipt_period(day), count, initial=last_print_number)
+
+
+def reserve_invoice_numbers(company, now, count=1):
+    """
+    Returns the invoice numbers reserved for a company in the month of `now`.
+    """
+
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    def last_invoice_count():
+        last_invoice = Invoice.objects.filter(company=company, date_created__gte=month_start)\
+            .exclude(invoice_number=UNNUMBERED_INVOICE).order_by("-date_created").first()
+        if last_invoice is None:
+            return 0
+        return int(last_invoice.invoice_number.split("/")[-1])
+
+    first = reserve(company, INVOICE, invoice_period(now), count, initial=last_invoice_count)
+    return [f"FV/{now.year}/{now.month}/{number}" for number in range(first, first + count)]
+
+
+def number_receipts(receipts):
+    """
+    Sets print and receipt numbers of inserted receipts, reserving the numbers of every company at once.
+    Callers save the numbers, which should be the last writes of the transaction.
+    """
+    companies = {receipt.company_id: receipt.company for receipt in receipts}
+    numbers = {
+        company_id: reserve_print_numbers(companies[company_id], count)
+        for company_id, count in Counter(receipt.company_id for receipt in receipts).items()
+    }
+    for receipt in receipts:
+        receipt.print_number = receipt.receipt_number = numbers[receipt.company_id]
+        numbers[receipt.company_id] += 1
+
+
+def number_invoices(invoices, now):
+    """
+    Sets invoice numbers of inserted invoices, reserving the numbers of every company at once.
+    Callers save the numbers, which should be the last writes of the transaction.
+    """
+    companies = {invoice.company_id: invoice.company for invoice in invoices}
+    numbers = {
+        company_id: iter(reserve_invoice_numbers(companies[company_id], now, count))
+        for company_id, count in Counter(invoice.company_id for invoice in invoices).items()
+    }
+    for invoice in invoices:
+        invoice.invoice_number = next(numbers[invoice.company_id])
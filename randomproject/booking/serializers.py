@@ -1,18 +1,177 @@
+from django.conf import settings
 from django.db import transaction
-from django.shortcuts import get_object_or_404
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError, NotFound
-from .models import ReceiptProduct, Address, Receipt, Company, InvoiceProduct, Invoice, InvoicePrepayment
+from rest_framework.permissions import SAFE_METHODS
+from .models import (
+    ReceiptProduct, Address, Receipt, Company, InvoiceProduct, Invoice, InvoicePrepayment, ReceiptTaxSummary,
+    InvoiceTaxSummary, ReportJob, SalesRollup, SearchEntry
+)
+from .sequences import number_receipts, number_invoices, UNNUMBERED_RECEIPT, UNNUMBERED_INVOICE
+from .rollups import apply_contributions, receipt_contributions, invoice_contributions
+from .caching import bump_company_version, get_company, get_companies, forget_company
+from .search import receipt_search_entries, invoice_search_entries
 from collections import defaultdict
 from django.utils import timezone
 import re
 
+VAT_TYPES = {"A": 0.23, "B": 0.08, "C": 0.05, "D": 0.00, "E": 1}
+
+
+def calculate_tax_values(products):
+    tax_values = defaultdict(float)
+    for product in products:
+        if product.vat_type == "E":
+            continue
+        full_price = product.get_full_price()
+        tax_value = round(float(full_price) - float(full_price) / (VAT_TYPES[product.vat_type]+1), 2)
+        tax_values[product.vat_type] += tax_value
+    return tax_values
+
+
+def build_receipt_tax_summaries(receipt, products):
+    gross_prices = defaultdict(int)
+    for product in products:
+        gross_prices[product.vat_type] += product.get_full_price()
+    tax_values = calculate_tax_values(products)
+    return [
+        ReceiptTaxSummary(
+            receipt=receipt,
+            vat_type=vat_type,
+            gross_price=gross_price,
+            tax_value=tax_values.get(vat_type, 0)
+        )
+        for vat_type, gross_price in gross_prices.items()
+    ]
+
+
+def build_invoice_tax_summaries(invoice, products, prepayments):
+    summaries = {}
+
+    def get_summary(kind, vat_tax):
+        if (kind, vat_tax) not in summaries:
+            summaries[kind, vat_tax] = InvoiceTaxSummary(invoice=invoice, kind=kind, vat_tax=vat_tax)
+        return summaries[kind, vat_tax]
+
+    for product in products:
+        summary = get_summary(InvoiceTaxSummary.PRODUCTS, product.vat_tax)
+        summary.net_price += product.get_net_price()
+        summary.tax_value += product.get_vat_tax()
+        summary.gross_price += product.get_gross_price()
+    for prepayment in prepayments:
+        summary = get_summary(InvoiceTaxSummary.PREPAYMENTS, prepayment.vat_tax)
+        summary.net_price += prepayment.net_price
+        summary.tax_value += prepayment.get_tax_value()
+        summary.gross_price += prepayment.get_gross_price()
+    return list(summaries.values())
+
+
+def get_receipt_tax_values(tax_summaries):
+    return {summary.vat_type: summary.tax_value for summary in tax_summaries if summary.vat_type != "E"}
+
+
+def get_invoice_tax_data(tax_summaries):
+    tax_data = {
+        "total_net_price": 0,
+        "total_tax_value": 0
+    }
+    for summary in tax_summaries:
+        if summary.kind != InvoiceTaxSummary.PRODUCTS:
+            continue
+        tax_data['total_net_price'] += summary.net_price
+        tax_data['total_tax_value'] += summary.tax_value
+        tax_data[float(summary.vat_tax)] = summary.get_tax_data()
+    return tax_data
+
+
+def get_invoice_prepayments_data(tax_summaries):
+    prepayments_data = {
+        "total_net_price": 0,
+        "total_tax_value": 0,
+        "total_gross_price": 0
+    }
+    for summary in tax_summaries:
+        if summary.kind != InvoiceTaxSummary.PREPAYMENTS:
+            continue
+        prepayments_data['total_net_price'] += summary.net_price
+        prepayments_data['total_tax_value'] += summary.tax_value
+        prepayments_data['total_gross_price'] += summary.gross_price
+        prepayments_data[float(summary.vat_tax)] = summary.get_tax_data()
+    return prepayments_data
+
+
+class SparseFieldsMixin:
+
+    """
+    Lets GET requests pick the fields of documents with the fields query parameter and the embedded relations
+    with expand, both comma separated. Every relation is embedded when expand isn't given. Foreign keys which
+    aren't expanded are represented by their primary key, the other relations and fields computed from them
+    are left out. optimize_queryset joins and prefetches only the relations which are serialized.
+    """
+
+    # Expandable foreign key name to its select_related path
+    expandable_related = {}
+    # Expandable field name to prefetch_related lookups it needs
+    expandable_prefetched = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request is not None and request.method in SAFE_METHODS:
+            self.select_fields(*self.get_sparse_params(request.query_params))
+
+    @staticmethod
+    def get_sparse_params(query_params):
+        """
+        Returns (fields, expand) query parameters as frozensets of names, None when they aren't given.
+        """
+        return tuple(
+            frozenset(name.strip() for name in query_params[param].split(",") if name.strip())
+            if param in query_params else None
+            for param in ("fields", "expand")
+        )
+
+    def select_fields(self, fields, expand):
+        readable = [name for name, field in self.fields.items() if not field.write_only]
+        expandable = {*self.expandable_related, *self.expandable_prefetched}
+        errors = {}
+        if fields is not None and not fields:
+            errors["fields"] = ["Select at least one field"]
+        elif fields is not None and not fields <= set(readable):
+            errors["fields"] = [f"Unknown fields: {', '.join(sorted(fields - set(readable)))}"]
+        if expand is not None and not expand <= expandable:
+            errors["expand"] = [f"Relations which can be expanded: {', '.join(sorted(expandable))}"]
+        if errors:
+            raise ValidationError(errors)
+        for name in readable:
+            if fields is not None and name not in fields:
+                del self.fields[name]
+            elif expand is not None and name in expandable and name not in expand:
+                if name in self.expandable_related:
+                    self.fields[name] = serializers.UUIDField(source=f"{name}_id", read_only=True)
+                else:
+                    del self.fields[name]
+
+    @classmethod
+    def optimize_queryset(cls, queryset, fields=None, expand=None):
+        def is_serialized(name):
+            return (fields is None or name in fields) and (expand is None or name in expand)
+
+        related = [path for name, path in cls.expandable_related.items() if is_serialized(name)]
+        if related:
+            queryset = queryset.select_related(*related)
+        return queryset.prefetch_related(*sorted({
+            lookup
+            for name, lookups in cls.expandable_prefetched.items() if is_serialized(name)
+            for lookup in lookups
+        }))
+
 
 class AddressSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Address
-        exclude = ("id",)
+        exclude = ("id", "content_hash")
 
     def validate_postCode(self, post_code):
         if not re.match(r"\d{2}-\d{3}", post_code):
@@ -32,21 +191,23 @@ class CompanySerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         user = self.context['request'].user
         address = validated_data.pop("company_address")
-        company_address = Address.objects.create(**address)
+        company_address = Address.objects.intern(**address)
         company = Company.objects.create(**validated_data, owner=user, company_address=company_address)
         return company
 
     def update(self, instance, validated_data):
         address = validated_data.pop("company_address", None)
+        name = instance.name
         with transaction.atomic():
             if address is not None:
-                company_address = instance.company_address
-                for name, value in address.items():
-                    setattr(company_address, name, value)
-                company_address.save()
+                # Addresses are shared, so a changed address is interned instead of edited in place
+                current_address = {name: getattr(instance.company_address, name) for name in Address.FIELDS}
+                instance.company_address = Address.objects.intern(**{**current_address, **address})
             for name, value in validated_data.items():
                 setattr(instance, name, value)
             instance.save()
+        bump_company_version(instance.pk)
+        forget_company(instance.owner_id, name)
         return instance
 
     class Meta:
@@ -80,7 +241,73 @@ class ReceiptProductSerializer(serializers.ModelSerializer):
         exclude = ("id", "receipt")
 
 
-class ReceiptSerializer(serializers.ModelSerializer):
+class ReceiptListSerializer(serializers.ListSerializer):
+
+    def to_internal_value(self, data):
+        validated_data = super().to_internal_value(data)
+        user = self.context['request'].user
+        company_names = {item["company_name"] for item in validated_data}
+        self.companies = get_companies(user, company_names)
+        errors = []
+        for item in validated_data:
+            if item["company_name"] in self.companies:
+                errors.append({})
+            else:
+                errors.append({"company_name": [f"No company named {item['company_name']}"]})
+        if any(errors):
+            raise ValidationError(errors)
+        return validated_data
+
+    def create(self, validated_data):
+        batch_size = settings.BULK_BATCH_SIZE
+        receipts = []
+        receipt_products = []
+        tax_summaries = []
+        search_entries = []
+        with transaction.atomic():
+            sales_points = iter(Address.objects.intern_many(
+                [item["sales_point"] for item in validated_data if item.get("sales_point") is not None]
+            ))
+            for item in validated_data:
+                products = item.pop("products")
+                company_name = item.pop("company_name")
+                sales_point = item.pop("sales_point", None)
+                receipt = Receipt(
+                    **item,
+                    company=self.companies[company_name],
+                    print_number=UNNUMBERED_RECEIPT,
+                    receipt_number=UNNUMBERED_RECEIPT
+                )
+                if sales_point is not None:
+                    receipt.sales_point = next(sales_points)
+                products = [ReceiptProduct(**product, receipt=receipt) for product in products]
+                receipt.gross_price = sum(product.get_full_price() for product in products)
+                receipt.total_tax = round(sum(calculate_tax_values(products).values()), 2)
+                receipts.append(receipt)
+                receipt_products.extend(products)
+                tax_summaries.append(build_receipt_tax_summaries(receipt, products))
+                search_entries.extend(receipt_search_entries(receipt, products))
+            Receipt.objects.bulk_create(receipts, batch_size=batch_size)
+            ReceiptProduct.objects.bulk_create(receipt_products, batch_size=batch_size)
+            ReceiptTaxSummary.objects.bulk_create(
+                [summary for summaries in tax_summaries for summary in summaries],
+                batch_size=batch_size
+            )
+            SearchEntry.objects.bulk_create(search_entries, batch_size=batch_size)
+            apply_contributions(
+                contribution
+                for receipt, summaries in zip(receipts, tax_summaries)
+                for contribution in receipt_contributions(receipt, summaries)
+            )
+            number_receipts(receipts)
+            Receipt.objects.bulk_update(receipts, ["print_number", "receipt_number"], batch_size=batch_size)
+        return receipts
+
+
+class ReceiptSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+
+    expandable_related = {"company": "company__company_address", "sales_point": "sales_point"}
+    expandable_prefetched = {"products": ["products"], "tax_values": ["tax_summaries"]}
 
     company = CompanySerializer(read_only=True)
     company_name = serializers.CharField(max_length=150, write_only=True)
@@ -99,61 +326,45 @@ class ReceiptSerializer(serializers.ModelSerializer):
         company_name = validated_data.pop("company_name")
         sales_point = validated_data.pop("sales_point", None)
         with transaction.atomic():
-            last_receipt = Receipt.objects.filter(company__name=company_name).order_by("-print_number").first()
-            print_number = 1
-            if last_receipt is not None:
-                now = timezone.now()
-                date_created = last_receipt.date_created
-                if not now.today().date() != date_created.date():
-                    print_number = last_receipt.print_number + 1
-            company = get_object_or_404(Company, name=company_name)
+            company = get_company(self.context['request'].user, company_name)
             receipt = Receipt.objects.create(
                 **validated_data,
                 company=company,
-                print_number=print_number,
-                receipt_number=print_number
+                print_number=UNNUMBERED_RECEIPT,
+                receipt_number=UNNUMBERED_RECEIPT
             )
             if sales_point is not None:
-                sales_point_address = Address.objects.create(**sales_point)
+                sales_point_address = Address.objects.intern(**sales_point)
                 receipt.sales_point = sales_point_address
-            gross_price = 0
-            for product in products:
-                product_model = ReceiptProduct.objects.create(**product, receipt=receipt)
-                gross_price += product_model.get_full_price()
-            receipt.gross_price = gross_price
-            total_tax = self.get_total_tax(receipt)
-            receipt.total_tax = total_tax
+            products = ReceiptProduct.objects.bulk_create(
+                ReceiptProduct(**product, receipt=receipt) for product in products
+            )
+            tax_summaries = ReceiptTaxSummary.objects.bulk_create(build_receipt_tax_summaries(receipt, products))
+            SearchEntry.objects.bulk_create(receipt_search_entries(receipt, products))
+            receipt.gross_price = sum(product.get_full_price() for product in products)
+            receipt.total_tax = round(sum(calculate_tax_values(products).values()), 2)
+            apply_contributions(receipt_contributions(receipt, tax_summaries))
+            number_receipts([receipt])
             receipt.save()
         return receipt
 
-    def get_total_price(self, receipt):
-        total_price = 0
-        for product in receipt.products.all():
-            total_price += product.get_full_price()
-        return total_price
-
     def get_tax_values(self, receipt):
-        vat_types = {"A": 0.23, "B": 0.08, "C": 0.05, "D": 0.00, "E": 1}
-        tax_values = defaultdict(float)
-        for product in receipt.products.all():
-            if product.vat_type == "E":
-                continue
-            full_price = product.get_full_price()
-            tax_value = round(float(full_price) - float(full_price) / (vat_types[product.vat_type]+1), 2)
-            tax_values[product.vat_type] += tax_value
-        return tax_values
-
-    def get_total_tax(self, receipt):
-        tax_values = self.get_tax_values(receipt)
-        if "E" in tax_values:
-            del tax_values["E"]
-        return round(sum(tax_values.values()), 2)
+        return get_receipt_tax_values(receipt.tax_summaries.all())
 
     class Meta:
         model = Receipt
         fields = "__all__"
         ref_name = None
         read_only_fields = ("total_tax", "gross_price")
+        list_serializer_class = ReceiptListSerializer
+
+
+class ReceiptSummarySerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Receipt
+        fields = ("id", "print_number", "receipt_number", "date_created", "total_tax", "gross_price")
+        ref_name = None
 
 
 class InvoiceProductSerializer(serializers.ModelSerializer):
@@ -188,7 +399,15 @@ class InvoicePrepaymentSerializer(serializers.ModelSerializer):
         exclude = ("id", "invoice")
 
 
-class InvoiceSerializer(serializers.ModelSerializer):
+class InvoiceSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+
+    expandable_related = {"company": "company__company_address", "buyer_address": "buyer_address"}
+    expandable_prefetched = {
+        "products": ["products"],
+        "prepayments": ["prepayments"],
+        "tax_data": ["tax_summaries"],
+        "prepayments_data": ["tax_summaries"]
+    }
 
     products = InvoiceProductSerializer(many=True)
     company = CompanySerializer(read_only=True)
@@ -207,27 +426,19 @@ class InvoiceSerializer(serializers.ModelSerializer):
         previous_prepayment = validated_data.pop("previous_prepayment", None)
         is_prepayment = validated_data.get("is_prepayment")
         with transaction.atomic():
-            buyer_address = Address.objects.create(**buyer_address)
-            company = get_object_or_404(Company, name=company_name, owner=user)
-            now = timezone.now()
-            last_invoice = Invoice.objects.filter(company=company).order_by("-date_created").first()
-            invoice_count = 1
-            if last_invoice is not None:
-                year = last_invoice.date_created.year
-                month = last_invoice.date_created.month
-                if now.year == year and now.month == month:
-                    last_invoice_count = int(last_invoice.invoice_number.split("/")[-1])
-                    invoice_count = last_invoice_count + 1
-            invoice_number = f"FV/{now.year}/{now.month}/{invoice_count}"
+            buyer_address = Address.objects.intern(**buyer_address)
+            company = get_company(user, company_name)
             invoice = Invoice.objects.create(
                 **validated_data,
-                invoice_number=invoice_number,
+                invoice_number=UNNUMBERED_INVOICE,
                 company=company,
                 buyer_address=buyer_address
             )
+            invoice_prepayments = []
             if is_prepayment:
-                for prepayment in prepayments:
-                    InvoicePrepayment.objects.create(**prepayment, invoice=invoice)
+                invoice_prepayments = InvoicePrepayment.objects.bulk_create(
+                    InvoicePrepayment(**prepayment, invoice=invoice) for prepayment in prepayments
+                )
                 if previous_prepayment is not None:
                     if Invoice.objects.filter(company=company, invoice_number=previous_prepayment, is_prepayment=True)\
                             .exists():
@@ -236,17 +447,18 @@ class InvoiceSerializer(serializers.ModelSerializer):
                         raise NotFound(f"No prepayments with invoice number {previous_prepayment}")
             else:
                 invoice.is_prepayment = False
-            net_price = 0
-            total_tax = 0
-            gross_price = 0
-            for product in products:
-                product_model = InvoiceProduct.objects.create(**product, invoice=invoice)
-                net_price += product_model.get_net_price()
-                total_tax += product_model.get_vat_tax()
-                gross_price += product_model.get_gross_price()
-            invoice.net_price = net_price
-            invoice.total_tax += total_tax
-            invoice.gross_price += gross_price
+            products = InvoiceProduct.objects.bulk_create(
+                InvoiceProduct(**product, invoice=invoice) for product in products
+            )
+            tax_summaries = InvoiceTaxSummary.objects.bulk_create(
+                build_invoice_tax_summaries(invoice, products, invoice_prepayments)
+            )
+            SearchEntry.objects.bulk_create(invoice_search_entries(invoice, products))
+            invoice.net_price = sum(product.get_net_price() for product in products)
+            invoice.total_tax = sum(product.get_vat_tax() for product in products)
+            invoice.gross_price = sum(product.get_gross_price() for product in products)
+            apply_contributions(invoice_contributions(invoice, tax_summaries))
+            number_invoices([invoice], timezone.now())
             invoice.save()
         return invoice
 
@@ -274,55 +486,12 @@ class InvoiceSerializer(serializers.ModelSerializer):
         return data
 
     def get_tax_data(self, invoice):
-        tax_data = {
-            "total_net_price": 0,
-            "total_tax_value": 0
-        }
-        for product in invoice.products.all():
-            total_net_price = product.get_net_price()
-            tax_value = product.get_vat_tax()
-            total_gross_price = product.get_gross_price()
-            vat_key = float(product.vat_tax)
-            tax_data['total_net_price'] += total_net_price
-            tax_data['total_tax_value'] += tax_value
-            if vat_key not in tax_data:
-                tax_data[vat_key] = {
-                    "total_net_price": total_net_price,
-                    "tax_value": tax_value,
-                    "total_gross_price": total_gross_price
-                }
-            else:
-                vat_type = tax_data[vat_key]
-                vat_type['total_net_price'] += total_net_price
-                vat_type['tax_value'] += tax_value
-                vat_type['total_gross_price'] += total_gross_price
-        return tax_data
+        return get_invoice_tax_data(invoice.tax_summaries.all())
 
     def get_prepayments_data(self, invoice):
         if not invoice.is_prepayment:
             return None
-        prepayments_data = {
-            "total_net_price": 0,
-            "total_tax_value": 0,
-            "total_gross_price": 0
-        }
-        for prepayment in invoice.prepayments.all():
-            vat_key = float(prepayment.vat_tax)
-            prepayments_data['total_net_price'] += prepayment.net_price
-            prepayments_data['total_tax_value'] += prepayment.get_tax_value()
-            prepayments_data['total_gross_price'] += prepayment.get_gross_price()
-            if vat_key not in prepayments_data:
-                prepayments_data[vat_key] = {
-                    "total_net_price": prepayment.net_price,
-                    "tax_value": prepayment.get_tax_value(),
-                    "total_gross_price": prepayment.get_gross_price()
-                }
-            else:
-                vat_type = prepayments_data[vat_key]
-                vat_type['total_net_price'] += prepayment.net_price
-                vat_type['tax_value'] += prepayment.get_tax_value()
-                vat_type['total_gross_price'] += prepayment.get_gross_price()
-        return prepayments_data
+        return get_invoice_prepayments_data(invoice.tax_summaries.all())
 
     def get_total_gross_price(self, invoice):
         total_price = 0
@@ -336,3 +505,38 @@ class InvoiceSerializer(serializers.ModelSerializer):
         ref_name = None
         write_only_fields = ("company_name",)
         read_only_fields = ("net_price", "total_tax", "gross_price")
+
+
+class ReportJobSerializer(serializers.ModelSerializer):
+
+    doctype = serializers.ChoiceField(choices=["invoice", "receipt"])
+    params = serializers.DictField(required=False, default=dict)
+
+    class Meta:
+        model = ReportJob
+        fields = (
+            "id", "doctype", "params", "status", "cursor", "error", "date_created", "date_started", "date_finished"
+        )
+        read_only_fields = ("status", "cursor", "error", "date_started", "date_finished")
+        ref_name = None
+
+
+class SalesRollupSerializer(serializers.ModelSerializer):
+
+    company = serializers.CharField(source="company.name", read_only=True)
+
+    class Meta:
+        model = SalesRollup
+        exclude = ("id",)
+        ref_name = None
+
+
+class SearchEntrySerializer(serializers.ModelSerializer):
+
+    company = serializers.CharField(source="company.name", read_only=True)
+    rank = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = SearchEntry
+        fields = ("company", "receipt", "invoice", "text", "rank")
+        ref_name = None
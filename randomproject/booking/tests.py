@@ -1,18 +1,64 @@
 from rest_framework.test import APITestCase
+from rest_framework.renderers import JSONRenderer
+from django.db import connection, connections, transaction
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from django.shortcuts import reverse
-from .models import Receipt, Company, Address
+from django.core.management import call_command
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+from .models import Receipt, Company, Address, Invoice, SalesRollup, DocumentSequence, SearchEntry, ReportJob
+from .filters import ReceiptFilter, InvoiceFilter
+from .reports import get_report_queryset
+from .jobs import submit_report_job, run_report_job_in_worker, get_report_path
+from .sequences import reserve_print_numbers
+from .caching import get_companies, bump_company_version
+from .profiling import Profiler
+from .metrics import metrics
+from .serializers import ReceiptSerializer, InvoiceSerializer, apply_contributions
+from .asgi import ASGIHandler
+from asgiref.sync import async_to_sync
 from django.utils import timezone
 from datetime import timedelta
+from importlib.util import find_spec
+from pathlib import Path
+from unittest import mock, skipIf, skipUnless
+from threading import Event, Thread, current_thread
 import math
+import io
+import gzip
+import tempfile
+import json
+import os
+import subprocess
+import sys
 
 User = get_user_model()
 abs_tol = 0.02  # used for math.isclose() function
 
 
+def setUpModule():
+    # Metrics and cache entries of the test process must not end up in the project directory
+    global temporary_dir, temporary_settings
+    temporary_dir = tempfile.TemporaryDirectory()
+    temporary_settings = override_settings(
+        METRICS_DIR=f"{temporary_dir.name}/metrics",
+        CACHES={"default": {**settings.CACHES["default"], "LOCATION": f"{temporary_dir.name}/cache"}}
+    )
+    temporary_settings.enable()
+
+
+def tearDownModule():
+    temporary_settings.disable()
+    temporary_dir.cleanup()
+
+
 class BookingTestCase(APITestCase):
 
     def setUp(self):
+        cache.clear()
         self.user_data = {
             "username": "TestUser",
             "email": "test@test.com",
@@ -146,8 +192,9 @@ class BookingTestCase(APITestCase):
         for _ in range(5):
             response = self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
         self.assertEqual(response.data['print_number'], print_number + 5)
-        Receipt.objects.all().update(date_created=timezone.now()-timedelta(days=2))
-        response = self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        two_days_later = timezone.localdate() + timedelta(days=2)
+        with mock.patch("booking.sequences.timezone.localdate", return_value=two_days_later):
+            response = self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
         self.assertEqual(response.data['print_number'], 1)
 
     def test_create_invoice(self):
@@ -164,3 +211,799 @@ class BookingTestCase(APITestCase):
         self.assertTrue(math.isclose(float(response.data['total_tax']), calculated_tax, abs_tol=abs_tol))
         self.assertTrue(math.isclose(float(response.data['net_price']), net_price, abs_tol=abs_tol))
         self.assertTrue(math.isclose(float(response.data['gross_price']), gross_price, abs_tol=abs_tol))
+
+    def test_bulk_create_receipts(self):
+        self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        invalid_receipt = {**self.receipt_data, "company_name": "Doesnt exist"}
+        response = self.client.post(
+            reverse("receipt-bulk"),
+            [self.receipt_data, invalid_receipt, self.receipt_data],
+            format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.data), 3)
+        self.assertIn("company_name", response.data[1])
+        self.assertEqual(Receipt.objects.count(), 1)
+        receipt_with_sales_point = {**self.receipt_data, "sales_point": self.company_data['company_address']}
+        response = self.client.post(
+            reverse("receipt-bulk"),
+            [self.receipt_data, receipt_with_sales_point, self.receipt_data],
+            format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([receipt['print_number'] for receipt in response.data], [2, 3, 4])
+        single = self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        self.assertEqual(single.data['print_number'], 5)
+        bulk_receipt = Receipt.objects.get(print_number=2)
+        self.assertEqual(bulk_receipt.gross_price, Receipt.objects.get(print_number=1).gross_price)
+        self.assertEqual(bulk_receipt.total_tax, Receipt.objects.get(print_number=1).total_tax)
+        self.assertEqual(Receipt.objects.get(print_number=3).sales_point.city, "TestCity")
+
+    def test_import_invoices(self):
+        self.client.post(reverse("invoice-list"), self.invoice_data, format="json")
+        invalid_invoice = {**self.invoice_data, "buyer_nip": None}
+        response = self.client.post(
+            reverse("invoice-import-invoices") + "?batch_size=2",
+            [self.invoice_data, invalid_invoice, self.invoice_data],
+            format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([result['status'] for result in response.data['results']], ["created", "failed", "created"])
+        numbers = [Invoice.objects.get(invoice_number=result['invoice_number']) for result in response.data['results']
+                   if result['status'] == "created"]
+        self.assertEqual([int(invoice.invoice_number.split("/")[-1]) for invoice in numbers], [2, 3])
+        single_invoice = Invoice.objects.get(invoice_number__endswith="/1")
+        self.assertEqual(numbers[0].gross_price, single_invoice.gross_price)
+        self.assertEqual(numbers[0].products.count(), 2)
+        ndjson = "\n".join(json.dumps(invoice) for invoice in [self.invoice_data, self.invoice_data])
+        response = self.client.post(
+            reverse("invoice-import-invoices"),
+            ndjson,
+            content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.data['created'], 2)
+
+    def test_import_chained_prepayments(self):
+        prepayment_invoice = {
+            **self.invoice_data,
+            "is_prepayment": True,
+            "prepayments": [{"net_price": 10, "vat_tax": 23}]
+        }
+        now = timezone.now()
+        first_number = f"FV/{now.year}/{now.month}/1"
+        response = self.client.post(
+            reverse("invoice-import-invoices"),
+            [
+                prepayment_invoice,
+                {**prepayment_invoice, "previous_prepayment": first_number},
+                {**prepayment_invoice, "previous_prepayment": f"FV/{now.year}/{now.month}/9"}
+            ],
+            format="json"
+        )
+        self.assertEqual([result['status'] for result in response.data['results']], ["created", "created", "failed"])
+        self.assertEqual(response.data['results'][0]['invoice_number'], first_number)
+        self.assertIn("previous_prepayment", response.data['results'][2]['errors'])
+        chained = Invoice.objects.get(invoice_number=response.data['results'][1]['invoice_number'])
+        self.assertEqual(chained.previous_prepayment, first_number)
+
+    def test_receipt_queries_do_not_depend_on_page_size(self):
+        receipt_with_sales_point = {**self.receipt_data, "sales_point": self.company_data['company_address']}
+        for page_size in (1, 5):
+            for _ in range(page_size):
+                self.client.post(reverse("receipt-list"), receipt_with_sales_point, format="json")
+            with self.assertNumQueries(3):
+                response = self.client.get(reverse("receipt-list"))
+            self.assertEqual(len(response.data['results']), 5 if page_size == 5 else 1)
+        receipt = Receipt.objects.first()
+        with self.assertNumQueries(3):
+            self.client.get(reverse("receipt-detail", kwargs={"pk": receipt.pk}))
+
+    def test_invoice_queries_do_not_depend_on_page_size(self):
+        prepayment_invoice = {
+            **self.invoice_data,
+            "is_prepayment": True,
+            "prepayments": [{"net_price": 10, "vat_tax": 23}, {"net_price": 5, "vat_tax": 8}]
+        }
+        for page_size in (1, 5):
+            for _ in range(page_size):
+                self.client.post(reverse("invoice-list"), prepayment_invoice, format="json")
+            with self.assertNumQueries(4):
+                response = self.client.get(reverse("invoice-list"))
+            self.assertEqual(len(response.data['results']), 5 if page_size == 5 else 1)
+        invoice = Invoice.objects.first()
+        with self.assertNumQueries(4):
+            self.client.get(reverse("invoice-detail", kwargs={"pk": invoice.pk}))
+
+    def test_flat_list_matches_serializers(self):
+        self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        self.client.post(
+            reverse("receipt-list"),
+            {**self.receipt_data, "header": None, "sales_point": self.company_data['company_address']},
+            format="json"
+        )
+        self.client.post(reverse("invoice-list"), self.invoice_data, format="json")
+        self.client.post(reverse("invoice-list"), {
+            **self.invoice_data,
+            "is_prepayment": True,
+            "prepayments": [{"net_price": 10, "vat_tax": 23}, {"net_price": 5.5, "vat_tax": 8}]
+        }, format="json")
+        renderer = JSONRenderer()
+        for name, serializer_class, queryset in (
+            ("receipt-list", ReceiptSerializer, Receipt.objects.order_by("-date_created", "-id")),
+            ("invoice-list", InvoiceSerializer, Invoice.objects.order_by("-date_created", "-id"))
+        ):
+            response = self.client.get(reverse(name))
+            self.assertEqual(len(response.data['results']), 2)
+            self.assertEqual(
+                renderer.render(response.data['results']),
+                renderer.render(serializer_class(queryset, many=True).data)
+            )
+
+    def test_sparse_fields(self):
+        self.client.post(
+            reverse("receipt-list"),
+            {**self.receipt_data, "sales_point": self.company_data['company_address']},
+            format="json"
+        )
+        receipt = Receipt.objects.get()
+        url = reverse("receipt-detail", kwargs={"pk": receipt.pk})
+        params = {"fields": "id,total_tax,company,products,tax_values", "expand": "products"}
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("receipt-list"), params)
+        listed = response.data['results'][0]
+        self.assertEqual(list(listed), ["id", "company", "products", "total_tax"])
+        self.assertEqual(listed['company'], str(receipt.company_id))
+        self.assertEqual(len(listed['products']), 2)
+        self.assertIn("tax_values", self.client.get(url).data)
+        with self.assertNumQueries(2):
+            response = self.client.get(url, params)
+        self.assertEqual(response.data, listed)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("receipt-list"), {"expand": ""})
+        self.assertEqual(response.data['results'][0]['sales_point'], str(receipt.sales_point_id))
+        self.assertNotIn("products", response.data['results'][0])
+        self.assertEqual(self.client.get(url, {"fields": "owner"}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"fields": ","}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("receipt-list"), {"fields": ""}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("receipt-list"), {"expand": "header"}).status_code, 400)
+        self.client.delete(url)
+        self.assertEqual(self.client.get(url, params).status_code, 404)
+
+    def test_orjson_renderer(self):
+        self.client.post(reverse("invoice-list"), {
+            **self.invoice_data,
+            "is_prepayment": True,
+            "prepayments": [{"net_price": 10, "vat_tax": 23}]
+        }, format="json")
+        response = self.client.get(reverse("invoice-list"))
+        self.assertEqual(response['Content-Type'], "application/json")
+        self.assertEqual(json.loads(response.content), json.loads(JSONRenderer().render(response.data)))
+        self.assertIn(b'"23.0":', response.content)
+        response = self.client.get(reverse("invoice-list"), HTTP_ACCEPT="application/json; indent=4")
+        self.assertTrue(response.content.startswith(b'{\n  "next"'))
+
+    @skipUnless(find_spec("msgpack"), "msgpack is not installed")
+    def test_msgpack_renderer(self):
+        import msgpack
+
+        self.client.post(reverse("invoice-list"), self.invoice_data, format="json")
+        response = self.client.get(reverse("invoice-list"), HTTP_ACCEPT="application/msgpack")
+        self.assertEqual(response['Content-Type'], "application/msgpack")
+        self.assertEqual(
+            msgpack.unpackb(response.content, strict_map_key=False)['results'][0]['invoice_number'],
+            Invoice.objects.get().invoice_number
+        )
+
+    def test_receipt_representation_cache(self):
+        self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        url = reverse("receipt-detail", kwargs={"pk": Receipt.objects.get().pk})
+        response = self.client.get(url)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(url)
+        self.assertEqual(cached_response.data, response.data)
+        self.assertEqual(cached_response['ETag'], etag)
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn("Accept", response['Vary'])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, HTTP_ACCEPT="text/html")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'], HTTP_ACCEPT="text/html")
+                         .status_code, 304)
+        self.client.patch(reverse("company-detail", kwargs={"name": "TestCompany"}), {"website": "new.com"},
+                          format="json")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['company']['website'], "new.com")
+        self.client.delete(url)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_full_text_search(self):
+        self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        self.client.post(reverse("receipt-list"), {**self.receipt_data, "header": "Apple store"}, format="json")
+        self.client.post(reverse("invoice-list"), self.invoice_data, format="json")
+        response = self.client.get(reverse("search-list"), {"q": "appl"})
+        self.assertEqual([hit['text'] for hit in response.data], ["Apple", "Apple", "Apple store"])
+        self.assertTrue(all(hit['receipt'] for hit in response.data))
+        response = self.client.get(reverse("receipt-list"), {"search": "apple store"})
+        self.assertEqual(len(response.data['results']), 1)
+        response = self.client.get(reverse("invoice-list"), {"search": self.invoice_data['buyer_name']})
+        self.assertEqual(len(response.data['results']), 1)
+        self.client.delete(reverse("receipt-detail", kwargs={"pk": Receipt.objects.get(header="Apple store").pk}))
+        self.assertEqual(len(self.client.get(reverse("search-list"), {"q": "apple"}).data), 1)
+        SearchEntry.objects.all().delete()
+        call_command("rebuild_search_index", stdout=io.StringIO())
+        self.assertEqual(len(self.client.get(reverse("search-list"), {"q": "apple", "doctype": "receipt"}).data), 1)
+        self.assertEqual(self.client.get(reverse("search-list")).status_code, 400)
+
+    def test_addresses_are_interned(self):
+        receipt_with_sales_point = {**self.receipt_data, "sales_point": self.company_data['company_address']}
+        self.client.post(reverse("receipt-list"), receipt_with_sales_point, format="json")
+        self.client.post(reverse("receipt-bulk"), [receipt_with_sales_point] * 2, format="json")
+        self.client.post(reverse("invoice-list"), self.invoice_data, format="json")
+        self.client.post(reverse("invoice-import-invoices"), [self.invoice_data], format="json")
+        self.assertEqual(Address.objects.count(), 1)
+        self.client.patch(
+            reverse("company-detail", kwargs={"name": "TestCompany"}),
+            {"company_address": {**self.company_data['company_address'], "city": "NewCity"}},
+            format="json"
+        )
+        self.assertEqual(Address.objects.count(), 2)
+        self.assertEqual(Receipt.objects.filter(sales_point__city="TestCity").count(), 3)
+
+    def test_deduplicate_addresses(self):
+        fields = {"street": "Teststreet", "building_number": "12", "post_code": "12-345", "country": "Poland"}
+        duplicates = Address.objects.bulk_create([
+            Address(**fields, city="TestCity"), Address(**fields, city=" TestCity "), Address(**fields, city="Other")
+        ])
+        self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        Receipt.objects.update(sales_point=duplicates[1])
+        call_command("deduplicate_addresses", stdout=io.StringIO())
+        self.assertEqual(Address.objects.count(), 2)
+        self.assertFalse(Address.objects.filter(content_hash__isnull=True).exists())
+        self.assertEqual(Receipt.objects.get().sales_point.companies.get().name, "TestCompany")
+
+    def test_company_cache(self):
+        user = User.objects.get(username="TestUser")
+        self.assertIn("TestCompany", get_companies(user, ["TestCompany"]))
+        with self.assertNumQueries(0):
+            company = get_companies(user, ["TestCompany"])["TestCompany"]
+        self.assertEqual(company.company_address.city, "TestCity")
+        for name in ("Second", "Third"):
+            self.client.post(reverse("company-list"), {**self.company_data, "name": name}, format="json")
+        names = ["TestCompany", "Second", "Third"]
+        self.assertEqual(get_companies(user, names).keys(), set(names))
+        with self.assertNumQueries(0), mock.patch("booking.caching.cache.get_many", wraps=cache.get_many) as get_many, \
+                mock.patch("booking.caching.cache.get_or_set") as get_or_set:
+            self.assertEqual(get_companies(user, names).keys(), set(names))
+        get_many.assert_called_once()
+        get_or_set.assert_not_called()
+        self.client.patch(reverse("company-detail", kwargs={"name": "TestCompany"}), {"name": "Renamed"}, format="json")
+        self.assertEqual(get_companies(user, ["TestCompany", "Renamed"]).keys(), {"Renamed"})
+        response = self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        self.assertEqual(response.status_code, 404)
+        receipt_data = {**self.receipt_data, "company_name": "Renamed"}
+        response = self.client.post(reverse("receipt-list"), receipt_data, format="json")
+        self.assertEqual(response.data['company']['name'], "Renamed")
+
+    def test_company_version_is_shared(self):
+        user = User.objects.get(username="TestUser")
+        company = get_companies(user, ["TestCompany"])["TestCompany"]
+        receipt_id = self.client.post(reverse("receipt-list"), self.receipt_data, format="json").data["id"]
+        url = reverse("receipt-detail", kwargs={"pk": receipt_id})
+        self.assertEqual(self.client.get(url).data["company"]["website"], "test.com")
+        # Another worker process updates the company and bumps its version through its own cache instance
+        Company.objects.filter(pk=company.pk).update(website="other.com")
+        other_cache = FileBasedCache(settings.CACHES["default"]["LOCATION"], {})
+        self.assertIsNot(other_cache, cache)
+        with mock.patch("booking.caching.cache", other_cache):
+            bump_company_version(company.pk)
+        self.assertEqual(get_companies(user, ["TestCompany"])["TestCompany"].website, "other.com")
+        self.assertEqual(self.client.get(url).data["company"]["website"], "other.com")
+
+    def test_generate_data(self):
+        def generate():
+            call_command("generate_data", owners=2, companies=2, receipts=300, invoices=60, days=3, seed=7,
+                         until="2021-03-01", batch_size=50, stdout=io.StringIO())
+            return list(Invoice.objects.filter(company__name__startswith="Generated").order_by("date_created")
+                        .values_list("id", "invoice_number", "previous_prepayment", "gross_price"))
+
+        with transaction.atomic():
+            invoices = generate()
+            transaction.set_rollback(True)
+        self.assertEqual(generate(), invoices)
+        self.assertTrue(any(previous_prepayment for _, _, previous_prepayment, _ in invoices))
+        company = Company.objects.get(name="Generated 7 company 0-0")
+        day = timezone.localtime(company.receipt_set.earliest("date_created").date_created).date()
+        print_numbers = company.receipt_set.filter(date_created__date=day).order_by("date_created")\
+            .values_list("print_number", flat=True)
+        self.assertEqual(list(print_numbers), list(range(1, len(print_numbers) + 1)))
+        sequence = DocumentSequence.objects.get(company=company, doctype="receipt", period=day.isoformat())
+        self.assertEqual(sequence.last_value, len(print_numbers))
+        out = io.StringIO()
+        call_command("rebuild_rollups", "--check", stdout=out)
+        self.assertIn("0 of", out.getvalue())
+
+    def test_sequence_reserves_blocks(self):
+        company = Company.objects.get()
+        self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        self.assertEqual(reserve_print_numbers(company, 10), 2)
+        response = self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        self.assertEqual(response.data['print_number'], 12)
+
+    def test_numbers_are_reserved_last(self):
+        requests = [
+            ("booking_receipt", reverse("receipt-bulk"), [self.receipt_data] * 3),
+            ("booking_receipt", reverse("receipt-list"), self.receipt_data),
+            ("booking_invoice", reverse("invoice-list"), self.invoice_data)
+        ]
+        for table, url, data in requests:
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.client.post(url, data, format="json").status_code, 201)
+            queries = [query['sql'] for query in context.captured_queries]
+            first_reservation = next(index for index, sql in enumerate(queries) if "booking_documentsequence" in sql)
+            # The sequence row stays locked from the reservation, only the numbers are written after it
+            self.assertEqual(
+                [sql for sql in queries[first_reservation:]
+                 if sql.startswith(("INSERT", "UPDATE", "DELETE")) and "booking_documentsequence" not in sql],
+                [sql for sql in queries[first_reservation:] if sql.startswith(f'UPDATE "{table}"')]
+            )
+        response = self.client.get(reverse("receipt-list"))
+        self.assertEqual(sorted(receipt['print_number'] for receipt in response.data['results']), [1, 2, 3, 4])
+
+    def test_invoice_tax_summaries(self):
+        invoice_data = {
+            **self.invoice_data,
+            "is_prepayment": True,
+            "prepayments": [{"net_price": 10, "vat_tax": 23}, {"net_price": 5, "vat_tax": 8}]
+        }
+        response = self.client.post(reverse("invoice-list"), invoice_data, format="json")
+        invoice = Invoice.objects.get()
+        self.assertEqual(invoice.tax_summaries.count(), 3)
+        response = self.client.get(reverse("invoice-detail", kwargs={"pk": invoice.pk}))
+        self.assertEqual(float(response.data['tax_data'][23.0]['total_net_price']), 71.88)
+        self.assertTrue(math.isclose(response.data['tax_data']['total_tax_value'], 16.54, abs_tol=abs_tol))
+        self.assertTrue(math.isclose(response.data['prepayments_data']['total_gross_price'], 17.7, abs_tol=abs_tol))
+        self.assertTrue(math.isclose(response.data['prepayments_data'][8.0]['tax_value'], 0.4, abs_tol=abs_tol))
+
+    def test_sales_report(self):
+        for _ in range(3):
+            self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        with self.settings(REPORT_CHUNK_SIZE=2):
+            response = self.client.get(reverse("report", kwargs={"doctype": "receipt"}))
+            chunks = list(response.streaming_content)
+        self.assertEqual(len(chunks), 2)
+        rows = b"".join(chunks).decode().splitlines()
+        self.assertEqual(rows[0], "Seller,ReceiptId,Country,TransactionTime,MarketplaceCurrency,TotalTax,GrossPrice")
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(rows[1].startswith("TestCompany,"))
+
+    def test_asgi_sales_report(self):
+        for _ in range(3):
+            self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        url = reverse("report", kwargs={"doctype": "receipt"})
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": url,
+            "query_string": b"",
+            "server": ("testserver", 80),
+            "headers": [(b"authorization", self.client._credentials['HTTP_AUTHORIZATION'].encode())]
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            messages.append(message)
+
+        with self.settings(REPORT_CHUNK_SIZE=2):
+            async_to_sync(ASGIHandler())(scope, receive, send)
+        self.assertEqual(messages[0]['status'], 200)
+        body = b"".join(message.get('body', b"") for message in messages[1:])
+        self.assertEqual(len(messages), 5)
+        self.assertEqual(body, b"".join(self.client.get(url).streaming_content))
+
+    def test_compressed_sales_report(self):
+        for _ in range(3):
+            self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        url = reverse("report", kwargs={"doctype": "receipt"})
+        csv = b"".join(self.client.get(url).streaming_content)
+        with self.settings(REPORT_CHUNK_SIZE=2):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip;q=1.0, identity;q=0.5")
+            chunks = list(response.streaming_content)
+        self.assertEqual(response['Content-Encoding'], "gzip")
+        self.assertEqual(response['Content-Type'], "text/csv")
+        self.assertIn("Accept-Encoding", response['Vary'])
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(gzip.decompress(b"".join(chunks)), csv)
+        response = self.client.get(url, {"format": "gzip"})
+        self.assertEqual(response['Content-Type'], "application/gzip")
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn("report.csv.gz", response['Content-Disposition'])
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), csv)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip;q=0")
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(self.client.get(url, {"format": "xlsx"}).status_code, 400)
+
+    @override_settings(REPORT_CURSOR_LAG=0)
+    def test_incremental_sales_report(self):
+        for _ in range(2):
+            self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        url = reverse("report", kwargs={"doctype": "receipt"})
+        response = self.client.get(url)
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 3)
+        cursor = response['X-Report-Cursor']
+        self.client.post(reverse("receipt-list"), {**self.receipt_data, "currency": "EUR"}, format="json")
+        response = self.client.get(url, {"cursor": cursor})
+        rows = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(rows), 2)
+        self.assertIn(",EUR,", rows[1])
+        response = self.client.get(url, {"cursor": response['X-Report-Cursor']})
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 1)
+        response = self.client.get(url, {"currency": "PLN", "since": timezone.now() - timedelta(hours=1)})
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 3)
+        response = self.client.get(reverse("report", kwargs={"doctype": "invoice"}), {"cursor": cursor})
+        self.assertEqual(response.status_code, 400)
+
+    def test_report_cursor_lag(self):
+        url = reverse("report", kwargs={"doctype": "receipt"})
+        receipt_id = self.client.post(reverse("receipt-list"), self.receipt_data, format="json").data['id']
+        response = self.client.get(url)
+        rows = b"".join(response.streaming_content).decode().splitlines()
+        # Reports without a cursor export new documents, but their cursor doesn't pass them yet
+        self.assertEqual(len(rows), 2)
+        self.assertIn(str(receipt_id), rows[1])
+        self.assertFalse(response.has_header('X-Report-Cursor'))
+        now = timezone.now()
+        ids = [receipt_id, self.client.post(reverse("receipt-list"), self.receipt_data, format="json").data['id']]
+        Receipt.objects.filter(pk=ids[0]).update(date_created=now - timedelta(seconds=120))
+        Receipt.objects.filter(pk=ids[1]).update(date_created=now - timedelta(seconds=30))
+        response = self.client.get(url)
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 3)
+        cursor = response['X-Report-Cursor']
+        # A receipt saved 45 seconds ago by a transaction which commits only now
+        self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        Receipt.objects.exclude(pk__in=ids).update(date_created=now - timedelta(seconds=45))
+        response = self.client.get(url, {"cursor": cursor})
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 1)
+        self.assertEqual(response['X-Report-Cursor'], cursor)
+        with mock.patch("booking.reports.timezone.now", return_value=now + timedelta(seconds=120)):
+            response = self.client.get(url, {"cursor": cursor})
+        rows = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(rows), 3)
+        self.assertIn(str(ids[1]), rows[2])
+
+    def test_report_job(self):
+        for _ in range(2):
+            self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        with tempfile.TemporaryDirectory() as reports_root, \
+                self.settings(REPORT_JOB_WORKERS=0, REPORTS_ROOT=reports_root):
+            job_data = {"doctype": "receipt", "params": {"currency": "PLN"}}
+            response = self.client.post(reverse("report-job-list"), job_data, format="json")
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data['status'], "finished")
+            job_id = response.data['id']
+            response = self.client.post(reverse("report-job-list"), job_data, format="json")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['id'], job_id)
+            url = reverse("report-job-download", kwargs={"pk": job_id})
+            content = b"".join(self.client.get(url).streaming_content)
+            self.assertEqual(len(gzip.decompress(content).splitlines()), 3)
+            response = self.client.get(url, HTTP_RANGE="bytes=10-")
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b"".join(response.streaming_content), content[10:])
+            self.assertEqual(response['Content-Range'], f"bytes 10-{len(content) - 1}/{len(content)}")
+            response = self.client.get(url, HTTP_RANGE=f"bytes={len(content)}-")
+            self.assertEqual(response.status_code, 416)
+            response = self.client.get(url, HTTP_RANGE="bytes=0-1,5-6")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), content)
+
+    def test_expire_report_jobs(self):
+        self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        with tempfile.TemporaryDirectory() as reports_root, \
+                self.settings(REPORT_JOB_WORKERS=0, REPORTS_ROOT=reports_root):
+            response = self.client.post(reverse("report-job-list"), {"doctype": "receipt"}, format="json")
+            job = ReportJob.objects.get(pk=response.data['id'])
+            path = get_report_path(job)
+            self.assertTrue(path.exists())
+            hour_ago = timezone.now() - timedelta(hours=1)
+            ReportJob.objects.filter(pk=job.pk).update(date_finished=hour_ago)
+            with self.settings(REPORT_JOB_WORKERS=2), mock.patch("booking.jobs.get_executor") as get_executor, \
+                    mock.patch("booking.jobs.transaction.on_commit", side_effect=lambda callback: callback()):
+                stale_job, _ = submit_report_job(job.owner, "receipt", {"currency": "EUR"})
+                ReportJob.objects.filter(pk=stale_job.pk).update(date_queued=timezone.now() - timedelta(minutes=10))
+                response = self.client.post(reverse("report-job-list"), {"doctype": "receipt"}, format="json")
+                self.assertEqual(response.status_code, 202)
+                self.assertFalse(ReportJob.objects.filter(pk=job.pk).exists())
+                self.assertFalse(path.exists())
+                self.assertEqual(submit_report_job(job.owner, "receipt", {"currency": "EUR"})[0], stale_job)
+            self.assertEqual(get_executor.return_value.submit.call_count, 3)
+            get_executor.return_value.submit.assert_called_with(run_report_job_in_worker, stale_job.pk)
+            orphan = Path(reports_root) / "orphan.csv.gz"
+            orphan.touch()
+            call_command("expire_report_jobs", stdout=io.StringIO())
+            self.assertFalse(orphan.exists())
+
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as metrics_dir, \
+                self.settings(METRICS_DIR=metrics_dir, METRICS_TOKEN="secret"):
+            for _ in range(2):
+                self.client.get(reverse("receipt-list"))
+            self.client.credentials()
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+            process = subprocess.Popen([sys.executable, "-c", ""])
+            process.wait()
+            for name in (f"{os.getppid()}-parent.json", f"{process.pid}-dead.json", "0.json"):
+                with open(f"{metrics_dir}/{name}", "w") as file:
+                    json.dump([[["receipt-list", "GET", "200"], {
+                        "buckets": [1] * 11, "count": 1, "sum": 0.001, "counters": [3, 0.001, 0.001, 100]
+                    }]], file)
+            process_count = metrics.series[("receipt-list", "GET", "200")]["count"]
+            response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+            self.assertFalse(os.path.exists(f"{metrics_dir}/{process.pid}-dead.json"))
+            with self.settings(METRICS_TOKEN=""):
+                self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+                staff_user = User.objects.create(username="staff", date_of_birth="1999-01-01", is_staff=True)
+                self.client.force_authenticate(staff_user)
+                self.assertEqual(self.client.get(reverse("metrics")).status_code, 200)
+                self.client.force_authenticate(None)
+        self.assertEqual(response.status_code, 200)
+        lines = dict(line.rsplit(" ", 1) for line in response.content.decode().splitlines() if line[0] != "#")
+        labels = '{route="receipt-list",method="GET",status="200"'
+        count = int(lines[f'booking_http_request_duration_seconds_bucket{labels},le="+Inf"}}'])
+        # Requests of the test process and one of the live parent process, the dead process isn't counted
+        self.assertEqual(count, process_count + 1)
+        self.assertGreaterEqual(count, 3)
+        self.assertEqual(int(lines[f'booking_http_request_duration_seconds_count{labels}}}']), count)
+        self.assertGreater(int(lines[f'booking_http_db_queries_total{labels}}}']), 3)
+        self.assertGreater(float(lines[f'booking_http_render_seconds_total{labels}}}']), 0)
+        self.assertGreater(float(lines[f'booking_http_serialize_seconds_total{labels}}}']), 0)
+        self.assertIn('booking_http_request_duration_seconds_count{route="metrics",method="GET",status="403"}', lines)
+
+    def test_profiler(self):
+        self.client.post(reverse("invoice-list"), self.invoice_data, format="json")
+        self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        with tempfile.TemporaryDirectory() as profiler_dir, \
+                self.settings(PROFILER_DIR=profiler_dir, PROFILER_TOKEN="secret", PROFILER_RING_SIZE=1):
+            self.assertNotIn('X-Profile-Id', self.client.get(reverse("invoice-list"), HTTP_X_PROFILE="wrong"))
+            self.client.get(reverse("receipt-list"), HTTP_X_PROFILE="secret")
+            response = self.client.get(reverse("invoice-list"), HTTP_X_PROFILE="secret")
+            profile_id = response['X-Profile-Id']
+            self.assertEqual(self.client.get(reverse("profile-list")).status_code, 403)
+            user = User.objects.get(username=self.user_data['username'])
+            user.is_staff = True
+            user.save()
+            response = self.client.get(reverse("profile-list"))
+            self.assertEqual([profile['id'] for profile in response.data], [profile_id])
+            profile = self.client.get(reverse("profile-detail", kwargs={"pk": profile_id})).data
+        self.assertEqual(profile['path'], reverse("invoice-list"))
+        self.assertEqual(profile['view'], "invoice-list")
+        self.assertEqual(profile['query_count'], 4)
+        self.assertIn("paginate_queryset", profile['queries'][0]['location'])
+        profiler = Profiler()
+        with connection.execute_wrapper(profiler):
+            for receipt in Receipt.objects.all()[:1]:
+                for _ in range(3):
+                    list(receipt.products.all())
+        self.assertEqual(len(profiler.queries), 4)
+        self.assertEqual([statement['count'] for statement in profiler.get_repeated()], [3])
+
+    def test_receipt_cursor_pagination(self):
+        for _ in range(7):
+            self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        self.client.post(reverse("receipt-list"), {**self.receipt_data, "currency": "EUR"}, format="json")
+        print_numbers = []
+        url = reverse("receipt-list") + "?page_size=3&currency=PLN"
+        while url is not None:
+            response = self.client.get(url)
+            self.assertLessEqual(len(response.data['results']), 3)
+            print_numbers.extend(receipt['print_number'] for receipt in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(print_numbers, [7, 6, 5, 4, 3, 2, 1])
+        response = self.client.get(reverse("receipt-list"), {"page_size": 1000})
+        self.assertEqual(len(response.data['results']), 8)
+        # More equal values than DRF's offset_cutoff of 1000
+        company = Company.objects.get()
+        Receipt.objects.bulk_create(
+            Receipt(company=company, currency="PLN", print_number=1, receipt_number=1) for _ in range(1100)
+        )
+        Receipt.objects.update(print_number=1)
+        expected = sorted(map(str, Receipt.objects.values_list("id", flat=True)), reverse=True)
+        ids = []
+        url = reverse("receipt-list") + "?page_size=100&ordering=-print_number&fields=id"
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        while True:
+            ids.extend(receipt['id'] for receipt in response.data['results'])
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(ids, expected)
+        ids = []
+        while True:
+            ids[:0] = [receipt['id'] for receipt in response.data['results']]
+            if response.data['previous'] is None:
+                break
+            response = self.client.get(response.data['previous'])
+        self.assertEqual(ids, expected)
+        expected = [None, None, None, "12345678901", "12345678902"]
+        for pesel in expected:
+            buyer = {"buyer_nip": None, "buyer_pesel": pesel} if pesel else {}
+            self.client.post(reverse("invoice-list"), {**self.invoice_data, **buyer}, format="json")
+        for ordering in ("buyer_pesel", "-buyer_pesel"):
+            pesels = []
+            url = reverse("invoice-list") + f"?page_size=2&ordering={ordering}"
+            while url is not None:
+                response = self.client.get(url)
+                pesels.extend(invoice['buyer_pesel'] for invoice in response.data['results'])
+                url = response.data['next']
+            # Null values are ordered before the others
+            self.assertEqual(pesels, expected if ordering[0] != "-" else expected[::-1])
+
+    def test_sales_analytics(self):
+        for _ in range(2):
+            self.client.post(reverse("receipt-list"), self.receipt_data, format="json")
+        self.client.post(reverse("receipt-bulk"), [self.receipt_data], format="json")
+        self.client.post(reverse("invoice-list"), self.invoice_data, format="json")
+        response = self.client.get(
+            reverse("analytics-list"),
+            {"period": "day", "doctype": "receipt", "vat_rate": "total"}
+        )
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['document_count'], 3)
+        self.assertEqual(float(response.data[0]['gross_price']), 3 * 100)
+        response = self.client.get(
+            reverse("analytics-list"),
+            {"period": "month", "doctype": "invoice", "vat_rate": "23"}
+        )
+        self.assertEqual(float(response.data[0]['net_price']), 71.88)
+        self.client.delete(reverse("receipt-detail", kwargs={"pk": Receipt.objects.first().pk}))
+        out = io.StringIO()
+        call_command("rebuild_rollups", "--check", stdout=out)
+        self.assertIn("0 of", out.getvalue())
+        rollup = SalesRollup.objects.get(period="day", doctype="receipt", vat_rate="total")
+        self.assertEqual(rollup.document_count, 2)
+        SalesRollup.objects.filter(pk=rollup.pk).update(document_count=5)
+        call_command("rebuild_rollups", stdout=out)
+        self.assertEqual(SalesRollup.objects.get(period="day", doctype="receipt", vat_rate="total").document_count, 2)
+
+
+@skipUnless(connection.vendor == "sqlite", "Query plans are checked with SQLite EXPLAIN QUERY PLAN")
+class QueryPlanTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for user_number in range(3):
+            user = User.objects.create(username=f"user{user_number}", date_of_birth="1999-01-01")
+            for company_number in range(2):
+                address = Address.objects.intern(
+                    street="Teststreet", building_number="1", post_code="12-345", city="TestCity", country="Poland"
+                )
+                company = Company.objects.create(
+                    owner=user,
+                    name=f"Company{user_number}{company_number}",
+                    company_address=address,
+                    nip_number="1234567890"
+                )
+                Receipt.objects.bulk_create(
+                    Receipt(company=company, currency="PLN", print_number=number, receipt_number=number)
+                    for number in range(1, 51)
+                )
+                Invoice.objects.bulk_create(
+                    Invoice(
+                        company=company,
+                        buyer_name="TestBuyer",
+                        buyer_address=address,
+                        date_finished="2020-01-01",
+                        invoice_number=f"FV/2020/1/{number}",
+                        currency="EUR",
+                        is_paid=True
+                    )
+                    for number in range(1, 51)
+                )
+        cls.user = User.objects.get(username="user0")
+        cls.company = cls.user.companies.first()
+
+    def assertNoFullScan(self, queryset):
+        plan = queryset.explain()
+        for line in plan.splitlines():
+            self.assertNotRegex(line, r"\bSCAN (TABLE )?booking_", plan)
+
+    def test_list_queries(self):
+        now = timezone.now()
+        receipts = Receipt.objects.filter(company__owner=self.user).order_by("-date_created", "-id")
+        invoices = Invoice.objects.filter(company__owner=self.user).order_by("-date_created", "-id")
+        self.assertNoFullScan(receipts[:5])
+        self.assertNoFullScan(receipts.filter(date_created__lt=now)[:5])
+        self.assertNoFullScan(invoices[:5])
+        self.assertNoFullScan(invoices.filter(date_created__lt=now)[:5])
+        self.assertNoFullScan(Company.objects.filter(owner=self.user).order_by("name"))
+
+    def test_filter_queries(self):
+        receipts = Receipt.objects.filter(company__owner=self.user)
+        invoices = Invoice.objects.filter(company__owner=self.user)
+        self.assertNoFullScan(ReceiptFilter({"print_number__gte": 10}, receipts).qs)
+        self.assertNoFullScan(ReceiptFilter({"receipt_number__lte": 10}, receipts).qs)
+        self.assertNoFullScan(ReceiptFilter({"date_created_after": "2020-01-01T00:00:00"}, receipts).qs)
+        self.assertNoFullScan(InvoiceFilter({"date_finished_after": "2020-01-01"}, invoices).qs)
+        self.assertNoFullScan(InvoiceFilter({"invoice_number": "FV/2020/1/1"}, invoices).qs)
+
+    def test_numbering_queries(self):
+        now = timezone.now()
+        self.assertNoFullScan(Receipt.objects.filter(company=self.company, date_created__date=now.date()))
+        self.assertNoFullScan(Invoice.objects.filter(company=self.company, date_created__gte=now)
+                              .order_by("-date_created"))
+        self.assertNoFullScan(Invoice.objects.filter(company=self.company, invoice_number="FV/2020/1/1",
+                                                     is_prepayment=True))
+        self.assertNoFullScan(DocumentSequence.objects.filter(company=self.company, doctype="receipt", period="x"))
+
+    def test_report_queries(self):
+        queryset = get_report_queryset(self.user, "receipt", {"since": timezone.now()})
+        self.assertNoFullScan(queryset)
+        self.assertNoFullScan(get_report_queryset(self.user, "invoice", {"company": self.company.name}))
+
+
+@skipIf(connection.vendor == "sqlite", "SQLite runs one writing transaction at a time")
+class DocumentNumberingConcurrencyTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="user", date_of_birth="1999-01-01")
+        address = Address.objects.intern(
+            street="Teststreet", building_number="1", post_code="12-345", city="TestCity", country="Poland"
+        )
+        Company.objects.create(owner=self.user, name="Company", company_address=address, nip_number="1234567890")
+        self.receipt_data = {
+            "company_name": "Company",
+            "currency": "PLN",
+            "products": [{"name": "Egg", "unit_price": 1, "quantity": 5, "vat_type": "A"}]
+        }
+
+    def create_receipts(self, count, print_numbers):
+        try:
+            serializer = ReceiptSerializer(
+                data=[self.receipt_data] * count, many=True, context={"request": mock.Mock(user=self.user)}
+            )
+            serializer.is_valid(raise_exception=True)
+            print_numbers.extend(receipt.print_number for receipt in serializer.save())
+        finally:
+            connections.close_all()
+
+    def test_concurrent_numbers_are_unique(self):
+        print_numbers = []
+        threads = [Thread(target=self.create_receipts, args=(5, print_numbers)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(print_numbers), list(range(1, 21)))
+        self.assertEqual(sorted(Receipt.objects.values_list("print_number", flat=True)), list(range(1, 21)))
+
+    def test_writer_does_not_block_another(self):
+        print_numbers = []
+        paused, resumed = Event(), Event()
+
+        def pause_first_writer(contributions):
+            if current_thread() is first_writer:
+                paused.set()
+                resumed.wait(10)
+            apply_contributions(contributions)
+
+        first_writer = Thread(target=self.create_receipts, args=(3, print_numbers))
+        second_writer = Thread(target=self.create_receipts, args=(2, print_numbers))
+        with mock.patch("booking.serializers.apply_contributions", side_effect=pause_first_writer):
+            first_writer.start()
+            self.assertTrue(paused.wait(10))
+            # The first writer inserted its receipts but hasn't reserved their numbers yet
+            second_writer.start()
+            second_writer.join(10)
+            self.assertFalse(second_writer.is_alive())
+            resumed.set()
+            first_writer.join()
+        self.assertEqual(print_numbers, [1, 2, 3, 4, 5])
@@ -1,5 +1,6 @@
 from django.urls import path, include
-from .views import ReceiptViewSet, CompanyViewSet, InvoiceViewSet, SalesReportView
+from .views import ReceiptViewSet, CompanyViewSet, InvoiceViewSet, SalesReportView, ReportJobViewSet, \
+    SalesAnalyticsViewSet, SearchViewSet, ProfileViewSet
 from rest_framework.routers import DefaultRouter
 
 receipt_router = DefaultRouter()
@@ -11,10 +12,26 @@ company_router.register(prefix="company", viewset=CompanyViewSet, basename="comp
 invoice_router = DefaultRouter()
 invoice_router.register(prefix="invoice", viewset=InvoiceViewSet, basename="invoice")
 
+report_job_router = DefaultRouter()
+report_job_router.register(prefix="report-job", viewset=ReportJobViewSet, basename="report-job")
+
+analytics_router = DefaultRouter()
+analytics_router.register(prefix="analytics", viewset=SalesAnalyticsViewSet, basename="analytics")
+
+search_router = DefaultRouter()
+search_router.register(prefix="search", viewset=SearchViewSet, basename="search")
+
+profile_router = DefaultRouter()
+profile_router.register(prefix="profile", viewset=ProfileViewSet, basename="profile")
+
 
 urlpatterns = [
     path("", include(receipt_router.urls)),
     path("", include(company_router.urls)),
     path("", include(invoice_router.urls)),
+    path("", include(report_job_router.urls)),
+    path("", include(analytics_router.urls)),
+    path("", include(search_router.urls)),
+    path("", include(profile_router.urls)),
     path("report/<str:doctype>/", SalesReportView.as_view(), name="report")
 ]
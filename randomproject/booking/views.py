@@ -1,21 +1,53 @@
-from rest_framework.viewsets import GenericViewSet
-from rest_framework.mixins import ListModelMixin, RetrieveModelMixin, CreateModelMixin, DestroyModelMixin
+from rest_framework.viewsets import GenericViewSet, ViewSet
+from rest_framework.mixins import (
+    ListModelMixin, RetrieveModelMixin, CreateModelMixin, DestroyModelMixin, UpdateModelMixin
+)
 from rest_framework.views import APIView
 from rest_framework.filters import SearchFilter, OrderingFilter
-from rest_framework.exceptions import NotAcceptable
-from django.http import StreamingHttpResponse
+from rest_framework.exceptions import NotAcceptable, ValidationError, NotFound, PermissionDenied
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework import status
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import AllowAny, IsAdminUser
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.utils.cache import patch_vary_headers
 from django_filters.rest_framework import DjangoFilterBackend
-from .serializers import ReceiptSerializer, CompanySerializer, InvoiceSerializer
-from .models import Receipt, Company, Invoice
-from .filters import ReceiptFilter, InvoiceFilter
-import csv
+from .serializers import (
+    ReceiptSerializer, CompanySerializer, InvoiceSerializer, ReceiptSummarySerializer, ReportJobSerializer,
+    SalesRollupSerializer, SearchEntrySerializer
+)
+from .models import Receipt, Company, Invoice, ReportJob, SalesRollup, SearchEntry
+from .filters import ReceiptFilter, InvoiceFilter, SalesRollupFilter, FullTextSearchFilter
+from .importers import InvoiceImporter
+from .jobs import submit_report_job, get_report_path
+from .responses import ranged_file_response, AsyncStreamingHttpResponse
+from .pagination import DocumentCursorPagination
+from .rollups import apply_contributions, receipt_contributions, invoice_contributions
+from .parsers import NDJSONParser
+from .search import matching_entries
+from .metrics import TimedSerializerMixin, collect, render_metrics
+from .negotiation import ReportContentNegotiation
+from .compression import COMPRESSORS, compress_chunks, async_compress_chunks
+from .profiling import get_profile_paths, load_profile, get_profile
+from .representations import FlatListModelMixin, FlatReceiptSerializer, FlatInvoiceSerializer
+from .caching import CachedRetrieveModelMixin, delete_representation, bump_company_version, forget_company
+from .reports import (
+    REPORTS, report_rows, csv_chunks, async_csv_chunks, get_report_params, get_report_queryset, limit_report,
+    dump_cursor
+)
 
 
 class CompanyViewSet(
+    TimedSerializerMixin,
     GenericViewSet,
     ListModelMixin,
     RetrieveModelMixin,
     CreateModelMixin,
+    UpdateModelMixin,
     DestroyModelMixin
 ):
 
@@ -28,8 +60,21 @@ class CompanyViewSet(
     def get_queryset(self):
         return Company.objects.filter(owner=self.request.user)
 
+    def perform_create(self, serializer):
+        company = serializer.save()
+        forget_company(company.owner_id, company.name)
+
+    def perform_destroy(self, instance):
+        company_id = instance.pk
+        instance.delete()
+        bump_company_version(company_id)
+        forget_company(instance.owner_id, instance.name)
+
 
 class InvoiceViewSet(
+    TimedSerializerMixin,
+    CachedRetrieveModelMixin,
+    FlatListModelMixin,
     GenericViewSet,
     ListModelMixin,
     RetrieveModelMixin,
@@ -38,16 +83,54 @@ class InvoiceViewSet(
 ):
 
     serializer_class = InvoiceSerializer
-    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    flat_serializer_class = FlatInvoiceSerializer
+    cache_doctype = "invoice"
+    filter_backends = [DjangoFilterBackend, FullTextSearchFilter, OrderingFilter]
     filterset_class = InvoiceFilter
-    ordering_fields = ["buyer_name", "buyer_nip", "buyer_pesel", "date_created", "date_finished"
+    pagination_class = DocumentCursorPagination
+    ordering_fields = ["buyer_name", "buyer_nip", "buyer_pesel", "date_created", "date_finished",
                        "invoice_number", "currency", "is_prepayment"]
+    ordering = DocumentCursorPagination.ordering
 
     def get_queryset(self):
-        return Invoice.objects.filter(company__owner=self.request.user)
+        return InvoiceSerializer.optimize_queryset(
+            Invoice.objects.filter(company__owner=self.request.user),
+            *InvoiceSerializer.get_sparse_params(self.request.query_params)
+        )
+
+    def perform_destroy(self, instance):
+        pk = instance.pk
+        with transaction.atomic():
+            apply_contributions(invoice_contributions(instance, instance.tax_summaries.all()), sign=-1)
+            instance.delete()
+        delete_representation("invoice", pk)
+
+    @action(detail=False, methods=["post"], url_path="import", parser_classes=[JSONParser, NDJSONParser])
+    def import_invoices(self, request):
+        """
+        Imports invoices from a JSON array or NDJSON body.
+        Every batch is saved in its own transaction, the result of every record is reported.
+        Optional batch_size query parameter sets the number of records per batch.
+        """
+        if not isinstance(request.data, list):
+            raise ValidationError("Expected a list of invoices")
+        try:
+            batch_size = int(request.query_params.get("batch_size", 0)) or None
+        except ValueError:
+            raise ValidationError("batch_size must be an integer")
+        results = list(InvoiceImporter(request.user, batch_size=batch_size).run(request.data))
+        created = sum(1 for result in results if result["status"] == "created")
+        return Response({
+            "created": created,
+            "failed": len(results) - created,
+            "results": results
+        })
 
 
 class ReceiptViewSet(
+    TimedSerializerMixin,
+    CachedRetrieveModelMixin,
+    FlatListModelMixin,
     GenericViewSet,
     ListModelMixin,
     RetrieveModelMixin,
@@ -56,19 +139,37 @@ class ReceiptViewSet(
 ):
 
     serializer_class = ReceiptSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    flat_serializer_class = FlatReceiptSerializer
+    cache_doctype = "receipt"
+    filter_backends = [DjangoFilterBackend, FullTextSearchFilter, OrderingFilter]
     filterset_class = ReceiptFilter
-    search_fields = ["header"]
+    pagination_class = DocumentCursorPagination
     ordering_fields = ["print_number", "receipt_number", "date_created", "currency"]
+    ordering = DocumentCursorPagination.ordering
 
     def get_queryset(self):
-        return Receipt.objects.filter(company__owner=self.request.user)
-
+        return ReceiptSerializer.optimize_queryset(
+            Receipt.objects.filter(company__owner=self.request.user),
+            *ReceiptSerializer.get_sparse_params(self.request.query_params)
+        )
 
-class PseudoBuffer:
+    def perform_destroy(self, instance):
+        pk = instance.pk
+        with transaction.atomic():
+            apply_contributions(receipt_contributions(instance, instance.tax_summaries.all()), sign=-1)
+            instance.delete()
+        delete_representation("receipt", pk)
 
-    def write(self, value):
-        return value
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """
+        Creates many receipts at once from a list of receipts.
+        Validation errors are returned as a list in the same order as the input.
+        """
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        receipts = serializer.save()
+        return Response(ReceiptSummarySerializer(receipts, many=True).data, status=status.HTTP_201_CREATED)
 
 
 class SalesReportView(APIView):
@@ -76,50 +177,186 @@ class SalesReportView(APIView):
     """
     Exports either invoice or receipt to .csv format.
     Possible values for doctype are: invoice, receipt
+    Rows can be filtered with since, until, company and currency query parameters.
+    X-Report-Cursor response header can be passed as cursor parameter to export only rows created later.
+    The cursor doesn't pass rows created in the last REPORT_CURSOR_LAG seconds, so reports with a cursor
+    leave them to the next report.
+    The response is compressed according to Accept-Encoding (gzip, zstd), format parameter gzip or zstd
+    downloads a compressed file instead.
     """
 
+    content_negotiation_class = ReportContentNegotiation
+
     def get(self, request, doctype):
-        if doctype not in ("invoice", "receipt"):
+        if doctype not in REPORTS:
             raise NotAcceptable("Type must be invoice or receipt")
-        buffer = PseudoBuffer()
-        writer = csv.writer(buffer)
-        if doctype == "invoice":
-            fields = ["Seller", "Buyer", "Marketplace", "Country", "InvoiceId",
-                      "TransactionTime", "MarketplaceCurrency", "NetPrice", "TotalTax", "GrossPrice"]
-            invoices = list(Invoice.objects.filter(company__owner=request.user).values_list(
-                "company__name",
-                "buyer_name",
-                "company__website",
-                "company__company_address__country",
-                "id",
-                "date_finished",
-                "currency",
-                "net_price",
-                "total_tax",
-                "gross_price"
-            ))
-            invoices.insert(0, fields)
-            rows = (writer.writerow(row) for row in invoices)
-            response = StreamingHttpResponse(rows, content_type="text/csv")
-            response['Content-Disposition'] = 'attachment; filename=report.csv'
-            return response
-
-        elif doctype == "receipt":
-            fields = ["Seller", "ReceiptId", "Country", "TransactionTime",
-                      "MarketplaceCurrency", "TotalTax", "GrossPrice"]
-            receipts = list(Receipt.objects.filter(company__owner=request.user).values_list(
-                "company__name",
-                "id",
-                "company__company_address__country",
-                "date_created",
-                "currency",
-                "total_tax",
-                "gross_price"
-            ))
-            receipts.insert(0, fields)
-            rows = (writer.writerow(row) for row in receipts)
-            response = StreamingHttpResponse(rows, content_type="text/csv")
-            response['Content-Disposition'] = "attachment; filename=report.csv"
-            return response
+        encoding, compressed_file = self.get_content_negotiator().select_encoding(request)
+        params = get_report_params(doctype, request.query_params)
+        queryset = get_report_queryset(request.user, doctype, params)
+        queryset, watermark = limit_report(queryset, params)
+        chunks = csv_chunks(report_rows(queryset, doctype))
+        async_chunks = async_csv_chunks(queryset, doctype)
+        content_type = "text/csv"
+        filename = "report.csv"
+        if encoding is not None:
+            chunks = compress_chunks(chunks, encoding)
+            async_chunks = async_compress_chunks(async_chunks, encoding)
+        if compressed_file:
+            content_type = COMPRESSORS[encoding].content_type
+            filename = f"report.csv.{COMPRESSORS[encoding].extension}"
+        response = AsyncStreamingHttpResponse(chunks, async_chunks, content_type=content_type)
+        response['Content-Disposition'] = f"attachment; filename={filename}"
+        patch_vary_headers(response, ["Accept-Encoding"])
+        if encoding is not None and not compressed_file:
+            response['Content-Encoding'] = encoding
+        if watermark is not None:
+            response['X-Report-Cursor'] = dump_cursor(doctype, *watermark)
+        elif "cursor" in request.query_params:
+            response['X-Report-Cursor'] = request.query_params["cursor"]
+        return response
+
+
+class ReportJobViewSet(
+    TimedSerializerMixin,
+    GenericViewSet,
+    RetrieveModelMixin,
+    CreateModelMixin
+):
+
+    """
+    Generates sales reports in the background.
+    Create a job with doctype and report params, poll it until status is finished and get the file from download.
+    """
+
+    serializer_class = ReportJobSerializer
+
+    def get_queryset(self):
+        return ReportJob.objects.filter(owner=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        job, created = submit_report_job(
+            request.user,
+            serializer.validated_data["doctype"],
+            serializer.validated_data["params"]
+        )
+        return Response(
+            self.get_serializer(job).data,
+            status=status.HTTP_202_ACCEPTED if created else status.HTTP_200_OK
+        )
+
+    @action(detail=True, methods=["get"])
+    def download(self, request, pk=None):
+        job = self.get_object()
+        path = get_report_path(job)
+        if job.status != ReportJob.FINISHED or not path.exists():
+            raise NotFound("Report is not ready")
+        return ranged_file_response(request, path, "application/gzip", f"report-{job.pk}.csv.gz", f'"{job.pk}"')
+
+
+class SalesAnalyticsViewSet(
+    TimedSerializerMixin,
+    GenericViewSet,
+    ListModelMixin
+):
+
+    """
+    Sales totals per company, day or month, currency and VAT rate.
+    Rows with vat_rate "total" are totals of whole documents.
+    """
+
+    serializer_class = SalesRollupSerializer
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filterset_class = SalesRollupFilter
+    ordering_fields = ["period_start", "currency", "gross_price"]
+    pagination_class = None
+
+    def get_queryset(self):
+        return SalesRollup.objects.filter(company__owner=self.request.user).select_related("company")
+
+
+class SearchViewSet(
+    TimedSerializerMixin,
+    GenericViewSet,
+    ListModelMixin
+):
+
+    """
+    Full-text search over receipt headers, invoice buyer names and product names, best matches first.
+    Query parameters: q (required), doctype (invoice or receipt) and limit (20 by default, at most 100).
+    """
+
+    serializer_class = SearchEntrySerializer
+    pagination_class = None
+    default_limit = 20
+    max_limit = 100
+
+    def get_queryset(self):
+        return SearchEntry.objects.filter(company__owner=self.request.user).select_related("company")
+
+    def list(self, request, *args, **kwargs):
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            raise ValidationError({"q": ["This parameter is required."]})
+        queryset = self.get_queryset()
+        doctype = request.query_params.get("doctype")
+        if doctype is not None:
+            if doctype not in ("invoice", "receipt"):
+                raise ValidationError({"doctype": ["Type must be invoice or receipt"]})
+            queryset = queryset.filter(**{f"{doctype}__isnull": False})
+        try:
+            limit = min(int(request.query_params.get("limit", self.default_limit)), self.max_limit)
+        except ValueError:
+            raise ValidationError({"limit": ["limit must be an integer"]})
+        entries = matching_entries(queryset, query, ranked=True)[:max(limit, 1)]
+        return Response(self.get_serializer(entries, many=True).data)
+
+
+class MetricsView(APIView):
+
+    """
+    Request metrics of all worker processes in the Prometheus text format.
+    When METRICS_TOKEN is set, scrapers have to send it in the Authorization: Bearer header,
+    otherwise metrics are available to staff users only.
+    """
+
+    swagger_schema = None
+
+    def get_authenticators(self):
+        # The metrics token is sent in the Authorization header, which user authentication would reject
+        return [] if settings.METRICS_TOKEN else super().get_authenticators()
+
+    def get_permissions(self):
+        return [AllowAny()] if settings.METRICS_TOKEN else [IsAdminUser()]
+
+    def get(self, request):
+        if settings.METRICS_TOKEN:
+            expected = f"Bearer {settings.METRICS_TOKEN}"
+            if not constant_time_compare(request.META.get("HTTP_AUTHORIZATION", ""), expected):
+                raise PermissionDenied("Invalid metrics token")
+        return HttpResponse(render_metrics(collect()), content_type="text/plain; version=0.0.4")
+
+
+class ProfileViewSet(ViewSet):
+
+    """
+    SQL profiles of requests stored by booking.middleware.ProfilerMiddleware on this server, the newest first.
+    The list leaves out statements, retrieve a profile by id to get them. Available to staff users only.
+    """
+
+    permission_classes = [IsAdminUser]
+    swagger_schema = None
 
+    def list(self, request):
+        profiles = (load_profile(path) for path in get_profile_paths())
+        return Response([
+            {key: value for key, value in profile.items() if key != "queries"}
+            for profile in profiles if profile is not None
+        ])
 
+    def retrieve(self, request, pk=None):
+        profile = get_profile(pk)
+        if profile is None:
+            raise NotFound()
+        return Response(profile)
@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'randomproject.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# Imported after setup, sends streamed reports without holding a thread for the whole download
+from booking.asgi import ASGIHandler  # noqa: E402
+
+application = ASGIHandler()
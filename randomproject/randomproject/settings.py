@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 
 from pathlib import Path
 from datetime import timedelta
+from importlib.util import find_spec
+import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -54,6 +56,8 @@ INSTALLED_APPS = [
 SITE_ID = 1
 
 MIDDLEWARE = [
+    'booking.middleware.MetricsMiddleware',
+    'booking.middleware.ProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -120,16 +124,24 @@ AUTHENTICATION_BACKENDS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'dj_rest_auth.jwt_auth.JWTAuthentication'
+        'users.authentication.CachedJWTAuthentication'
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated'
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'booking.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer'
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 5,
     'EXCEPTION_HANDLER': 'booking.exceptions.custom_exception_handler'
 }
 
+# MessagePack responses (Accept: application/msgpack) are available when msgpack is installed
+if find_spec('msgpack') is not None:
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].append('booking.renderers.MessagePackRenderer')
+
 REST_AUTH_SERIALIZERS = {
     'USER_DETAILS_SERIALIZER': 'users.serializers.CustomUserDetailsSerializer'
 }
@@ -145,6 +157,68 @@ SIMPLE_JWT = {
 
 REST_USE_JWT = True
 
+# Users resolved from access tokens are kept in memory of every process until the token expires, but at most
+# this many seconds, a changed or deleted user is loaded again by every process through the shared cache
+AUTH_USER_CACHE_SIZE = 4096
+AUTH_USER_CACHE_TTL = 300
+
+# Number of rows written per INSERT statement by the bulk endpoints
+BULK_BATCH_SIZE = 500
+
+# Number of rows fetched from the database and written per chunk by the sales reports
+REPORT_CHUNK_SIZE = 2000
+# Seconds documents are left out of sales reports and their cursors, so transactions saving them can commit,
+# it has to be longer than the longest transaction creating documents, like a batch of the invoice import
+REPORT_CURSOR_LAG = 60
+# Compression levels of streamed reports, every chunk is compressed as it's produced
+REPORT_GZIP_LEVEL = 6
+REPORT_ZSTD_LEVEL = 3
+
+# Background report jobs, REPORT_JOB_WORKERS = 0 generates reports in the request process
+REPORTS_ROOT = BASE_DIR / 'reports'
+REPORT_JOB_WORKERS = 2
+# Seconds a finished report is reused for identical requests, older reports and their files are deleted
+REPORT_JOB_REUSE_SECONDS = 600
+# Seconds after which a job still pending is submitted to the workers again when it's requested
+REPORT_JOB_REQUEUE_SECONDS = 300
+# Seconds after which a pending or running job is considered dead and failed
+REPORT_JOB_TIMEOUT = 3600
+# Seconds a rendered receipt or invoice is kept in the cache
+REPRESENTATION_CACHE_TIMEOUT = 24 * 3600
+# Number of companies resolved by name kept in memory of every process and seconds they are kept
+COMPANY_CACHE_SIZE = 1024
+COMPANY_CACHE_TTL = 300
+# Every process writes its request metrics to its own file in METRICS_DIR at most every METRICS_FLUSH_INTERVAL
+# seconds and /metrics sums the files of running processes, removing the files of the others
+METRICS_DIR = BASE_DIR / 'metrics'
+METRICS_FLUSH_INTERVAL = 5
+# Bearer token required by /metrics, only staff users can read the metrics when it's empty
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Requests with the X-Profile header set to PROFILER_TOKEN are profiled, profiling by header is off when it's empty
+PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN', '')
+# Fraction of other requests which are profiled, their profiles are kept only when they take
+# PROFILER_SLOW_REQUEST_SECONDS or longer
+PROFILER_SAMPLE_RATE = 0
+PROFILER_SLOW_REQUEST_SECONDS = 1
+# Statements run this many times in one request are reported as N+1 suspects
+PROFILER_REPEATED_QUERIES = 3
+# Profiles are stored in PROFILER_DIR of every server, only the newest PROFILER_RING_SIZE of them are kept
+PROFILER_DIR = BASE_DIR / 'profiles'
+PROFILER_RING_SIZE = 100
+
+# Company versions, document representations and users are cached here, and company updates and deletions
+# invalidate cached entries of every worker process through it, so the cache has to be shared by all of them.
+# The file cache is shared by the processes of one server, deployments with several servers need Redis or Memcached
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000
+        }
+    }
+}
+
 ACCOUNT_AUTHENTICATION_METHOD = 'username'
 ACCOUNT_EMAIL_REQUIRED = True
 ACCOUNT_EMAIL_VERIFICATION = 'none'
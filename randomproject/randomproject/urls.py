@@ -5,6 +5,7 @@ from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from dj_rest_auth.views import LoginView, UserDetailsView
 from dj_rest_auth.registration.views import RegisterView
+from booking.views import MetricsView
 
 public_patterns = [
     path("api/", include("booking.urls")),
@@ -30,6 +31,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path("api/", include("booking.urls")),
     path("auth/", include("users.urls")),
+    path("metrics", MetricsView.as_view(), name="metrics"),
     re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
     re_path(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     re_path(r'^redoc/$', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc')
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from dj_rest_auth.jwt_auth import JWTAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from randomproject.lru import LRUCache
+from time import time
+from uuid import uuid4
+
+UserModel = get_user_model()
+
+# Per-process cache of user id -> (field values of the user, user version)
+users = LRUCache(settings.AUTH_USER_CACHE_SIZE, settings.AUTH_USER_CACHE_TTL)
+
+
+def get_user_version_key(user_id):
+    return f"users:user-version:{user_id}"
+
+
+def get_user_version(user_id):
+    return cache.get_or_set(get_user_version_key(user_id), uuid4().hex, None)
+
+
+def forget_user(user_id):
+    """
+    Replaces the version of the user in the shared cache, so every process loads the user again.
+    """
+    cache.set(get_user_version_key(user_id), uuid4().hex, None)
+    users.delete(str(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+
+    """
+    JWT authentication keeping field values of users resolved from access tokens in memory until the token expires,
+    at most for AUTH_USER_CACHE_TTL seconds. Values are used while the user version in the shared cache is current,
+    which is replaced when the user is saved or deleted, and every request gets its own user instance.
+    """
+
+    def get_user(self, validated_token):
+        user_id = validated_token.payload.get(jwt_settings.USER_ID_CLAIM)
+        if user_id is None:
+            return super().get_user(validated_token)
+        version = get_user_version(user_id)
+        entry = users.get(str(user_id))
+        if entry is None or entry[1] != version:
+            # The version is read before the user, so a change made in between replaces it and isn't missed
+            user = super().get_user(validated_token)
+            values = tuple(field.value_from_object(user) for field in UserModel._meta.concrete_fields)
+            users.set(str(user_id), ((user._state.db, values), version), ttl=validated_token["exp"] - time())
+            return user
+        (db, values), _version = entry
+        user = UserModel.from_db(db, [field.attname for field in UserModel._meta.concrete_fields], values)
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        return user
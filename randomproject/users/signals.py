@@ -0,0 +1,12 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .authentication import forget_user
+
+UserModel = get_user_model()
+
+
+@receiver(post_save, sender=UserModel)
+@receiver(post_delete, sender=UserModel)
+def forget_cached_user(sender, instance, **kwargs):
+    forget_user(instance.pk)
@@ -1,3 +1,71 @@
-from django.test import TestCase
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.shortcuts import reverse
+from django.core.cache.backends.filebased import FileBasedCache
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+from randomproject.lru import LRUCache
+from unittest import mock
+from .authentication import CachedJWTAuthentication, forget_user
+import tempfile
 
-# Create your tests here.
+User = get_user_model()
+
+
+def setUpModule():
+    # Metrics and cache entries of the test process must not end up in the project directory
+    global temporary_dir, temporary_settings
+    temporary_dir = tempfile.TemporaryDirectory()
+    temporary_settings = override_settings(
+        METRICS_DIR=f"{temporary_dir.name}/metrics",
+        CACHES={"default": {**settings.CACHES["default"], "LOCATION": f"{temporary_dir.name}/cache"}}
+    )
+    temporary_settings.enable()
+
+
+def tearDownModule():
+    temporary_settings.disable()
+    temporary_dir.cleanup()
+
+
+class CachedJWTAuthenticationTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="TestUser", date_of_birth="2000-01-01")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+
+    def test_user_is_cached(self):
+        self.client.get(reverse("company-list"))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("company-list"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_changed_user_is_reloaded(self):
+        self.client.get(reverse("company-list"))
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse("company-list")).status_code, 401)
+
+    def test_every_request_gets_its_own_user(self):
+        authentication = CachedJWTAuthentication()
+        request = APIRequestFactory().get("/", HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+        first_user, _ = authentication.authenticate(request)
+        with self.assertNumQueries(0):
+            second_user, _ = authentication.authenticate(request)
+        self.assertIsNot(second_user, first_user)
+        second_user.first_name = "Changed"
+        third_user, _ = authentication.authenticate(request)
+        self.assertEqual(third_user.first_name, self.user.first_name)
+        self.assertEqual(third_user.pk, self.user.pk)
+
+    def test_user_changed_by_other_process_is_reloaded(self):
+        self.client.get(reverse("company-list"))
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        # Another worker process saves the user and replaces its version through its own cache instance
+        other_cache = FileBasedCache(settings.CACHES["default"]["LOCATION"], {})
+        with mock.patch("users.authentication.cache", other_cache), \
+                mock.patch("users.authentication.users", LRUCache(1)):
+            forget_user(self.user.pk)
+        self.assertEqual(self.client.get(reverse("company-list")).status_code, 401)